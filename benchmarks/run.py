@@ -0,0 +1,319 @@
+"""
+Benchmarks the gateway against local stand-ins for voctoweb and the upload host.
+
+    python -m benchmarks.run --requests 200 --concurrency 16 --output results.json
+
+Every scenario reports throughput, latency percentiles, response status codes and
+memory usage of the benchmark process (which runs the gateway in-process).
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from benchmarks import stubs
+
+SCENARIOS = ["single_upload", "batch_upload", "metadata_storm", "upstream_outage"]
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def rss_mb() -> float | None:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return None
+
+
+def vtt(size: int, seed: int) -> bytes:
+    """A valid WebVTT file of about `size` bytes, different for every seed"""
+    lines = [f"WEBVTT\n\nNOTE {seed}\n"]
+    total = len(lines[0])
+    second = 0
+    while total < size:
+        cue = (
+            f"\n{second // 3600:02}:{second // 60 % 60:02}:{second % 60:02}.000 --> "
+            f"{second // 3600:02}:{second // 60 % 60:02}:{second % 60:02}.900\n"
+            f"Line {second} of benchmark file {seed}\n"
+        )
+        lines.append(cue)
+        total += len(cue)
+        second += 1
+    return "".join(lines).encode()
+
+
+async def measure(requests: int, concurrency: int, send) -> dict:
+    """Runs `send(i)` for i in range(requests), at most `concurrency` at a time"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    statuses: dict[str, int] = {}
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                status = str((await send(i)).status_code)
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    duration = time.perf_counter() - start
+    latencies.sort()
+    result = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(requests / duration, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+        "statuses": statuses,
+        "memory_mb": {
+            "rss_before": rss_before and round(rss_before, 1),
+            "rss_after": (rss := rss_mb()) and round(rss, 1),
+            # ru_maxrss is in KiB on Linux
+            "max_rss": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+    }
+    return result
+
+
+def summary(name: str, result: dict) -> str:
+    latency = result["latency_ms"]
+    return (
+        f"{name:>16}: {result['throughput_rps']:8.1f} req/s, p50 {latency['p50']} ms,"
+        f" p95 {latency['p95']} ms, p99 {latency['p99']} ms, {result['statuses']}"
+    )
+
+
+async def run_scenarios(args, control) -> dict:
+    # imported late, the gateway reads its configuration from the environment on import
+    from publishing_gw import auth, cdn, server, voctoweb
+    import httpx
+
+    api_key = next(iter(auth.settings.config.allowed_keys))
+    headers = {"Authorization": f"Token {api_key}"}
+    conference = stubs.CONFERENCE
+    meta = json.dumps({"recording": {"language": "deu", "mime_type": "text/vtt"}})
+
+    def guid(i):
+        return stubs.event_guid(i % args.events)
+
+    results = {}
+    transport = httpx.ASGITransport(app=server.app)
+    async with (
+        server.lifespan(server.app),
+        httpx.AsyncClient(transport=transport, base_url="http://gateway", timeout=300) as client,
+    ):
+
+        async def single_upload(i, seed=0):
+            return await client.put(
+                f"/api/{conference}/events/{guid(i)}/file",
+                headers=headers,
+                files={
+                    "meta": (None, meta, "application/json"),
+                    "file": (f"{i}.vtt", vtt(args.file_size, seed + i), "text/vtt"),
+                },
+            )
+
+        async def batch_upload(i):
+            names = [f"f{j}" for j in range(args.batch_size)]
+            files = [
+                (
+                    "meta",
+                    (
+                        None,
+                        json.dumps(
+                            {
+                                "files": {
+                                    name: {
+                                        "guid": guid(i * args.batch_size + j),
+                                        "recording": {"language": "deu", "mime_type": "text/vtt"},
+                                    }
+                                    for j, name in enumerate(names)
+                                }
+                            }
+                        ),
+                        "application/json",
+                    ),
+                )
+            ]
+            files += [
+                (
+                    name,
+                    (f"{name}.vtt", vtt(args.file_size, 1_000_000 + i * args.batch_size + j), "text/vtt"),
+                )
+                for j, name in enumerate(names)
+            ]
+            return await client.put(f"/api/{conference}/files", headers=headers, files=files)
+
+        async def metadata_read(i):
+            kind = i % 3
+            if kind == 0:
+                return await client.get(f"/api/{conference}")
+            if kind == 1:
+                return await client.get(f"/api/{conference}/events/{guid(i)}")
+            return await client.get(
+                f"/api/{conference}/resolve/{stubs.video_filename(i % args.events)}"
+            )
+
+        async def mixed(i):
+            return await (single_upload(i, seed=2_000_000) if i % 2 else metadata_read(i))
+
+        for scenario in args.scenarios:
+            if scenario == "single_upload":
+                result = await measure(args.requests, args.concurrency, single_upload)
+            elif scenario == "batch_upload":
+                result = await measure(
+                    max(1, args.requests // args.batch_size), args.concurrency, batch_upload
+                )
+                result["files_per_request"] = args.batch_size
+            elif scenario == "metadata_storm":
+                result = await measure(
+                    args.requests * 5, args.concurrency * 4, metadata_read
+                )
+            elif scenario == "upstream_outage":
+                voctoweb.cache.clear()
+                for flag in control["outage"]:
+                    flag.value = 1
+                try:
+                    result = await measure(args.requests, args.concurrency, mixed)
+                finally:
+                    for flag in control["outage"]:
+                        flag.value = 0
+                    # do not let the outage spill over into later scenarios
+                    voctoweb.breaker.success()
+                    for target in cdn.targets:
+                        target.breaker.success()
+            results[scenario] = result
+            print(summary(scenario, result))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--events", type=int, default=500, help="events of the stub conference")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="bytes per uploaded file")
+    parser.add_argument("--batch-size", type=int, default=10, help="files per batch request")
+    parser.add_argument("--voctoweb-latency", type=float, default=0.02, help="seconds per request")
+    parser.add_argument("--sftp-latency", type=float, default=0.005, help="seconds per SFTP request")
+    parser.add_argument(
+        "--outage", choices=["voctoweb", "sftp", "both"], default="voctoweb",
+        help="upstream failing during the upstream_outage scenario",
+    )
+    parser.add_argument("--output", default="benchmarks/results.json")
+    parser.add_argument(
+        "--log-level", default="ERROR",
+        help="level of the gateway's log on stderr, its warnings are expected during the outage",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+
+    workdir = tempfile.mkdtemp(prefix="publishing-gw-bench-")
+    ctx = multiprocessing.get_context("spawn")
+    voctoweb_latency = ctx.Value("d", args.voctoweb_latency, lock=False)
+    sftp_latency = ctx.Value("d", args.sftp_latency, lock=False)
+    voctoweb_down = ctx.Value("b", 0, lock=False)
+    sftp_down = ctx.Value("b", 0, lock=False)
+
+    import paramiko
+
+    host_key = os.path.join(workdir, "host_key")
+    client_key = os.path.join(workdir, "client_key")
+    paramiko.RSAKey.generate(2048).write_private_key_file(host_key)
+    paramiko.RSAKey.generate(2048).write_private_key_file(client_key)
+    root = os.path.join(workdir, "cdn")
+    os.makedirs(root)
+
+    voctoweb_port = stubs.free_port()
+    sftp_port = stubs.free_port()
+    processes = [
+        ctx.Process(
+            target=stubs.serve_voctoweb,
+            args=(voctoweb_port, args.events, voctoweb_latency, voctoweb_down),
+            daemon=True,
+        ),
+        ctx.Process(
+            target=stubs.serve_sftp,
+            args=(sftp_port, root, host_key, sftp_latency, sftp_down),
+            daemon=True,
+        ),
+    ]
+    for process in processes:
+        process.start()
+
+    os.environ.update(
+        VOCTOWEB_URL=f"http://127.0.0.1:{voctoweb_port}",
+        VOCTOWEB_API_KEY="benchmark",
+        SFTP_UPLOAD_HOST="127.0.0.1",
+        SFTP_UPLOAD_PORT=str(sftp_port),
+        SFTP_UPLOAD_USER="bench",
+        SFTP_UPLOAD_KEY=client_key,
+        JOBS_DIR=os.path.join(workdir, "jobs"),
+        CDN_INDEX=os.path.join(workdir, "cdn-index.sqlite"),
+    )
+    control = {
+        "outage": {
+            "voctoweb": [voctoweb_down],
+            "sftp": [sftp_down],
+            "both": [voctoweb_down, sftp_down],
+        }[args.outage]
+    }
+
+    try:
+        stubs.wait_for_port(voctoweb_port)
+        stubs.wait_for_port(sftp_port)
+        scenarios = asyncio.run(run_scenarios(args, control))
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    report = {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "revision": revision,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": vars(args),
+        "scenarios": scenarios,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""
+Local stand-ins for voctoweb and the upload host, each running in its own process.
+Latency and outages are controlled at runtime through shared memory values.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from multiprocessing.sharedctypes import Synchronized
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+from paramiko.sftp import SFTP_FAILURE, SFTP_OK
+
+CONFERENCE = "bench"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def event_guid(i: int) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{CONFERENCE}/{i}"))
+
+
+def video_filename(i: int) -> str:
+    return f"{CONFERENCE}-{i}-deu-Talk_{i}_hd.mp4"
+
+
+def _event(i: int) -> dict:
+    guid = event_guid(i)
+    static = f"https://static.media.ccc.de/media/{CONFERENCE}/{i}-{guid}"
+    return {
+        "guid": guid,
+        "slug": f"{CONFERENCE}-{i}-talk-{i}",
+        "title": f"Talk {i}",
+        "date": "2023-12-28T19:00:00.000+01:00",
+        "video": {"filename": video_filename(i)},
+        "images": {"thumbUrl": f"{static}.jpg"},
+    }
+
+
+def _detailed_event(i: int) -> dict:
+    event = _event(i)
+    static = event["images"]["thumbUrl"].removesuffix(".jpg")
+    return {
+        **{k: event[k] for k in ("guid", "slug", "title", "date")},
+        "subtitle": None,
+        "link": f"https://example.org/{i}",
+        "description": "",
+        "original_language": "deu",
+        "persons": [],
+        "tags": [],
+        "view_count": 0,
+        "promoted": False,
+        "release_date": event["date"],
+        "updated_at": event["date"],
+        "length": 2400,
+        "duration": 2400,
+        "thumb_url": f"{static}.jpg",
+        "poster_url": f"{static}_preview.jpg",
+        "timeline_url": f"{static}.timeline.jpg",
+        "thumbnails_url": f"{static}.thumbnails.vtt",
+        "frontend_link": f"https://media.ccc.de/v/{event['slug']}",
+        "url": f"https://media.ccc.de/public/events/{event['guid']}",
+        "related": [],
+        "recordings": [
+            {
+                "size": 500,
+                "length": 2400,
+                "mime_type": "video/mp4",
+                "language": "deu",
+                "filename": video_filename(i),
+                "state": "new",
+                "folder": "h264-hd",
+                "high_quality": True,
+                "width": 1920,
+                "height": 1080,
+                "updated_at": event["date"],
+                "recording_url": f"https://cdn.media.ccc.de/{CONFERENCE}/h264-hd/{video_filename(i)}",
+            }
+        ],
+    }
+
+
+def serve_voctoweb(port: int, events: int, latency: Synchronized, down: Synchronized):
+    """GraphQL, public REST and private API of voctoweb, as far as the gateway uses them"""
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    conference = {
+        "id": CONFERENCE,
+        "title": "Benchmark Conference",
+        "events": {"nodes": [_event(i) for i in range(events)]},
+    }
+    details = {event_guid(i): _detailed_event(i) for i in range(events)}
+    recordings = 0
+
+    async def delay():
+        if latency.value:
+            await asyncio.sleep(latency.value)
+        if down.value:
+            return JSONResponse({"error": "down"}, status_code=503)
+
+    async def graphql(request):
+        if response := await delay():
+            return response
+        variables = json.loads(request.query_params.get("variables", "{}"))
+        if variables.get("slug") != CONFERENCE:
+            return JSONResponse({"data": {"conference": None}})
+        if "first" not in variables:
+            return JSONResponse({"data": {"conference": conference}})
+        # Relay style pagination, cursors are the (stringified) index of the last event
+        start = int(variables["after"]) + 1 if variables.get("after") else 0
+        end = start + variables["first"]
+        nodes = conference["events"]["nodes"]
+        page = {
+            "pageInfo": {"hasNextPage": end < len(nodes), "endCursor": str(end - 1)},
+            "nodes": nodes[start:end],
+        }
+        return JSONResponse({"data": {"conference": {**conference, "events": page}}})
+
+    async def event(request):
+        if response := await delay():
+            return response
+        detail = details.get(request.path_params["guid"])
+        if detail is None:
+            return JSONResponse({"error": "not found"}, status_code=404)
+        return JSONResponse(detail)
+
+    async def upsert(request):
+        nonlocal recordings
+        if response := await delay():
+            return response
+        await request.json()
+        recordings += 1
+        return JSONResponse({"id": recordings}, status_code=201)
+
+    app = Starlette(
+        routes=[
+            Route("/graphql", graphql),
+            Route("/public/events/{guid}", event),
+            Route("/api/recordings", upsert, methods=["POST"]),
+        ]
+    )
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+
+class _Server(paramiko.ServerInterface):
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+class _Handle(SFTPHandle):
+    def __init__(self, sftp, flags=0):
+        super().__init__(flags)
+        self.sftp = sftp
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def read(self, offset, length):
+        return self.sftp.delay() or super().read(offset, length)
+
+    def write(self, offset, data):
+        return self.sftp.delay() or super().write(offset, data)
+
+
+class _SFTP(SFTPServerInterface):
+    """Serves the files below `root`, with `latency` seconds added to every request"""
+
+    def __init__(self, server, root: str, latency: Synchronized, down: Synchronized):
+        super().__init__(server)
+        self.root = root
+        self.latency = latency
+        self.down = down
+
+    def delay(self):
+        if self.latency.value:
+            time.sleep(self.latency.value)
+        if self.down.value:
+            return SFTP_FAILURE
+        return None
+
+    def _path(self, path):
+        return self.root + self.canonicalize(path)
+
+    def _errno(self, fn, *args):
+        if error := self.delay():
+            return error
+        try:
+            return fn(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        def listing(path):
+            result = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+
+        return self._errno(listing, self._path(path))
+
+    def stat(self, path):
+        return self._errno(lambda p: SFTPAttributes.from_stat(os.stat(p)), self._path(path))
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        def open_file(path):
+            fd = os.open(path, flags, 0o644)
+            if flags & os.O_WRONLY:
+                mode = "ab" if flags & os.O_APPEND else "wb"
+            elif flags & os.O_RDWR:
+                mode = "a+b" if flags & os.O_APPEND else "r+b"
+            else:
+                mode = "rb"
+            handle = _Handle(self, flags)
+            handle.filename = path
+            handle.readfile = handle.writefile = os.fdopen(fd, mode)
+            return handle
+
+        return self._errno(open_file, self._path(path))
+
+    def remove(self, path):
+        return self._errno(lambda p: os.remove(p) or SFTP_OK, self._path(path))
+
+    def rename(self, oldpath, newpath):
+        return self._errno(
+            lambda a, b: os.rename(a, b) or SFTP_OK, self._path(oldpath), self._path(newpath)
+        )
+
+    def posix_rename(self, oldpath, newpath):
+        return self._errno(
+            lambda a, b: os.replace(a, b) or SFTP_OK, self._path(oldpath), self._path(newpath)
+        )
+
+    def mkdir(self, path, attr):
+        return self._errno(lambda p: os.mkdir(p) or SFTP_OK, self._path(path))
+
+    def rmdir(self, path):
+        return self._errno(lambda p: os.rmdir(p) or SFTP_OK, self._path(path))
+
+
+def serve_sftp(
+    port: int, root: str, host_key: str, latency: Synchronized, down: Synchronized
+):
+    """SSH server offering only the SFTP subsystem, accepting any public key"""
+    # connections probing whether the server is up are no errors worth logging
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    key = paramiko.RSAKey.from_private_key_file(host_key)
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", port))
+    listener.listen(64)
+
+    def handle(conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(key)
+        transport.set_subsystem_handler(
+            "sftp", SFTPServer, _SFTP, root=root, latency=latency, down=down
+        )
+        try:
+            transport.start_server(server=_Server())
+        except (paramiko.SSHException, EOFError):
+            return
+        # keep a reference, channels are closed when garbage collected
+        channel = transport.accept()
+        transport.join()
+        if channel is not None:
+            channel.close()
+
+    while True:
+        conn, _ = listener.accept()
+        if down.value:
+            conn.close()
+            continue
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
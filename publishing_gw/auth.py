@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import importlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import httpx
+from jwt import JWT, JWKSet
+from jwt.exceptions import JWTDecodeError
+from jwt.utils import b64decode
+
+from publishing_gw import config as settings
+
+# seconds between checks whether config.py (and thus the allowed API keys) changed
+API_KEYS_RELOAD = float(os.environ.get("API_KEYS_RELOAD", 10))
+# JSON Web Key Set of the SSO, Bearer tokens are rejected if unset
+JWT_JWKS_URL = os.environ.get("JWT_JWKS_URL", "")
+JWT_ISSUER = os.environ.get("JWT_ISSUER")
+JWT_AUDIENCE = os.environ.get("JWT_AUDIENCE")
+JWT_ALGORITHMS = set(os.environ.get("JWT_ALGORITHMS", "RS256").split(","))
+# seconds the key set is used before it is fetched again, and min. seconds between
+# fetches triggered by tokens signed with an unknown key
+JWKS_REFRESH = float(os.environ.get("JWKS_REFRESH", 3600))
+JWKS_MIN_REFRESH = float(os.environ.get("JWKS_MIN_REFRESH", 30))
+# max. number of verified tokens remembered until they expire
+JWT_CACHE_SIZE = int(os.environ.get("JWT_CACHE_SIZE", 4096))
+
+
+def _digest(key: str) -> bytes:
+    # keys are accepted with or without the `token=` prefix
+    return hashlib.sha256(key.removeprefix("token=").encode()).digest()
+
+
+class KeySet:
+    """
+    The API keys of config.allowed_keys, stored as SHA-256 digests.
+    config.py is reloaded when it changes, so keys can be added or revoked without a restart.
+    """
+
+    def __init__(self):
+        self.digests: set[bytes] = set()
+        self.mtime = os.stat(settings.__file__).st_mtime
+        self.checked = time.monotonic()
+        self._load(settings.config.allowed_keys)
+
+    def _load(self, keys):
+        self.digests = set(map(_digest, keys))
+
+    def _reload(self):
+        try:
+            mtime = os.stat(settings.__file__).st_mtime
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self._load(importlib.reload(settings).config.allowed_keys)
+                logging.info(f"Reloaded {len(self.digests)} API keys")
+        except Exception:
+            # keep the current keys while config.py is broken
+            logging.exception("Could not reload API keys")
+
+    def check(self, key: str) -> bool:
+        now = time.monotonic()
+        if now - self.checked > API_KEYS_RELOAD:
+            self.checked = now
+            self._reload()
+        # the lookup compares digests, so its timing tells nothing about the bytes of stored keys
+        return _digest(key) in self.digests
+
+
+keys = KeySet()
+
+
+class TokenVerifier:
+    """
+    Verifies JWTs against the key set of the SSO. The key set is cached and refreshed
+    periodically (or early, for tokens signed with an unknown key), verified tokens are
+    remembered until they expire, so repeated requests with the same token skip the signature check.
+    """
+
+    def __init__(self, jwks_url: str = JWT_JWKS_URL):
+        self.jwks_url = jwks_url
+        self.jwks: Optional[JWKSet] = None
+        self.fetched = 0.0
+        self.verified: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self._jwt = JWT()
+        self._lock = asyncio.Lock()
+
+    async def _refresh(self, force=False):
+        async with self._lock:
+            age = time.monotonic() - self.fetched
+            if self.jwks is not None and age < (JWKS_MIN_REFRESH if force else JWKS_REFRESH):
+                return
+            async with httpx.AsyncClient(timeout=10) as client:
+                r = await client.get(self.jwks_url)
+                r.raise_for_status()
+            self.jwks = JWKSet.from_dict(r.json())
+            self.fetched = time.monotonic()
+
+    async def _key(self, kid: Optional[str]):
+        try:
+            await self._refresh()
+        except (httpx.HTTPError, ValueError) as e:
+            # a stale key set is better than none
+            if self.jwks is None:
+                raise JWTDecodeError(f"could not fetch key set: {e}") from e
+            logging.warning(f"Could not refresh key set, using the cached one: {e}")
+        assert self.jwks is not None
+        matches = self.jwks.filter_keys(kid=kid)
+        if not matches:
+            # keys might have been rotated
+            try:
+                await self._refresh(force=True)
+            except (httpx.HTTPError, ValueError) as e:
+                logging.warning(f"Could not refresh key set: {e}")
+            matches = self.jwks.filter_keys(kid=kid)
+        if not matches:
+            raise JWTDecodeError(f"unknown key {kid}")
+        return matches[0]
+
+    async def verify(self, token: str) -> Optional[dict]:
+        """Returns the claims of a valid token, None otherwise"""
+        if not self.jwks_url:
+            return None
+        cached = self.verified.get(token)
+        if cached is not None:
+            claims, exp = cached
+            if time.time() < exp:
+                self.verified.move_to_end(token)
+                return claims
+            del self.verified[token]
+
+        try:
+            header = json.loads(b64decode(token.split(".")[0]))
+            key = await self._key(header.get("kid"))
+            claims = self._jwt.decode(token, key, do_verify=True, algorithms=JWT_ALGORITHMS)
+        except (JWTDecodeError, ValueError, IndexError) as e:
+            logging.info(f"Rejected JWT: {e}")
+            return None
+        if JWT_ISSUER and claims.get("iss") != JWT_ISSUER:
+            return None
+        if JWT_AUDIENCE:
+            audience = claims.get("aud")
+            if JWT_AUDIENCE not in (audience if isinstance(audience, list) else [audience]):
+                return None
+
+        # tokens without expiry are verified every time
+        if isinstance(claims.get("exp"), (int, float)):
+            self.verified[token] = (claims, claims["exp"])
+            while len(self.verified) > JWT_CACHE_SIZE:
+                self.verified.popitem(last=False)
+        return claims
+
+
+tokens = TokenVerifier()
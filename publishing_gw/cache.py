@@ -0,0 +1,184 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Hashable, Optional
+
+from publishing_gw import metrics
+
+
+@dataclass
+class CacheEntry:
+    value: Any
+    expires: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def fresh(self):
+        return time.monotonic() < self.expires
+
+
+class TTLCache:
+    """
+    Bounded in-process cache with least-recently-used eviction.
+    Entries expire after `ttl` seconds but are kept (until evicted) together with
+    their ETag/Last-Modified validators, so stale entries can be revalidated upstream.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 60):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self._hits = metrics.cache_requests.labels(name, "hit")
+        self._misses = metrics.cache_requests.labels(name, "miss")
+
+    def get(self, key: Hashable) -> Optional[CacheEntry]:
+        entry = self.entries.get(key)
+        if entry is None or not entry.fresh():
+            self._misses.inc()
+        else:
+            self._hits.inc()
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key: Hashable, value: Any, etag=None, last_modified=None, ttl=None):
+        self.entries[key] = CacheEntry(
+            value=value,
+            expires=time.monotonic() + (self.ttl if ttl is None else ttl),
+            etag=etag,
+            last_modified=last_modified,
+        )
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def touch(self, key: Hashable, ttl=None):
+        """Mark an entry as fresh again, e.g. after upstream answered 304 Not Modified"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+    def pop(self, key: Hashable):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SharedCache:
+    """
+    Cache stored in an SQLite database, so that all worker processes of the gateway share one
+    cache instead of each warming (and revalidating) their own copy. Meant to be used behind a
+    TTLCache per process, which serves the fresh entries without a database query.
+    Keys and values have to be JSON serializable. The database is queried in a thread of its
+    own. When full, entries are evicted in the order they were stored: unlike TTLCache not by
+    their use, which would turn every lookup into a write.
+    """
+
+    def __init__(self, name: str, filename: str, maxsize: int = 1024, ttl: float = 60):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.db = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache (name TEXT NOT NULL, key TEXT NOT NULL,"
+            " value TEXT NOT NULL, expires REAL NOT NULL, etag TEXT, last_modified TEXT,"
+            " stored REAL NOT NULL, PRIMARY KEY (name, key))"
+        )
+        self._lock = threading.Lock()
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"cache-{name}")
+        self._hits = metrics.cache_requests.labels(name, "hit")
+        self._misses = metrics.cache_requests.labels(name, "miss")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._thread, fn, *args)
+
+    async def get(self, key: Hashable) -> Optional[CacheEntry]:
+        return await self._run(self._get, key)
+
+    async def set(self, key: Hashable, value: Any, etag=None, last_modified=None, ttl=None):
+        await self._run(self._set, key, value, etag, last_modified, ttl)
+
+    async def touch(self, key: Hashable, ttl=None):
+        """Mark an entry as fresh again, e.g. after upstream answered 304 Not Modified"""
+        await self._run(self._touch, key, ttl)
+
+    async def pop(self, key: Hashable):
+        await self._run(self._pop, key)
+
+    def _get(self, key: Hashable) -> Optional[CacheEntry]:
+        with self._lock:
+            row = self.db.execute(
+                "SELECT value, expires, etag, last_modified FROM cache WHERE name = ? AND key = ?",
+                (self.name, json.dumps(key)),
+            ).fetchone()
+        if row is None:
+            self._misses.inc()
+            return None
+        # expiry is stored as wall clock time, as monotonic clocks are not comparable between processes
+        entry = CacheEntry(
+            value=json.loads(row[0]),
+            expires=time.monotonic() + row[1] - time.time(),
+            etag=row[2],
+            last_modified=row[3],
+        )
+        if entry.fresh():
+            self._hits.inc()
+        else:
+            self._misses.inc()
+        return entry
+
+    def _set(self, key: Hashable, value: Any, etag, last_modified, ttl):
+        now = time.time()
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.name, json.dumps(key), json.dumps(value),
+                 now + (self.ttl if ttl is None else ttl), etag, last_modified, now),
+            )
+            (count,) = self.db.execute(
+                "SELECT COUNT(*) FROM cache WHERE name = ?", (self.name,)
+            ).fetchone()
+            if count > self.maxsize:
+                self.db.execute(
+                    "DELETE FROM cache WHERE name = ? AND key IN (SELECT key FROM cache"
+                    " WHERE name = ? ORDER BY stored LIMIT ?)",
+                    (self.name, self.name, count - self.maxsize),
+                )
+
+    def _touch(self, key: Hashable, ttl):
+        with self._lock:
+            self.db.execute(
+                "UPDATE cache SET expires = ? WHERE name = ? AND key = ?",
+                (time.time() + (self.ttl if ttl is None else ttl), self.name, json.dumps(key)),
+            )
+
+    def _pop(self, key: Hashable):
+        with self._lock:
+            self.db.execute(
+                "DELETE FROM cache WHERE name = ? AND key = ?", (self.name, json.dumps(key))
+            )
+
+    def clear(self):
+        with self._lock:
+            self.db.execute("DELETE FROM cache WHERE name = ?", (self.name,))
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute(
+                "SELECT COUNT(*) FROM cache WHERE name = ?", (self.name,)
+            ).fetchone()[0]
+
+    def close(self):
+        self._thread.shutdown()
+        self.db.close()
@@ -1,79 +1,992 @@
+import asyncio
+import hashlib
+import json
 import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
 import paramiko
-import urllib
-from os import path, environ as env
+import posixpath
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os import environ as env
+from typing import Callable
+from uuid import uuid4
 
-ssh = None
-sftp = None
+from publishing_gw import metrics, resilience, timing
 
+SFTP_UPLOAD_HOST = env.get("SFTP_UPLOAD_HOST", "upload.media.ccc.de")
+SFTP_UPLOAD_USER = env.get("SFTP_UPLOAD_USER", "cdn-app")
+SFTP_UPLOAD_PORT = int(env.get("SFTP_UPLOAD_PORT", 22))
+# private key file, otherwise the SSH agent and the default keys in ~/.ssh are used
+SFTP_UPLOAD_KEY = env.get("SFTP_UPLOAD_KEY") or None
+# number of parallel SSH connections and seconds to wait for a free one
+SFTP_POOL_SIZE = int(env.get("SFTP_POOL_SIZE", 4))
+SFTP_POOL_TIMEOUT = float(env.get("SFTP_POOL_TIMEOUT", 30))
+# interval of SSH keepalive packets, and idle time after which a connection is probed before use
+SFTP_KEEPALIVE = int(env.get("SFTP_KEEPALIVE", 30))
+SFTP_IDLE_CHECK = float(env.get("SFTP_IDLE_CHECK", 60))
+# max. number of received chunks buffered per streaming upload while the SFTP write catches up
+SFTP_UPLOAD_BUFFER = int(env.get("SFTP_UPLOAD_BUFFER", 8))
+# files up to this size are kept in memory and only written once complete (and changed)
+SFTP_DEFER_BYTES = int(env.get("SFTP_DEFER_BYTES", 1024 * 1024))
+# seconds a directory is trusted to exist on the upload host without checking again
+SFTP_DIR_CACHE_TTL = float(env.get("SFTP_DIR_CACHE_TTL", 600))
+# further upload hosts every file is replicated to, comma separated as [user@]host[:port]
+SFTP_UPLOAD_MIRRORS = env.get("SFTP_UPLOAD_MIRRORS", "")
+# number of upload hosts which must store a file before it counts as published, 0 for a majority
+SFTP_QUORUM = int(env.get("SFTP_QUORUM", 0))
+# local index of the SHA-256 digests of uploaded files, used to skip unchanged uploads
+CDN_INDEX = env.get("CDN_INDEX", "cdn-index.sqlite")
+# on an index miss, existing remote files up to this size are read back and hashed
+CDN_VERIFY_MAX = int(env.get("CDN_VERIFY_MAX", 16 * 1024 * 1024))
 
-def connect_ssh():
-    global ssh, sftp
-    logging.info("Establishing SSH connection")
+logging.getLogger("paramiko").setLevel(logging.ERROR)
+
+breaker = resilience.CircuitBreaker("cdn")
+
+
+class PoolExhausted(resilience.UpstreamUnavailable):
+    pass
+
+
+class ConnectFailed(Exception):
+    pass
+
+
+# errors after which an SFTP operation may succeed on a new connection
+TRANSIENT_ERRORS = (ConnectFailed, paramiko.SSHException, EOFError)
+
+
+class Connection:
+    def __init__(self, ssh: paramiko.SSHClient, sftp: paramiko.SFTPClient):
+        self.ssh = ssh
+        self.sftp = sftp
+        self.last_used = time.monotonic()
+
+    def active(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def alive(self):
+        if not self.active():
+            return False
+        # keepalives do not detect every half-open connection, so probe long idle ones
+        if time.monotonic() - self.last_used > SFTP_IDLE_CHECK:
+            try:
+                self.sftp.stat(".")
+            except (paramiko.SSHException, EOFError, OSError):
+                return False
+        return True
+
+    def close(self):
+        try:
+            self.sftp.close()
+            self.ssh.close()
+        except Exception:
+            pass
+
+
+def connect_ssh(
+    host=SFTP_UPLOAD_HOST, username=SFTP_UPLOAD_USER, port=SFTP_UPLOAD_PORT
+) -> Connection:
+    logging.info(f"Establishing SSH connection to {host}")
     ssh = paramiko.SSHClient()
-    logging.getLogger("paramiko").setLevel(logging.ERROR)
     ssh.load_system_host_keys()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    host = env.get("SFTP_UPLOAD_HOST", "upload.media.ccc.de")
     try:
         ssh.connect(
-            host,
-            username=env.get("SFTP_UPLOAD_USER", "cdn-app"),
+            host, port=port, username=username, key_filename=SFTP_UPLOAD_KEY
         )
     except paramiko.AuthenticationException as e:
-        raise Exception(f"Authentication failed. Please check credentials {e}") from e
+        raise ConnectFailed(f"Authentication failed. Please check credentials {e}") from e
     except paramiko.BadHostKeyException:
-        raise Exception("Bad host key. Check your known_hosts file")
+        raise ConnectFailed("Bad host key. Check your known_hosts file")
     except paramiko.SSHException as e:
-        raise Exception(f"SSH negotiation failed {e}") from e
+        raise ConnectFailed(f"SSH negotiation failed {e}") from e
+    except OSError as e:
+        raise ConnectFailed(f"Could not connect to {host}: {e}") from e
 
+    transport = ssh.get_transport()
+    assert transport is not None  # connected
+    transport.set_keepalive(SFTP_KEEPALIVE)
     sftp = ssh.open_sftp()
     logging.info(f"SSH connection established to {host}")
+    return Connection(ssh, sftp)
+
+
+class SFTPPool:
+    """
+    Pool of up to `size` SSH connections with one SFTP channel each.
+    Connections are checked for liveness when borrowed and transparently replaced when dead,
+    callers wait at most `timeout` seconds for a free connection.
+    """
 
+    def __init__(
+        self,
+        host,
+        username,
+        size=SFTP_POOL_SIZE,
+        timeout=SFTP_POOL_TIMEOUT,
+        port=SFTP_UPLOAD_PORT,
+        name="sftp",
+    ):
+        self.host = host
+        self.username = username
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.idle: queue.LifoQueue[Connection] = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.in_use = 0
+        self._lock = threading.Lock()
+        # set explicitly instead of via set_function, which does not work with multiple workers
+        self._in_use_gauge = metrics.pool_connections.labels(name, "in_use")
+        self._idle_gauge = metrics.pool_connections.labels(name, "idle")
 
+    def _observe(self):
+        self._in_use_gauge.set(self.in_use)
+        self._idle_gauge.set(self.idle.qsize())
 
-def upload_file(file, target):
-    # check if ssh connection is open
-    if ssh is None:
-        connect_ssh()
+    def _checkout(self) -> Connection:
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return connect_ssh(self.host, self.username, self.port)
+            if conn.alive():
+                return conn
+            logging.info(f"Dropping dead SSH connection to {self.host}")
+            conn.close()
+
+    @contextmanager
+    def sftp(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolExhausted(
+                "cdn",
+                f"no SFTP connection to {self.host} available after {self.timeout}s",
+                retry_after=self.timeout,
+            )
+        conn = None
+        with self._lock:
+            self.in_use += 1
+        try:
+            conn = self._checkout()
+            self._observe()
+            yield conn.sftp
+        except Exception as e:
+            # after transport level errors the connection is in an unknown state,
+            # do not hand it out again (plain SFTP errors like EACCES keep it usable)
+            if conn is not None and (
+                isinstance(e, (paramiko.SSHException, EOFError)) or not conn.active()
+            ):
+                conn.close()
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                conn.last_used = time.monotonic()
+                self.idle.put(conn)
+            with self._lock:
+                self.in_use -= 1
+            self._observe()
+            self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self._observe()
 
+
+pool = SFTPPool(SFTP_UPLOAD_HOST, SFTP_UPLOAD_USER, port=SFTP_UPLOAD_PORT)
+
+async def in_borrow_thread(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(borrow_executor, fn, *args)
+
+
+async def enter(cm):
+    """
+    Enters the context manager `cm` (e.g. SFTPPool.sftp()) in a borrow thread. If the caller is
+    cancelled meanwhile, the thread still completes, so whatever it borrowed is returned again.
+    """
+    future = asyncio.get_running_loop().run_in_executor(borrow_executor, cm.__enter__)
     try:
-        print("  uploading {} to {}".format(file.filename, target))
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+
+        def release(future: asyncio.Future):
+            # __exit__ of an unused connection only returns it to the pool, without any I/O
+            if not future.cancelled() and future.exception() is None:
+                cm.__exit__(None, None, None)
+
+        future.add_done_callback(release)
+        raise
+
+
+async def run(fn, *args):
+    """
+    Calls `fn(sftp, *args)` with a pooled SFTP connection in a worker thread,
+    retrying on connection problems
+    """
+
+    def with_sftp():
+        with pool.sftp() as sftp:
+            return fn(sftp, *args)
+
+    async def attempt():
         try:
-            sftp.mkdir(path.dirname(target))
-        except:
-            pass
-        with sftp.open(target, "w", 32768) as fh:
-            while True:
-                chunk = file.file.read(32768)
-                if not chunk:
-                    break
-                fh.write(chunk)
-    except paramiko.SSHException as e:
-        raise Exception(f"could not upload WebVTT because of SSH problem {e}") from e
-    except IOError as e:
-        raise Exception(f"could not upload WebVTT because of {e}") from e
+            return await in_borrow_thread(with_sftp)
+        except TRANSIENT_ERRORS as e:
+            raise resilience.Retryable(f"SFTP operation failed: {e}") from e
+
+    return await resilience.call(breaker, attempt)
 
 
-def upload_from_url(url, target):
-    # check if ssh connection is open
-    if ssh is None:
-        connect_ssh()
+def observe_upload(size: int, duration: float):
+    metrics.sftp_upload_duration.observe(duration)
+    metrics.sftp_uploaded_bytes.inc(size)
+    if duration > 0:
+        metrics.sftp_upload_throughput.observe(size / duration)
 
+
+class DirectoryCache:
+    """
+    Directories known to exist on the upload host, so that uploads into them
+    skip the stat/mkdir round trips
+    """
+
+    def __init__(self, ttl=SFTP_DIR_CACHE_TTL):
+        self.ttl = ttl
+        self.known: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, directory: str):
+        with self._lock:
+            expires = self.known.get(directory)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.known[directory]
+                return False
+            return True
+
+    def add(self, directory: str):
+        with self._lock:
+            self.known[directory] = time.monotonic() + self.ttl
+
+    def invalidate(self, directory: str):
+        """Forgets `directory` and everything below it"""
+        with self._lock:
+            for known in list(self.known):
+                if known == directory or known.startswith(directory + "/"):
+                    del self.known[known]
+
+
+directories = DirectoryCache()
+
+
+def makedirs(sftp: paramiko.SFTPClient, directory: str, known: DirectoryCache = directories):
+    """
+    Creates `directory` on the upload host including missing parents,
+    unless it is `known` to exist. Raises on real errors, e.g. missing permissions.
+    """
+    if not directory or directory == "/" or directory in known:
+        return
     try:
-        with urllib.request.urlopen(url) as df:
-            print("  uploading {} to {}".format(url, target))
+        attr = sftp.stat(directory)
+    except FileNotFoundError:
+        makedirs(sftp, posixpath.dirname(directory), known)
+        try:
+            sftp.mkdir(directory)
+            attr = None
+        except IOError as e:
+            # fine if a parallel upload created it in the meantime, otherwise raise the real error
             try:
-                sftp.mkdir(path.dirname(target))
-            except:
-                pass
-            with sftp.open(target, "w", 32768) as fh:
-                while True:
-                    chunk = df.read(32768)
-                    if not chunk:
-                        break
-                    fh.write(chunk)
-    except paramiko.SSHException as e:
-        raise Exception(f"could not upload WebVTT because of SSH problem {e}") from e
-    except IOError as e:
-        raise Exception(f"could not upload WebVTT because of {e}") from e
+                attr = sftp.stat(directory)
+            except FileNotFoundError:
+                raise e
+    if attr is not None and not stat.S_ISDIR(attr.st_mode or 0):
+        raise NotADirectoryError(f"{directory} on the upload host is not a directory")
+    known.add(directory)
+
+
+def open_file(
+    sftp: paramiko.SFTPClient,
+    target: str,
+    mode: str,
+    bufsize: int = -1,
+    known: DirectoryCache = directories,
+):
+    """Opens `target` on the upload host, creating its directory as needed"""
+    directory = posixpath.dirname(target)
+    makedirs(sftp, directory, known)
+    try:
+        return sftp.open(target, mode, bufsize)
+    except FileNotFoundError:
+        # the directory was removed behind our back
+        known.invalidate(directory)
+        makedirs(sftp, directory, known)
+        return sftp.open(target, mode, bufsize)
+
+
+class Target:
+    """An upload host, with its own connection pool, circuit breaker and directory cache"""
+
+    def __init__(self, host: str, username: str, port: int, primary=False):
+        self.host = host
+        self.name = host if port == 22 else f"{host}:{port}"
+        self.primary = primary
+        if primary:
+            self.pool, self.breaker, self.directories = pool, breaker, directories
+        else:
+            self.pool = SFTPPool(host, username, port=port, name=f"sftp:{self.name}")
+            self.breaker = resilience.CircuitBreaker(f"cdn {self.name}")
+            self.directories = DirectoryCache()
+
+    def key(self, path: str) -> str:
+        """Name of a file of this host in the digest index and in logs"""
+        return path if self.primary else f"{self.name}:{path}"
+
+
+def parse_target(spec: str) -> Target:
+    """[user@]host[:port], user and port default to those of the upload host"""
+    username, _, host = spec.rpartition("@")
+    if host.startswith("["):
+        # IPv6 address, e.g. [2001:db8::1]:2222
+        host, _, port = host[1:].partition("]")
+        port = port.removeprefix(":")
+    else:
+        host, _, port = host.partition(":")
+    return Target(host, username or SFTP_UPLOAD_USER, int(port or SFTP_UPLOAD_PORT))
+
+
+# the upload host, which also stages resumable uploads and is scanned,
+# and the mirrors every published file is replicated to
+primary = Target(SFTP_UPLOAD_HOST, SFTP_UPLOAD_USER, SFTP_UPLOAD_PORT, primary=True)
+mirrors = [parse_target(spec.strip()) for spec in SFTP_UPLOAD_MIRRORS.split(",") if spec.strip()]
+targets = [primary, *mirrors]
+quorum = min(len(targets), SFTP_QUORUM or len(targets) // 2 + 1)
+
+# Waiting for a free connection blocks a thread for up to SFTP_POOL_TIMEOUT. This must not happen
+# on the default executor: there, uploads holding connections do their I/O, and with all its
+# threads waiting for a connection, none of them would ever be released again. Sized for every
+# connection of all pools being in use, with as many borrowers waiting for them.
+borrow_executor = ThreadPoolExecutor(
+    max_workers=2 * sum(target.pool.size for target in targets), thread_name_prefix="sftp-borrow"
+)
+
+
+class DigestIndex:
+    """
+    Maps target paths on the upload host to the SHA-256 and size of the file last written there.
+    Also keeps the catch-ups (see catch_up) which are not done yet, so they survive a restart.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS digests "
+                "(path TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL)"
+            )
+            # owner is the pid of the process catching up
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS catch_ups (target TEXT NOT NULL, path TEXT NOT NULL, "
+                "sources TEXT NOT NULL, owner INTEGER, PRIMARY KEY (target, path))"
+            )
+        return self._db
+
+    def get(self, target: str) -> tuple[str, int] | None:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT sha256, size FROM digests WHERE path = ?", (target,)
+            ).fetchone()
+
+    def set(self, target: str, sha256: str, size: int):
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO digests (path, sha256, size) VALUES (?, ?, ?)",
+                (target, sha256, size),
+            )
+
+    def add_catch_up(self, target: str, path: str, sources: list[str]):
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO catch_ups (target, path, sources, owner) "
+                "VALUES (?, ?, ?, ?)",
+                (target, path, json.dumps(sources), os.getpid()),
+            )
+
+    def remove_catch_up(self, target: str, path: str):
+        with self._lock:
+            self._connect().execute(
+                "DELETE FROM catch_ups WHERE target = ? AND path = ?", (target, path)
+            )
+
+    def claim_catch_ups(self, alive: Callable[[int], bool]) -> list[tuple[str, str, list[str]]]:
+        """Takes over the catch-ups of processes which are not `alive` anymore"""
+        claimed = []
+        with self._lock:
+            db = self._connect()
+            rows = db.execute("SELECT target, path, sources, owner FROM catch_ups").fetchall()
+            for target, path, sources, owner in rows:
+                if owner == os.getpid() or alive(owner):
+                    continue
+                if db.execute(
+                    "UPDATE catch_ups SET owner = ? WHERE target = ? AND path = ? AND owner IS ?",
+                    (os.getpid(), target, path, owner),
+                ).rowcount:
+                    claimed.append((target, path, json.loads(sources)))
+        return claimed
+
+
+index = DigestIndex(CDN_INDEX)
+
+
+def remote_hash(sftp: paramiko.SFTPClient, target: str):
+    sha256 = hashlib.sha256()
+    with sftp.open(target, "r", 32768) as fh:
+        fh.prefetch()
+        while chunk := fh.read(32768):
+            sha256.update(chunk)
+    return sha256
+
+
+def remote_digest(sftp: paramiko.SFTPClient, target: str, size: int) -> tuple[str, int] | None:
+    """Hashes an existing remote file, if it could be identical to a new one of `size` bytes"""
+    try:
+        if sftp.stat(target).st_size != size:
+            return None
+        return remote_hash(sftp, target).hexdigest(), size
+    except IOError:
+        return None
+
+
+class RemoteFile:
+    """
+    Streams a file to the upload host from async code: chunks pass through a bounded queue
+    to a writer running in a worker thread, so memory per upload stays constant while
+    receiving and writing overlap. Size and SHA-256 are computed on the fly. Data is written
+    to a temporary name and only moved to its target on commit, so nobody sees partial files.
+
+    Files up to `defer` bytes are held in memory until commit, so unchanged small files
+    (e.g. re-published subtitles) never touch the upload host.
+
+    Resumable uploads pass the `tmp` file staged by earlier requests, together with its `size`
+    (and digest state, if known), new data is then appended to it.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        buffer: int = SFTP_UPLOAD_BUFFER,
+        tmp: str | None = None,
+        size: int = 0,
+        sha256=None,
+        defer: int = SFTP_DEFER_BYTES,
+        target: Target = primary,
+    ):
+        self.target = target
+        self.directory = directory
+        self.tmp = tmp or f"{directory}/.upload-{uuid4().hex}"
+        self.size = size
+        self.sha256 = sha256 or hashlib.sha256()
+        self.defer = defer
+        self._staged = tmp is not None
+        self._queue: asyncio.Queue[bytes | None] = asyncio.Queue(maxsize=buffer)
+        self._deferred: list[bytes] = []
+        self._conn = None
+        self._sftp = None
+        self._fh = None
+        self._writer = None
+        self._start = time.perf_counter()
+
+    async def open(self):
+        # fail fast while the upload host is known to be down
+        self.target.breaker.check()
+        self._start = time.perf_counter()
+        return self
+
+    async def _borrow(self):
+        async def borrow():
+            conn = self.target.pool.sftp()
+            try:
+                return conn, await enter(conn)
+            except TRANSIENT_ERRORS as e:
+                raise resilience.Retryable(f"could not connect to upload host: {e}") from e
+
+        # (re)connecting is retried with backoff, the breaker fails fast while the host is down
+        with timing.span("sftp.connect"):
+            self._conn, self._sftp = await resilience.call(self.target.breaker, borrow)
+
+    async def _client(self) -> paramiko.SFTPClient:
+        if self._sftp is None:
+            await self._borrow()
+        assert self._sftp is not None
+        return self._sftp
+
+    async def _open_tmp(self):
+        sftp = await self._client()
+        try:
+            mode = "a" if self._staged else "w"
+            with timing.span("sftp.open"):
+                self._fh = await asyncio.to_thread(
+                    open_file, sftp, self.tmp, mode, 32768, self.target.directories
+                )
+            self._fh.set_pipelined(True)
+        except BaseException as e:
+            await self._release(e)
+            raise
+        self._writer = asyncio.create_task(self._drain())
+        deferred, self._deferred = self._deferred, []
+        for chunk in deferred:
+            await self._put(chunk)
+
+    async def _drain(self):
+        fh = self._fh
+        assert fh is not None
+        try:
+            while (chunk := await self._queue.get()) is not None:
+                await asyncio.to_thread(fh.write, chunk)
+        except (paramiko.SSHException, EOFError):
+            self.target.breaker.failure()
+            raise
+
+    async def _put(self, item: bytes | None):
+        writer = self._writer
+        assert writer is not None
+        if writer.done():
+            # writer failed, surface its exception
+            await writer
+        put = asyncio.ensure_future(self._queue.put(item))
+        await asyncio.wait((put, writer), return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            # writer failed while we waited for space in the queue
+            put.cancel()
+            await writer
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        self.sha256.update(chunk)
+        if self._writer is None:
+            if self.size <= self.defer:
+                self._deferred.append(chunk)
+                return
+            await self._open_tmp()
+        await self._put(chunk)
+
+    async def _in_place(self, target: str, digest: str):
+        # e.g. files uploaded before the index existed, or whose registration failed
+        if self.size > CDN_VERIFY_MAX:
+            return False
+        known = await asyncio.to_thread(remote_digest, await self._client(), target, self.size)
+        return known is not None and tuple(known) == (digest, self.size)
+
+    async def commit(self, target: str, force: bool = False) -> bool:
+        """
+        Moves the file to `target`. Returns False if an identical file was published there
+        before (see remember), in which case nothing is written (unless `force` is set).
+        """
+        digest = self.sha256.hexdigest()
+        try:
+            known = None if force else index.get(self.target.key(target))
+            unchanged = known is not None and tuple(known) == (digest, self.size)
+            if unchanged or (not force and known is None and await self._in_place(target, digest)):
+                logging.info(f"{self.target.key(target)} is unchanged")
+                if self._staged and self._conn is None:
+                    # still need to clean up the staged data
+                    await self._borrow()
+                await self.abort()
+                # not in the index means not known to be registered, so only the upload is skipped
+                return not unchanged
+            logging.info(f"uploading {self.size} bytes to {self.target.key(target)}")
+            if self._writer is None and (self._deferred or not self._staged):
+                await self._open_tmp()
+            await self._close_tmp()
+            sftp = await self._client()
+            await asyncio.to_thread(sftp.posix_rename, self.tmp, target)
+        except BaseException as e:
+            # data staged by resumable uploads is kept, so the commit can be retried
+            await self.abort(e, remove=not self._staged)
+            if isinstance(e, (paramiko.SSHException, EOFError)):
+                self.target.breaker.failure()
+            if isinstance(e, paramiko.SSHException):
+                raise Exception(f"could not upload file because of SSH problem {e}") from e
+            if isinstance(e, IOError):
+                raise Exception(f"could not upload file because of {e}") from e
+            raise
+        await self._release()
+        observe_upload(self.size, time.perf_counter() - self._start)
+        return True
+
+    async def _close_tmp(self):
+        if self._writer is not None:
+            await self._put(None)
+            await self._writer
+            assert self._fh is not None
+            await asyncio.to_thread(self._fh.close)
+            self._writer = None
+            self._fh = None
+
+    async def flush(self):
+        """
+        Writes all data received so far to the temporary file and releases the connection,
+        without moving the file to its target. Used by resumable uploads.
+        """
+        try:
+            if self._writer is None and self._deferred:
+                await self._open_tmp()
+            await self._close_tmp()
+        except BaseException as e:
+            await self.abort(e, remove=False)
+            raise
+        await self._release()
+
+    async def abort(self, exc: BaseException | None = None, remove=True):
+        self._deferred = []
+        if self._conn is None:
+            return
+        if self._writer is not None:
+            # let the writer thread finish its current chunk, paramiko files are not thread-safe
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
+            await asyncio.gather(self._writer, return_exceptions=True)
+        try:
+            if self._fh is not None:
+                await asyncio.to_thread(self._fh.close)
+            if remove and self._sftp is not None and (self._fh is not None or self._staged):
+                await asyncio.to_thread(self._sftp.remove, self.tmp)
+        except Exception:
+            pass
+        await self._release(exc)
+
+    async def _release(self, exc: BaseException | None = None):
+        conn, self._conn = self._conn, None
+        self._sftp = None
+        if conn is None:
+            return
+        try:
+            if exc is None:
+                await asyncio.to_thread(conn.__exit__, None, None, None)
+            else:
+                await asyncio.to_thread(conn.__exit__, type(exc), exc, exc.__traceback__)
+        except BaseException:
+            if exc is None:
+                raise
+
+
+# catch-up attempts for a target which missed a file, each with RETRY_ATTEMPTS retries,
+# separated by the time its circuit breaker stays open
+CATCH_UP_ROUNDS = 10
+# background commits and catch-ups, referenced until they are done
+replications: set[asyncio.Task] = set()
+
+
+def _background(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    replications.add(task)
+    task.add_done_callback(replications.discard)
+    return task
+
+
+def copy_file(source: Target, dest: Target, path: str) -> tuple[str, int]:
+    """
+    Copies `path` from one upload host to another via a temporary name,
+    returns SHA-256 and size of the copied data
+    """
+    tmp = f"{posixpath.dirname(path)}/.upload-{uuid4().hex}"
+    sha256 = hashlib.sha256()
+    size = 0
+    with source.pool.sftp() as src, dest.pool.sftp() as dst:
+        with src.open(path, "r", 32768) as fin:
+            fin.prefetch()
+            try:
+                with open_file(dst, tmp, "w", 32768, dest.directories) as fout:
+                    fout.set_pipelined(True)
+                    while chunk := fin.read(32768):
+                        sha256.update(chunk)
+                        size += len(chunk)
+                        fout.write(chunk)
+                dst.posix_rename(tmp, path)
+            except BaseException:
+                try:
+                    dst.remove(tmp)
+                except Exception:
+                    pass
+                raise
+    return sha256.hexdigest(), size
+
+
+async def replicate(dest: Target, path: str, sources: list[Target]) -> tuple[str, int]:
+    """
+    Copies `path` to `dest` from the first of `sources` which has it, with retries.
+    Returns SHA-256 and size of the copy.
+    """
+
+    async def attempt():
+        errors = []
+        for source in sources:
+            try:
+                return await in_borrow_thread(copy_file, source, dest, path)
+            except (*TRANSIENT_ERRORS, IOError) as e:
+                errors.append(f"{source.name}: {e}")
+        raise resilience.Retryable(f"could not copy {path} to {dest.name}: {', '.join(errors)}")
+
+    return await resilience.call(dest.breaker, attempt)
+
+
+async def catch_up(dest: Target, path: str, sources: list[Target]):
+    """
+    Replicates a file to a target which missed it, for as long as CATCH_UP_ROUNDS allow.
+    Catch-ups interrupted by a restart are resumed, see start.
+    """
+    index.add_catch_up(dest.name, path, [source.name for source in sources])
+    for _ in range(CATCH_UP_ROUNDS):
+        try:
+            digest, size = await replicate(dest, path, sources)
+        except resilience.UpstreamUnavailable as e:
+            await asyncio.sleep(e.retry_after or dest.breaker.reset_timeout)
+            continue
+        # only files registered in voctoweb are in the digest index (see ReplicatedFile.remember),
+        # so is the copy of one
+        if any(index.get(source.key(path)) == (digest, size) for source in sources):
+            index.set(dest.key(path), digest, size)
+        index.remove_catch_up(dest.name, path)
+        metrics.cdn_replications.labels(dest.name, "caught_up").inc()
+        logging.info(f"caught up {dest.key(path)}")
+        return
+    index.remove_catch_up(dest.name, path)
+    metrics.cdn_replications.labels(dest.name, "failed").inc()
+    logging.error(f"giving up to replicate {dest.key(path)}, it is missing on {dest.name}")
+
+
+def remember(path: str, names: list[str], sha256: str, size: int):
+    """Records a published file in the digest index of the upload hosts `names`"""
+    for target in targets:
+        if target.name in names:
+            index.set(target.key(path), sha256, size)
+
+
+class ReplicatedFile:
+    """
+    Streams a file to all upload hosts in parallel, via one RemoteFile per host. Hosts failing
+    on the way are dropped, as long as a `quorum` of them remains. Commit returns as soon as
+    `quorum` hosts stored the file, the others finish in the background, hosts which failed are
+    caught up by copying the file from one that has it. `acknowledged` lists the hosts which
+    stored the file when commit returned.
+
+    Resumable uploads stage their data on the primary host only, the mirrors copy it from there
+    once it is committed.
+    """
+
+    def __init__(self, directory: str, tmp: str | None = None, size: int = 0, sha256=None, **kwargs):
+        self.size = size
+        self.sha256 = sha256 or hashlib.sha256()
+        self._staged = tmp is not None
+        self.files = {
+            primary.name: RemoteFile(
+                directory, tmp=tmp, size=size, sha256=self.sha256.copy(), target=primary, **kwargs
+            )
+        }
+        # mirrors the staged data is copied to after commit
+        self.copies: list[Target] = list(mirrors) if self._staged else []
+        if not self._staged:
+            for target in mirrors:
+                self.files[target.name] = RemoteFile(directory, target=target, **kwargs)
+        self.failed: dict[str, BaseException] = {}
+        self.acknowledged: list[str] = []
+        # hosts which stored the file in the background, after commit returned
+        self.late: list[str] = []
+        self.remembered = False
+
+    def _drop(self, name: str, e: BaseException):
+        logging.warning(f"dropping upload target {name}: {e!r}")
+        self.failed[name] = e
+        del self.files[name]
+
+    def _check_quorum(self, acknowledged: int = 0):
+        available = acknowledged + len(self.files) + len(self.copies)
+        if available >= quorum:
+            return
+        if len(self.failed) == 1 and len(targets) == 1:
+            # a single upload host, keep its error as it is
+            raise next(iter(self.failed.values()))
+        errors = "; ".join(f"{name}: {e}" for name, e in self.failed.items())
+        retry_after = [
+            e.retry_after
+            for e in self.failed.values()
+            if isinstance(e, resilience.UpstreamUnavailable) and e.retry_after
+        ]
+        raise resilience.UpstreamUnavailable(
+            "cdn",
+            f"only {available} of the {quorum} required upload hosts "
+            f"available ({errors})",
+            retry_after=min(retry_after, default=None),
+        )
+
+    async def open(self):
+        for name, file in list(self.files.items()):
+            try:
+                await file.open()
+            except resilience.UpstreamUnavailable as e:
+                self._drop(name, e)
+        for target in list(self.copies):
+            try:
+                target.breaker.check()
+            except resilience.UpstreamUnavailable as e:
+                self.failed[target.name] = e
+                self.copies.remove(target)
+        self._check_quorum()
+        return self
+
+    async def write(self, chunk: bytes):
+        with timing.span("cdn.write"):
+            await self._write(chunk)
+
+    async def _write(self, chunk: bytes):
+        self.size += len(chunk)
+        self.sha256.update(chunk)
+        names = list(self.files)
+        results = await asyncio.gather(
+            *(self.files[name].write(chunk) for name in names), return_exceptions=True
+        )
+        for name, result in zip(names, results):
+            if isinstance(result, BaseException):
+                await self.files[name].abort(result)
+                self._drop(name, result)
+        if len(self.files) < len(names):
+            try:
+                self._check_quorum()
+            except BaseException as e:
+                await self.abort(e)
+                raise
+
+    async def commit(self, target: str, force: bool = False) -> bool:
+        """
+        Moves the file to `target` on (at least) a quorum of upload hosts. Returns False if an
+        identical file is already there on all of them that acknowledged.
+        """
+        with timing.span("cdn.commit"):
+            return await self._commit(target, force)
+
+    async def _commit(self, target: str, force: bool) -> bool:
+        acknowledged = []
+        changed = False
+        if self._staged:
+            # data staged by resumable uploads is kept on failure, so the commit can be retried
+            changed = await self.files[primary.name].commit(target, force=force)
+            acknowledged.append(primary.name)
+            tasks = {
+                asyncio.create_task(self._copy(mirror, target, force)): mirror.name
+                for mirror in self.copies
+            }
+            self.copies = []
+        else:
+            tasks = {
+                asyncio.create_task(file.commit(target, force=force)): name
+                for name, file in self.files.items()
+            }
+
+        pending = set(tasks)
+        try:
+            while pending and len(acknowledged) < quorum:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = tasks[task]
+                    error = task.exception()
+                    if error is not None:
+                        self.failed[name] = error
+                    else:
+                        acknowledged.append(name)
+                        changed = changed or task.result()
+                self.files = {name: file for name, file in self.files.items() if name not in self.failed}
+                if len(acknowledged) + len(pending) < quorum:
+                    break
+            if len(acknowledged) < quorum:
+                self.files = {}
+                self._check_quorum(len(acknowledged))
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            raise
+
+        sources = [t for t in targets if t.name in acknowledged]
+        by_name = {t.name: t for t in targets}
+        for task in pending:
+            _background(self._laggard(task, by_name[tasks[task]], target, sources))
+        for name in self.failed:
+            _background(catch_up(by_name[name], target, sources))
+        self.acknowledged = [t.name for t in targets if t.name in acknowledged]
+        return changed
+
+    def remember(self, target: str):
+        """
+        Records the committed file in the digest index of the hosts which acknowledged it,
+        so publishing it again is skipped. Only call this once it is registered in voctoweb.
+        """
+        self.remembered = True
+        remember(target, self.acknowledged + self.late, self.sha256.hexdigest(), self.size)
+
+    async def _copy(self, mirror: Target, target: str, force: bool) -> bool:
+        known = index.get(mirror.key(target))
+        if not force and known is not None and tuple(known) == (self.sha256.hexdigest(), self.size):
+            return False
+        await replicate(mirror, target, [primary])
+        return True
+
+    async def _laggard(self, task: asyncio.Task, target: Target, path: str, sources: list[Target]):
+        # caught up after a restart which interrupted the commit
+        index.add_catch_up(target.name, path, [source.name for source in sources])
+        try:
+            await task
+        except Exception as e:
+            logging.warning(f"could not store {target.key(path)}, catching up: {e!r}")
+            await catch_up(target, path, sources)
+        else:
+            index.remove_catch_up(target.name, path)
+            self.late.append(target.name)
+            if self.remembered:
+                remember(path, [target.name], self.sha256.hexdigest(), self.size)
+            metrics.cdn_replications.labels(target.name, "late").inc()
+
+    async def abort(self, exc: BaseException | None = None, remove=True):
+        await asyncio.gather(
+            *(file.abort(exc, remove=remove) for file in self.files.values()),
+            return_exceptions=True,
+        )
+
+
+async def start():
+    """Resumes the catch-ups of processes which stopped before they were done"""
+    # imported here, jobs imports this module
+    from publishing_gw import jobs
+
+    by_name = {target.name: target for target in targets}
+    for name, path, sources in index.claim_catch_ups(jobs.alive):
+        if name not in by_name:
+            logging.warning(f"dropping catch-up of {path}, {name} is no upload host anymore")
+            index.remove_catch_up(name, path)
+            continue
+        logging.info(f"resuming catch-up of {by_name[name].key(path)}")
+        _background(catch_up(by_name[name], path, [by_name[s] for s in sources if s in by_name]))
+
+
+async def close():
+    for task in list(replications):
+        task.cancel()
+    await asyncio.gather(*replications, return_exceptions=True)
+    for target in targets:
+        target.pool.close()
@@ -0,0 +1,206 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, Optional
+
+from publishing_gw import voctoweb
+from publishing_gw.model import EventSummary
+
+# seconds an event index is used before it is refreshed from voctoweb
+EVENT_INDEX_TTL = float(os.environ.get("EVENT_INDEX_TTL", 300))
+# max. number of conferences kept indexed in memory
+EVENT_INDEX_SIZE = int(os.environ.get("EVENT_INDEX_SIZE", 32))
+# max. number of events fetched from voctoweb per GraphQL query when paginating
+EVENT_PAGE_SIZE = int(os.environ.get("EVENT_PAGE_SIZE", 500))
+
+
+class ConferenceNotFound(Exception):
+    pass
+
+
+indexes: OrderedDict[str, "EventIndex"] = OrderedDict()
+
+
+async def fetch_conference(conference: str) -> Optional[dict]:
+    """
+    Returns id, title and the (non-null) events of a conference as plain dict,
+    None if voctoweb does not know the conference.
+    Raises ValueError on an invalid response.
+    """
+    data = await voctoweb.graphql(
+        """query Conference($slug: ID!){
+    	 conference(id: $slug) {
+    		id
+    		title
+    		events:lectures{nodes{guid,slug,title,date,video:videoPreferred{filename}}}
+    	}
+    }""",
+        slug=conference,
+    )
+    if not data:
+        raise ValueError("Invalid response from voctoweb")
+    result = data["conference"]
+    if result is None:
+        return None
+
+    # copy instead of modifying the result in place, as it is shared via the voctoweb cache
+    result = {
+        **result,
+        "events": [
+            event
+            for event in (result.get("events") or {}).get("nodes", [])
+            if event is not None  # api returns null in some cases at the moment
+        ],
+    }
+    # keep an existing index up to date with whatever we got anyway
+    idx = indexes.get(conference)
+    if idx is not None:
+        idx.update(result["events"])
+    return result
+
+
+async def fetch_page(
+    conference: str, after: Optional[str] = None, limit: int = EVENT_PAGE_SIZE
+) -> Optional[dict]:
+    """
+    Like fetch_conference, but only up to `limit` events following the cursor `after`,
+    with the cursor of the next page as `next` (None on the last page).
+    """
+    data = await voctoweb.graphql(
+        """query ConferencePage($slug: ID!, $first: Int!, $after: String){
+    	 conference(id: $slug) {
+    		id
+    		title
+    		events:lectures(first: $first, after: $after){
+    			pageInfo{hasNextPage,endCursor}
+    			nodes{guid,slug,title,date,video:videoPreferred{filename}}
+    		}
+    	}
+    }""",
+        slug=conference,
+        first=limit,
+        after=after,
+    )
+    if not data:
+        raise ValueError("Invalid response from voctoweb")
+    result = data["conference"]
+    if result is None:
+        return None
+
+    events = result.get("events") or {}
+    page_info = events.get("pageInfo") or {}
+    return {
+        "id": result["id"],
+        "title": result["title"],
+        "events": [event for event in events.get("nodes") or [] if event is not None],
+        "next": page_info.get("endCursor") if page_info.get("hasNextPage") else None,
+    }
+
+
+async def pages(
+    conference: str, after: Optional[str] = None, limit: Optional[int] = None
+) -> AsyncGenerator[dict, None]:
+    """
+    Yields the pages (see fetch_page) of the events of a conference following the cursor
+    `after`, up to `limit` events in total, fetching the next page only once the current
+    one was consumed. Raises ConferenceNotFound or ValueError.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = EVENT_PAGE_SIZE if remaining is None else min(remaining, EVENT_PAGE_SIZE)
+        page = await fetch_page(conference, after, size)
+        if page is None:
+            raise ConferenceNotFound(conference)
+        yield page
+        if page["next"] is None:
+            return
+        after = page["next"]
+        if remaining is not None:
+            remaining -= size
+
+
+def event_names(event: dict) -> set[str]:
+    """
+    All names an event can be referred to by: guid, slug, the
+    `conference-local_id` key and the filename of the preferred video.
+    """
+    names = {event["guid"], event["slug"], voctoweb.key_from_slug(event["slug"])}
+    filename = (event.get("video") or {}).get("filename")
+    if filename:
+        names.add(filename)
+        names.add(voctoweb.key_from_slug(filename, cleanup=True))
+    return names
+
+
+class EventIndex:
+    def __init__(self, conference: str):
+        self.conference = conference
+        self.events: dict[str, tuple[dict, EventSummary]] = {}  # by guid
+        self.names: dict[str, str] = {}  # name -> guid
+        self.updated = 0.0
+        self.lock = asyncio.Lock()
+
+    def stale(self) -> bool:
+        return time.monotonic() - self.updated > EVENT_INDEX_TTL
+
+    def update(self, events: list[dict]):
+        """
+        Brings the index in line with the given list of events, only touching
+        the entries of events which were added, changed or removed.
+        """
+        seen = set()
+        for event in events:
+            guid = event["guid"]
+            seen.add(guid)
+            current = self.events.get(guid)
+            if current is not None and current[0] == event:
+                continue
+            if current is not None:
+                self._remove(guid)
+            self.events[guid] = (event, EventSummary.model_validate(event))
+            for name in event_names(event):
+                # first event wins on (unlikely) ambiguous names
+                self.names.setdefault(name, guid)
+
+        for guid in self.events.keys() - seen:
+            self._remove(guid)
+        self.updated = time.monotonic()
+
+    def _remove(self, guid: str):
+        event, _ = self.events.pop(guid)
+        for name in event_names(event):
+            if self.names.get(name) == guid:
+                del self.names[name]
+
+    def resolve(self, name: str) -> Optional[EventSummary]:
+        guid = self.names.get(name)
+        if guid is None:
+            # any other file of the event, e.g. 37c3-58019-eng-...vtt
+            guid = self.names.get(voctoweb.key_from_slug(name, cleanup=True))
+        if guid is None:
+            return None
+        return self.events[guid][1]
+
+
+async def index(conference: str) -> EventIndex:
+    """
+    Returns the (fresh) event index of a conference, building or refreshing it as needed.
+    Raises ConferenceNotFound or ValueError.
+    """
+    idx = indexes.get(conference)
+    if idx is None:
+        idx = indexes[conference] = EventIndex(conference)
+        while len(indexes) > EVENT_INDEX_SIZE:
+            indexes.popitem(last=False)
+    indexes.move_to_end(conference)
+
+    if idx.stale():
+        async with idx.lock:
+            # another request might have refreshed it while we waited for the lock
+            if idx.stale():
+                if await fetch_conference(conference) is None:
+                    indexes.pop(conference, None)
+                    raise ConferenceNotFound(conference)
+    return idx
+
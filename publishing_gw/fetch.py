@@ -0,0 +1,307 @@
+"""
+Downloads files offered by other services (e.g. transcriptions) for publishing, see
+POST /api/{conference}/events/{guid}/fetch
+
+    async for chunk in download(url, sha256=…):
+        await remote.write(chunk)
+
+Data is passed on chunk by chunk as it arrives. Large files are fetched as several HTTP range
+requests in parallel, which are still passed on in order.
+"""
+
+import asyncio
+import hashlib
+import ipaddress
+import re
+import socket
+import time
+from os import environ
+from typing import AsyncIterator, Optional
+from urllib.parse import urlsplit
+
+import httpcore
+import httpx
+
+# max. size of a fetched file in bytes
+FETCH_MAX_SIZE = int(environ.get("FETCH_MAX_SIZE", 256 * 1024 * 1024))
+# seconds a download may take in total, and seconds to wait for the next data
+FETCH_TIMEOUT = float(environ.get("FETCH_TIMEOUT", 300))
+FETCH_READ_TIMEOUT = float(environ.get("FETCH_READ_TIMEOUT", 30))
+# files are fetched in ranges of FETCH_RANGE_SIZE bytes, FETCH_RANGES of them in parallel,
+# if the source supports range requests; 1 fetches every file with a single request
+FETCH_RANGES = int(environ.get("FETCH_RANGES", 4))
+FETCH_RANGE_SIZE = int(environ.get("FETCH_RANGE_SIZE", 8 * 1024 * 1024))
+# comma separated hosts files may be fetched from, any public host if empty;
+# hosts listed here may also resolve to private, loopback or link-local addresses
+FETCH_ALLOWED_HOSTS = {
+    host.strip().lower() for host in environ.get("FETCH_ALLOWED_HOSTS", "").split(",") if host.strip()
+}
+# allow fetching from any host resolving to private, loopback or link-local addresses
+FETCH_ALLOW_PRIVATE = bool(int(environ.get("FETCH_ALLOW_PRIVATE", 0)))
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+async def _check_request(request: httpx.Request):
+    # every request, including those following redirects, must go to a host which is allowed
+    check_url(str(request.url))
+
+
+class _CheckedBackend(httpcore.AsyncNetworkBackend):
+    """
+    Connects to the addresses a host was checked with (see resolve), so the host can not
+    resolve to an internal address once checked (DNS rebinding). TLS (SNI, certificate) and
+    the Host header still use the name of the host.
+    """
+
+    def __init__(self, backend: httpcore.AsyncNetworkBackend):
+        self.backend = backend
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        error = None
+        for address in await resolve(host):
+            try:
+                return await self.backend.connect_tcp(
+                    address, port, timeout, local_address, socket_options
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                error = e
+        assert error is not None
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise httpcore.ConnectError("fetching via unix sockets is not supported")
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
+
+
+def _transport() -> httpx.AsyncHTTPTransport:
+    transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=16)
+    )
+    # httpx does not take a network backend for its connection pool
+    transport._pool._network_backend = _CheckedBackend(transport._pool._network_backend)
+    return transport
+
+
+# with a transport of its own the client uses no proxies (HTTP_PROXY, …), which would resolve
+# the hosts themselves
+client = httpx.AsyncClient(
+    timeout=httpx.Timeout(FETCH_READ_TIMEOUT, connect=10),
+    transport=_transport(),
+    follow_redirects=True,
+    event_hooks={"request": [_check_request]},
+)
+
+
+class FetchError(Exception):
+    """Download failed, `status_code` is the one to respond with"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def check_url(url: str):
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise FetchError(422, f"not a HTTP(S) URL: {url}")
+    if FETCH_ALLOWED_HOSTS and parts.hostname.lower() not in FETCH_ALLOWED_HOSTS:
+        raise FetchError(403, f"fetching from {parts.hostname} is not allowed")
+
+
+async def resolve(host: str) -> list[str]:
+    """
+    The addresses to connect to for `host`. Rejects hosts resolving to internal addresses (e.g.
+    the metadata service of a cloud provider or services on the gateway's network), unless they
+    are listed in FETCH_ALLOWED_HOSTS.
+    """
+    if FETCH_ALLOW_PRIVATE or host.lower() in FETCH_ALLOWED_HOSTS:
+        return [host]
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise FetchError(502, f"could not resolve {host}: {e}") from e
+    addresses = []
+    for *_, sockaddr in infos:
+        host_address = str(sockaddr[0])
+        # without the scope of IPv6 link-local addresses, e.g. fe80::1%eth0
+        address = ipaddress.ip_address(host_address.split("%", 1)[0])
+        if not address.is_global or address.is_multicast:
+            raise FetchError(403, f"fetching from {host} ({address}) is not allowed")
+        if host_address not in addresses:
+            addresses.append(host_address)
+    return addresses
+
+
+class Download:
+    def __init__(self, url: str, sha256: Optional[str], size: Optional[int], max_size: int):
+        self.url = url
+        self.expected_sha256 = sha256.lower() if sha256 else None
+        self.expected_size = size
+        self.max_size = max_size
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.deadline = time.monotonic() + FETCH_TIMEOUT
+        # validator of the first response, so ranges of a file changing meanwhile are rejected
+        self.validator: Optional[str] = None
+
+    def _check_size(self, size: int):
+        if size > self.max_size:
+            raise FetchError(413, f"{self.url} is larger than {self.max_size} bytes")
+        if self.expected_size is not None and size != self.expected_size:
+            raise FetchError(
+                422, f"{self.url} has {size} bytes, expected {self.expected_size}"
+            )
+
+    def _received(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise FetchError(413, f"{self.url} is larger than {self.max_size} bytes")
+        if time.monotonic() > self.deadline:
+            raise FetchError(504, f"fetching {self.url} took longer than {FETCH_TIMEOUT:.0f}s")
+        self.sha256.update(chunk)
+
+    def _verify(self):
+        if self.expected_size is not None and self.size != self.expected_size:
+            raise FetchError(
+                422, f"{self.url} has {self.size} bytes, expected {self.expected_size}"
+            )
+        if self.expected_sha256 and self.sha256.hexdigest() != self.expected_sha256:
+            raise FetchError(
+                422,
+                f"SHA-256 of {self.url} is {self.sha256.hexdigest()}, "
+                f"expected {self.expected_sha256}",
+            )
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        headers = {}
+        if FETCH_RANGES > 1:
+            # servers supporting ranges answer 206 and tell the total size, others send everything
+            headers["Range"] = f"bytes=0-{FETCH_RANGE_SIZE - 1}"
+        total = None
+        ranges = Ranges(self)
+        try:
+            async with client.stream("GET", self.url, headers=headers) as response:
+                if response.status_code == 206:
+                    match = CONTENT_RANGE.fullmatch(response.headers.get("content-range", ""))
+                    if match is None or int(match[1]) != 0:
+                        raise FetchError(502, f"{self.url} returned an unexpected range")
+                    total = int(match[3])
+                    self._check_size(total)
+                    self.validator = response.headers.get("etag") or response.headers.get(
+                        "last-modified"
+                    )
+                    # without a validator, ranges could mix two versions of a changing file
+                    if self.validator:
+                        ranges.start(int(match[2]) + 1, total)
+                elif response.status_code == 200:
+                    if "content-length" in response.headers:
+                        total = int(response.headers["content-length"])
+                        self._check_size(total)
+                elif response.status_code == 416:
+                    # an empty file has no range to return
+                    total = 0
+                else:
+                    raise FetchError(
+                        502, f"{self.url} responded with status {response.status_code}"
+                    )
+
+                if total != 0:
+                    async for chunk in response.aiter_bytes():
+                        self._received(chunk)
+                        yield chunk
+            async for data in ranges:
+                self._received(data)
+                yield data
+            if total is not None and self.size < total:
+                async for chunk in self._rest():
+                    yield chunk
+        except httpx.TimeoutException as e:
+            raise FetchError(504, f"timeout while fetching {self.url}: {e!r}") from e
+        except httpx.HTTPError as e:
+            raise FetchError(502, f"could not fetch {self.url}: {e!r}") from e
+        finally:
+            await ranges.cancel()
+        if total is not None and self.size != total:
+            raise FetchError(502, f"{self.url} ended after {self.size} of {total} bytes")
+        self._verify()
+
+    async def _rest(self) -> AsyncIterator[bytes]:
+        async with client.stream(
+            "GET", self.url, headers={"Range": f"bytes={self.size}-"}
+        ) as response:
+            if response.status_code != 206:
+                raise FetchError(502, f"{self.url} does not resume at byte {self.size}")
+            async for chunk in response.aiter_bytes():
+                self._received(chunk)
+                yield chunk
+
+
+class Ranges:
+    """
+    Fetches the ranges of a file after the first one, at most FETCH_RANGES - 1 at a time besides
+    the first (streaming) request, and returns them in order. Memory is bounded by the ranges
+    in flight.
+    """
+
+    def __init__(self, download: Download):
+        self.download = download
+        self.window: list[asyncio.Task] = []
+        self.starts = iter(())
+        self.total = 0
+
+    def start(self, offset: int, total: int):
+        self.starts = iter(range(offset, total, FETCH_RANGE_SIZE))
+        self.total = total
+        for _ in range(FETCH_RANGES - 1):
+            self._schedule()
+
+    def _schedule(self):
+        start = next(self.starts, None)
+        if start is not None:
+            end = min(start + FETCH_RANGE_SIZE, self.total) - 1
+            self.window.append(asyncio.create_task(self._fetch(start, end)))
+
+    async def _fetch(self, start: int, end: int) -> bytes:
+        url = self.download.url
+        headers = {"Range": f"bytes={start}-{end}", "If-Range": self.download.validator}
+        async with client.stream("GET", url, headers=headers) as response:
+            if response.status_code != 206:
+                raise FetchError(502, f"{url} changed while it was fetched")
+            data = await response.aread()
+        if len(data) != end - start + 1:
+            raise FetchError(502, f"{url} returned {len(data)} bytes for range {start}-{end}")
+        return data
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        while self.window:
+            data = await self.window.pop(0)
+            self._schedule()
+            yield data
+
+    async def cancel(self):
+        for task in self.window:
+            task.cancel()
+        await asyncio.gather(*self.window, return_exceptions=True)
+        self.window = []
+
+
+def download(
+    url: str,
+    sha256: Optional[str] = None,
+    size: Optional[int] = None,
+    max_size: int = FETCH_MAX_SIZE,
+) -> AsyncIterator[bytes]:
+    """
+    Yields the content of `url`, raises FetchError if it can not be fetched, exceeds `max_size`
+    or FETCH_TIMEOUT, or does not match the expected `size` and `sha256`
+    (checked before the iteration ends, so nothing should be committed before)
+    """
+    check_url(url)
+    return aiter(Download(url, sha256, size, max_size))
+
+
+async def close():
+    await client.aclose()
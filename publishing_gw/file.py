@@ -1,42 +1,36 @@
 from dataclasses import dataclass
-from typing import Optional, Any
+from typing import Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class FileEntry:
     name: str  # e.g. 'camp2023-57136-eng-Lightning_Talks_Session_1_opus.vtt'
     path: str
     size: int
-    conference: Optional[str]
-    event_local_id: Optional[str]
-    language: Optional[str]
-    raw: Optional[Any]
+    conference: Optional[str] = None
+    event_local_id: Optional[str] = None
+    language: Optional[str] = None
 
     @staticmethod
-    def from_dict(d):
-        parts = d["name"].split("-")
-        return FileEntry(
-            name=d["name"],
-            path=d["path"],
-            size=d["size"],
-            conference=parts[0],
-            event_local_id=parts[1],
-            language=parts[2],
-            raw=d,
-        )
-
-    def __post_init__(self):
+    def parse(name: str, path: str, size: int):
         """
         Extracts conference acronym, local_id, and language from the filename.
         Assumes filename format like 'camp2023-57136-eng-...'
         """
-        parts = self.name.split("-")
-        if len(parts) >= 3:
-            self.conference = parts[0]
-            self.event_local_id = parts[1]
-            self.language = parts[2]
-
+        parts = name.split("-", 3)
+        if len(parts) < 3:
+            return FileEntry(name, path, size)
         # TODO: validate language code
+        return FileEntry(name, path, size, parts[0], parts[1], parts[2])
+
+    @staticmethod
+    def from_dict(d):
+        return FileEntry.parse(d["name"], d["path"], d["size"])
+
+    @staticmethod
+    def from_attr(directory: str, attr):
+        """From a paramiko.SFTPAttributes of a directory listing"""
+        return FileEntry.parse(attr.filename, f"{directory}/{attr.filename}", attr.st_size or 0)
 
     def key(self):
         return f"{self.conference}-{self.event_local_id}"
@@ -0,0 +1,427 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path, environ as env
+from typing import Optional
+from uuid import uuid4
+
+from fastapi import HTTPException
+
+from publishing_gw import cdn, publish, resilience, timing, webvtt
+from publishing_gw.model import FileUpsertBody, Job, JobQueue
+
+# directory for the job database and the payloads of pending jobs
+JOBS_DIR = env.get("JOBS_DIR", "jobs")
+# number of jobs published in parallel
+JOBS_CONCURRENCY = int(env.get("JOBS_CONCURRENCY", 2))
+# publish every upload in the background, as with ?async=true (unless ?async=false is given)
+JOBS_WRITE_BEHIND = bool(int(env.get("JOBS_WRITE_BEHIND", 0)))
+# max. bytes of files waiting to be published, further uploads are rejected with 429 (0: no limit)
+JOBS_SPOOL_LIMIT = int(env.get("JOBS_SPOOL_LIMIT", 1024 * 1024 * 1024))
+# attempts of jobs failing for other reasons than an unavailable upstream or an invalid file,
+# the delay between attempts starts at JOBS_RETRY_DELAY seconds and doubles every time
+JOBS_ATTEMPTS = int(env.get("JOBS_ATTEMPTS", 5))
+JOBS_RETRY_DELAY = float(env.get("JOBS_RETRY_DELAY", 10))
+# seconds after submission after which jobs are no longer retried while an upstream is unavailable
+JOBS_MAX_AGE = float(env.get("JOBS_MAX_AGE", 7 * 24 * 3600))
+# seconds to wait for a lock on the job database held by another worker process
+JOBS_DB_TIMEOUT = float(env.get("JOBS_DB_TIMEOUT", 30))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    conference TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    force INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    state TEXT NOT NULL,
+    stage TEXT,
+    error TEXT,
+    result TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    owner INTEGER,
+    -- jobs publishing the same file (event and language), which run in the order of submission
+    target TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+db: Optional[sqlite3.Connection] = None
+# the database is only used from this thread: waiting for a lock held by another worker process
+# (for up to JOBS_DB_TIMEOUT) must not block the event loop
+db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs-db")
+pending: asyncio.Queue[str | None] = asyncio.Queue()
+workers: list[asyncio.Task] = []
+stopping = False
+# bytes uploaded to the CDN so far, for running jobs only
+uploaded: dict[str, int] = {}
+# bytes of uploads this process is still receiving, they count against JOBS_SPOOL_LIMIT
+receiving = 0
+
+
+def _conn() -> sqlite3.Connection:
+    assert db is not None, "jobs.start() was not called"
+    return db
+
+
+def _fetch(sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+    return _conn().execute(sql, params).fetchall()
+
+
+def _write(sql: str, params: tuple = ()) -> int:
+    return _conn().execute(sql, params).rowcount
+
+
+async def _db(fn, *args):
+    """Calls `fn(*args)` in the database thread"""
+    return await asyncio.get_running_loop().run_in_executor(db_thread, fn, *args)
+
+
+def payload_path(id: str):
+    return path.join(JOBS_DIR, f"{id}.payload")
+
+
+class SpoolFile:
+    """
+    Local counterpart of cdn.RemoteFile: stores an upload in JOBS_DIR until a worker publishes it
+    """
+
+    def __init__(self):
+        self.tmp = path.join(JOBS_DIR, f".upload-{uuid4().hex}")
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self._fh = None
+        self._spooled = 0
+
+    def _check_limit(self):
+        if JOBS_SPOOL_LIMIT and self._spooled + receiving > JOBS_SPOOL_LIMIT:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many files waiting to be published, try again later",
+                headers={"Retry-After": str(round(JOBS_RETRY_DELAY))},
+            )
+
+    async def open(self):
+        # files queued by all worker processes, the limit is checked before anything is written
+        self._spooled = await spooled()
+        self._check_limit()
+        self._fh = await asyncio.to_thread(open, self.tmp, "wb")
+        return self
+
+    async def write(self, chunk: bytes):
+        global receiving
+        self.size += len(chunk)
+        receiving += len(chunk)
+        self.sha256.update(chunk)
+        self._check_limit()
+        assert self._fh is not None, "SpoolFile.open() was not called"
+        await asyncio.to_thread(self._fh.write, chunk)
+
+    def _received(self):
+        global receiving
+        receiving -= self.size
+
+    async def commit(self, target: str):
+        def close_and_move():
+            fh = self._fh
+            assert fh is not None, "SpoolFile.open() was not called"
+            fh.flush()
+            # the job must not be acknowledged before its payload is on disk
+            os.fsync(fh.fileno())
+            fh.close()
+            os.replace(self.tmp, target)
+            # and neither before the rename is
+            fd = os.open(JOBS_DIR, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        try:
+            with timing.span("spool.sync"):
+                await asyncio.to_thread(close_and_move)
+        finally:
+            self._received()
+
+    async def abort(self, exc: BaseException | None = None):
+        if self._fh is None:
+            return
+        self._received()
+        self._fh.close()
+        self._fh = None
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+
+async def _update(id: str, **fields):
+    fields["updated"] = time.time()
+    await _db(
+        _write,
+        f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+        (*fields.values(), id),
+    )
+
+
+def _job(row: sqlite3.Row) -> Job:
+    return Job(
+        id=row["id"],
+        conference=row["conference"],
+        guid=row["guid"],
+        state=row["state"],
+        stage=row["stage"],
+        size=row["size"],
+        sha256=row["sha256"],
+        uploaded=row["size"] if row["state"] == "done" else uploaded.get(row["id"], 0),
+        error=row["error"],
+        result=json.loads(row["result"]) if row["result"] else None,
+        created=row["created"],
+        updated=row["updated"],
+    )
+
+
+async def get(id: str) -> Optional[Job]:
+    rows = await _db(_fetch, "SELECT * FROM jobs WHERE id = ?", (id,))
+    return _job(rows[0]) if rows else None
+
+
+def _spooled() -> int:
+    return _fetch(
+        "SELECT COALESCE(SUM(size), 0) FROM jobs WHERE state IN ('queued', 'running')"
+    )[0][0]
+
+
+async def spooled() -> int:
+    """Bytes of the files waiting to be published"""
+    return await _db(_spooled)
+
+
+def _stats():
+    counts = {
+        state: count
+        for state, count in _fetch(
+            "SELECT state, COUNT(*) FROM jobs WHERE state IN ('queued', 'running', 'failed')"
+            " GROUP BY state"
+        )
+    }
+    oldest = _fetch("SELECT MIN(created) FROM jobs WHERE state = 'queued'")[0][0]
+    return counts, oldest, _spooled()
+
+
+async def queue() -> JobQueue:
+    counts, oldest, spooled = await _db(_stats)
+    return JobQueue(
+        queued=counts.get("queued", 0),
+        running=counts.get("running", 0),
+        failed=counts.get("failed", 0),
+        spooled=spooled + receiving,
+        limit=JOBS_SPOOL_LIMIT or None,
+        oldest=time.time() - oldest if oldest is not None else None,
+        write_behind=JOBS_WRITE_BEHIND,
+    )
+
+
+async def submit(
+    conference: str, guid: str, model: FileUpsertBody, spool: SpoolFile, force=False
+) -> Job:
+    id = str(uuid4())
+    await spool.commit(payload_path(id))
+    now = time.time()
+    await _db(
+        _write,
+        "INSERT INTO jobs (id, conference, guid, meta, force, size, sha256, state, created,"
+        " updated, target) VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+        (id, conference, guid, model.model_dump_json(), force, spool.size,
+         spool.sha256.hexdigest(), now, now, f"{guid}/{model.recording.language}"),
+    )
+    pending.put_nowait(id)
+    job = await get(id)
+    assert job is not None
+    return job
+
+
+async def _retry(id: str, delay: float, error: Exception, attempts: int = 0):
+    """Queues a job again after `delay` seconds"""
+    fields: dict = dict(state="queued", stage=None, error=str(error))
+    if attempts:
+        fields["attempts"] = attempts
+    await _update(id, **fields)
+    asyncio.get_running_loop().call_later(delay, pending.put_nowait, id)
+
+
+async def _next(target: str | None):
+    """Queues the next job publishing the same file, which waited for the finished one"""
+    rows = await _db(
+        _fetch,
+        "SELECT id FROM jobs WHERE target = ? AND state = 'queued' ORDER BY rowid LIMIT 1",
+        (target,),
+    )
+    if rows:
+        pending.put_nowait(rows[0]["id"])
+
+
+async def _run(id: str):
+    # with several worker processes every one of them may have the job queued, the first one wins;
+    # jobs publishing the same file run one after another, in the order they were submitted
+    claimed = await _db(
+        _write,
+        "UPDATE jobs SET state = 'running', stage = 'lookup', owner = ?, updated = ?"
+        " WHERE id = ? AND state = 'queued' AND NOT EXISTS ("
+        "  SELECT 1 FROM jobs AS earlier WHERE earlier.target = jobs.target"
+        "  AND earlier.rowid < jobs.rowid AND earlier.state IN ('queued', 'running'))",
+        (os.getpid(), time.time(), id),
+    )
+    if not claimed:
+        # done, claimed by another worker, or waiting for an earlier job (which queues it again)
+        return
+    [row] = await _db(_fetch, "SELECT * FROM jobs WHERE id = ?", (id,))
+    model = FileUpsertBody.model_validate_json(row["meta"])
+    try:
+        directory, prefix = await publish.lookup_target(row["guid"])
+
+        await _update(id, stage="upload")
+        remote = await cdn.ReplicatedFile(directory).open()
+        # the payload was validated on receipt, this only collects its stats
+        validator = webvtt.Validator(normalize=False)
+        try:
+            with open(payload_path(id), "rb") as fh:
+                while chunk := await asyncio.to_thread(fh.read, 65536):
+                    validator.feed(chunk)
+                    await remote.write(chunk)
+                    uploaded[id] = remote.size
+            validator.close()
+            webvtt.check_duration(validator.stats, await publish.event_length(row["guid"]))
+        except BaseException as e:
+            await remote.abort(e)
+            raise
+        filename = publish.target_filename(prefix, model.recording)
+        if await remote.commit(f"{directory}/{filename}", force=bool(row["force"])):
+            await _update(id, stage="register")
+            recording = await publish.register_file(row["guid"], model.recording, filename)
+            remote.remember(f"{directory}/{filename}")
+            result: dict = {"status": "published", "filename": filename, "recording": recording}
+        else:
+            result = {"status": "unchanged", "filename": filename}
+        result["targets"] = remote.acknowledged
+        await _update(id, state="done", stage=None, error=None, result=json.dumps(result))
+    except asyncio.CancelledError:
+        # interrupted by shutdown, the job is picked up again on start
+        await _update(id, state="queued", stage=None)
+        raise
+    except resilience.UpstreamUnavailable as e:
+        if time.time() - row["created"] < JOBS_MAX_AGE:
+            # do not occupy a worker while voctoweb or the CDN are down, try again later
+            await _retry(id, e.retry_after or resilience.BREAKER_RESET, e)
+            return
+        logging.error(f"publishing job {id} failed, giving up after {JOBS_MAX_AGE:.0f}s: {e}")
+        await _update(id, state="failed", error=str(e))
+    except Exception as e:
+        attempts = row["attempts"] + 1
+        permanent = isinstance(e, webvtt.WebVTTError) or (
+            isinstance(e, HTTPException) and e.status_code < 500
+        )
+        if not permanent and attempts < JOBS_ATTEMPTS:
+            delay = JOBS_RETRY_DELAY * 2 ** (attempts - 1)
+            logging.warning(f"publishing job {id} failed, attempt {attempts} in {delay:.0f}s: {e}")
+            await _retry(id, delay, e, attempts)
+            return
+        logging.exception(f"publishing job {id} failed")
+        await _update(id, state="failed", error=str(e))
+    finally:
+        uploaded.pop(id, None)
+
+    await _next(row["target"])
+
+    try:
+        os.remove(payload_path(id))
+    except OSError:
+        pass
+
+
+async def _worker():
+    while True:
+        id = await pending.get()
+        if stopping or id is None:
+            # the job stays queued in the database and is resumed on the next start
+            return
+        try:
+            await _run(id)
+        except Exception:
+            # e.g. the database being locked by another worker process for too long, the worker
+            # must keep running; the job is tried again (or resumed on the next start)
+            logging.exception(f"publishing job {id} could not be processed")
+            asyncio.get_running_loop().call_later(JOBS_RETRY_DELAY, pending.put_nowait, id)
+
+
+def alive(pid: int | None):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _open() -> list[str]:
+    """Opens the database, returns the jobs to resume"""
+    global db
+    # several worker processes share the database, wait for their writes instead of failing
+    db = sqlite3.connect(
+        path.join(JOBS_DIR, "jobs.sqlite"), isolation_level=None, timeout=JOBS_DB_TIMEOUT
+    )
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(SCHEMA)
+
+    # jobs of a process which died while running them are queued again
+    for row in db.execute("SELECT id, owner FROM jobs WHERE state = 'running'").fetchall():
+        if not alive(row["owner"]):
+            db.execute(
+                "UPDATE jobs SET state = 'queued', stage = NULL WHERE id = ? AND state = 'running'",
+                (row["id"],),
+            )
+    # jobs which were pending (or interrupted) when the gateway was stopped
+    rows = db.execute("SELECT id FROM jobs WHERE state = 'queued' ORDER BY created")
+    return [row["id"] for row in rows]
+
+
+async def start():
+    global pending, stopping
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    resume = await _db(_open)
+    stopping = False
+    pending = asyncio.Queue()
+    for id in resume:
+        pending.put_nowait(id)
+    workers.extend(asyncio.create_task(_worker()) for _ in range(JOBS_CONCURRENCY))
+
+
+async def stop(timeout: float = 0):
+    """
+    Lets running jobs finish for up to `timeout` seconds, jobs still running
+    after that are interrupted and resumed on the next start
+    """
+    global stopping
+    stopping = True
+    # wake up idle workers, busy ones return once their current job is done
+    for _ in workers:
+        pending.put_nowait(None)
+    if timeout > 0 and workers:
+        await asyncio.wait(workers, timeout=timeout)
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
+    await _db(_conn().close)
@@ -0,0 +1,57 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+voctoweb_latency = Histogram(
+    "publishing_gw_voctoweb_request_duration_seconds",
+    "Duration of requests to voctoweb",
+    ["operation"],
+)
+voctoweb_coalesced = Counter(
+    "publishing_gw_voctoweb_coalesced_total",
+    "Lookups which shared the pending voctoweb request of an identical lookup",
+    ["operation"],
+)
+voctoweb_upserts = Counter(
+    "publishing_gw_voctoweb_upserts_total",
+    "Recording upserts sent to voctoweb, by response status code",
+    ["status"],
+)
+voctoweb_upsert_batch_size = Histogram(
+    "publishing_gw_voctoweb_upsert_batch_size",
+    "Recordings per batch of upserts sent to voctoweb",
+    buckets=(1, 2, 5, 10, 20, 50, 100),
+)
+
+sftp_upload_duration = Histogram(
+    "publishing_gw_sftp_upload_duration_seconds",
+    "Duration of file uploads to the upload host",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+sftp_upload_throughput = Histogram(
+    "publishing_gw_sftp_upload_throughput_bytes_per_second",
+    "Throughput of file uploads to the upload host",
+    buckets=(1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8),
+)
+sftp_uploaded_bytes = Counter(
+    "publishing_gw_sftp_uploaded_bytes_total",
+    "Bytes uploaded to the upload host",
+)
+cdn_replications = Counter(
+    "publishing_gw_cdn_replications_total",
+    "Files stored on an upload host after the upload was acknowledged, by result "
+    "(late, caught_up, failed)",
+    ["target", "result"],
+)
+
+pool_connections = Gauge(
+    "publishing_gw_pool_connections",
+    "Connections of the upstream connection pools",
+    ["pool", "state"],
+    # summed over the live worker processes in multi-process mode
+    multiprocess_mode="livesum",
+)
+
+cache_requests = Counter(
+    "publishing_gw_cache_requests_total",
+    "Cache lookups, by result (hit, miss, revalidated)",
+    ["cache", "result"],
+)
@@ -1,4 +1,7 @@
-from pydantic import BaseModel
+import functools
+import typing
+
+from pydantic import BaseModel, create_model
 
 
 class BaseEvent(BaseModel):
@@ -13,7 +16,8 @@ class Video(BaseModel):
 
 
 class EventSummary(BaseEvent):
-    video: Video
+    # null for events without any (published) video yet
+    video: Video | None = None
 
 
 class Conference(BaseModel):
@@ -51,6 +55,114 @@ class Conference(BaseModel):
     }
 
 
+class ConferencePage(Conference):
+    # cursor of the following events (`?after=`), null on the last page or if not paginated
+    next: str | None = None
+
+
+class ResolveBody(BaseModel):
+    # guids, slugs, `conference-local_id` keys or filenames
+    names: list[str]
+
+
+class Resolved(BaseModel):
+    # events by requested name, null if the name is unknown
+    events: dict[str, EventSummary | None]
+
+
+class FileMeta(BaseModel):
+    language: str
+    mime_type: str
+
+
+class FileUpsertBody(BaseModel):
+    recording: FileMeta
+    # other: any
+
+    class Config:
+        arbitrary_types_allowed = True
+
+
+class BatchFile(FileUpsertBody):
+    guid: str
+
+
+class BatchBody(BaseModel):
+    # by name of the form field containing the file
+    files: dict[str, BatchFile]
+
+
+class UploadCreate(FileUpsertBody):
+    filename: str
+    length: int
+
+
+class FetchBody(FileUpsertBody):
+    # HTTP(S) URL the gateway downloads the file from
+    url: str
+    # optional, the download is rejected if it does not match
+    sha256: str | None = None
+    size: int | None = None
+
+
+class Upload(BaseModel):
+    id: str
+    conference: str
+    guid: str
+    filename: str
+    length: int
+    offset: int
+    created: float
+    expires: float
+
+
+class Job(BaseModel):
+    id: str
+    conference: str
+    guid: str
+    state: str  # queued, running, done, failed
+    stage: str | None  # lookup, upload, register
+    size: int
+    sha256: str
+    uploaded: int
+    error: str | None
+    result: dict | None
+    created: float
+    updated: float
+
+
+class JobQueue(BaseModel):
+    # jobs by state, done jobs are not counted
+    queued: int
+    running: int
+    failed: int
+    # bytes of the files waiting to be published, and the limit after which uploads are rejected
+    spooled: int
+    limit: int | None
+    # seconds the oldest queued job is waiting
+    oldest: float | None
+    # whether uploads are published in the background by default
+    write_behind: bool
+
+
+class ScanIssue(BaseModel):
+    # missing_on_cdn, not_registered, size_mismatch, missing_subtitles, event_unavailable
+    kind: str
+    path: str | None = None
+    guid: str | None = None
+    size: int | None = None  # bytes on the upload host
+    expected_size: int | None = None  # MiB according to voctoweb
+    languages: list[str] | None = None  # spoken languages without subtitles
+
+
+class ScanReport(BaseModel):
+    conference: str
+    directories: list[str]
+    files: int
+    recordings: int
+    issues: list[ScanIssue]
+
+
 class Recording(BaseModel):
     filename: str
     mime_type: str
@@ -209,3 +321,54 @@ class DetailedEvent(BaseEvent):
             }
         }
     }
+
+
+def _selection(fields: str) -> dict:
+    """'guid,recordings.filename' -> {'guid': {}, 'recordings': {'filename': {}}}"""
+    selection: dict = {}
+    for field in fields.split(","):
+        node = selection
+        for name in field.strip().split("."):
+            if not name:
+                raise ValueError(f"Invalid field '{field}'")
+            node = node.setdefault(name, {})
+    return selection
+
+
+def _partial(model: type[BaseModel], selection: dict) -> type[BaseModel]:
+    unknown = selection.keys() - model.model_fields.keys()
+    if unknown:
+        raise ValueError(f"Unknown fields of {model.__name__}: {', '.join(sorted(unknown))}")
+    definitions = {}
+    # in the order of the model, not of the selection
+    for name, field in model.model_fields.items():
+        if name not in selection:
+            continue
+        annotation = field.annotation
+        if selection[name]:
+            # `X | None`
+            args = typing.get_args(annotation)
+            optional = type(None) in args
+            if optional:
+                [annotation] = [arg for arg in args if arg is not type(None)]
+            is_list = typing.get_origin(annotation) is list
+            inner = typing.get_args(annotation)[0] if is_list else annotation
+            if not (isinstance(inner, type) and issubclass(inner, BaseModel)):
+                raise ValueError(f"Field {model.__name__}.{name} has no subfields")
+            inner = _partial(inner, selection[name])
+            annotation = list[inner] if is_list else inner
+            if optional:
+                annotation = typing.Optional[annotation]
+        definitions[name] = (annotation, ... if field.is_required() else field.default)
+    return create_model(f"Partial{model.__name__}", **definitions)
+
+
+@functools.lru_cache(maxsize=128)
+def partial(model: type[BaseModel], fields: str) -> type[BaseModel]:
+    """
+    A model with only the comma separated `fields` of `model`, subfields separated by dots
+    (e.g. 'guid,recordings.filename'), which neither validates nor emits any other field.
+    Raises ValueError for unknown fields.
+    """
+    return _partial(model, _selection(fields))
+
@@ -0,0 +1,150 @@
+import asyncio
+import pathlib
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+
+from publishing_gw import voctoweb, webvtt
+from publishing_gw.model import FileMeta
+
+
+def _target(url: str, suffix: str):
+    # e.g. "https://static.media.ccc.de/media/congress/2024/66-59022846-b130-581e-a89f-ecf6e7e43940.thumbnails.vtt"
+    path_base = pathlib.Path(
+        url.replace("https://static.media.ccc.de/media/", "").removesuffix(suffix)
+    )
+    conference_path = path_base.parent
+    return f"/static.media.ccc.de/{conference_path}", path_base.name
+
+
+async def lookup_target(guid: str):
+    """
+    Returns the directory on the upload host and the filename prefix for files of an event
+    """
+    # get legacy_id from voctoweb
+    event = await voctoweb.get(f"/public/events/{guid}")
+    if not event:
+        raise HTTPException(status_code=404, detail="Event not found")
+
+    # we need to get the confernce_path and the legacy_id from the event
+    return _target(event.get("thumbnails_url"), ".thumbnails.vtt")
+
+
+async def event_length(guid: str) -> Optional[float]:
+    """Length of the recording of an event in seconds, if known"""
+    event = await voctoweb.get(f"/public/events/{guid}")
+    return (event or {}).get("length") or None
+
+
+async def check_duration(remote, stats: webvtt.Stats, length: Optional[float]):
+    """Aborts the upload (cdn.RemoteFile or jobs.SpoolFile) if its cues do not fit the recording"""
+    try:
+        webvtt.check_duration(stats, length)
+    except webvtt.WebVTTError as e:
+        await remote.abort(e)
+        raise HTTPException(status_code=422, detail=f"Invalid WebVTT file: {e}") from e
+
+
+async def lookup_targets(conference: str, guids: set[str]) -> dict[str, tuple[str, str] | Exception]:
+    """
+    Like lookup_target, but for many events of a conference at once:
+    resolved with a single GraphQL query, falling back to the REST API for events missing there
+    """
+    data = await voctoweb.graphql(
+        """query ConferenceTargets($slug: ID!){
+    	 conference(id: $slug) {
+    		events:lectures{nodes{guid,images{thumbUrl}}}
+    	}
+    }""",
+        slug=conference,
+    )
+    targets = {}
+    events = ((data or {}).get("conference") or {}).get("events") or {}
+    for event in events.get("nodes") or []:
+        if event and event["guid"] in guids and (event.get("images") or {}).get("thumbUrl"):
+            # the thumbnail has the same path as the other event files, e.g. …/66-5902….jpg
+            targets[event["guid"]] = _target(event["images"]["thumbUrl"], ".jpg")
+
+    missing = [guid for guid in guids if guid not in targets]
+    results = await asyncio.gather(
+        *(lookup_target(guid) for guid in missing), return_exceptions=True
+    )
+    targets.update(zip(missing, results))
+    return targets
+
+
+def target_filename(prefix: str, recording: FileMeta):
+    return f"{prefix}-{recording.language}.vtt"
+    # filename = f"{legacy_id}-{guid}-{model.recording.language}.vtt"
+
+
+async def register_file(guid: str, recording: FileMeta, filename: str):
+    # add (or update) file to voctoweb
+    try:
+        return await voctoweb.upsert_recording(
+            guid,
+            {
+                "folder": "",
+                **recording.model_dump(),
+                "filename": filename,
+                "mime_type": "text/vtt",
+                "language": recording.language,
+                "state": "auto",
+            },
+        )
+    except voctoweb.RecordingRejected as e:
+        if e.errors is not None:
+            raise HTTPException(
+                status_code=422,
+                detail={"message": "voctoweb rejected the recording", "errors": e.errors},
+            ) from e
+        raise HTTPException(status_code=502, detail=str(e)) from e
+
+
+async def finish(
+    remote,
+    guid: str,
+    directory: str,
+    prefix: str,
+    recording: FileMeta,
+    force=False,
+    stats: Optional[webvtt.Stats] = None,
+    committed: Optional[Callable[[], Awaitable[None]]] = None,
+):
+    """
+    Moves an uploaded file (cdn.ReplicatedFile) into place and registers it in voctoweb,
+    unless an identical file was published before. With the `stats` of the file, it is
+    only published if its cues fit the length of the recording. `committed` is called once
+    the file is in place, before it is registered.
+    """
+    if stats is not None:
+        try:
+            length = await event_length(guid)
+        except BaseException as e:
+            await remote.abort(e)
+            raise
+        await check_duration(remote, stats, length)
+    filename = target_filename(prefix, recording)
+    if not await remote.commit(f"{directory}/{filename}", force=force):
+        # identical file was published before, so there is nothing to tell voctoweb either
+        return {
+            "message": "File unchanged",
+            "status": "unchanged",
+            "size": remote.size,
+            "sha256": remote.sha256.hexdigest(),
+            "targets": remote.acknowledged,
+        }
+
+    if committed is not None:
+        await committed()
+    await register_file(guid, recording, filename)
+    # only now the file counts as published, so a failed registration is retried next time
+    remote.remember(f"{directory}/{filename}")
+
+    return {
+        "message": "File and data processed",
+        "status": "published",
+        "size": remote.size,
+        "sha256": remote.sha256.hexdigest(),
+        "targets": remote.acknowledged,
+    }
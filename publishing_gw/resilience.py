@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from os import environ as env
+from typing import Awaitable, Callable, Optional, TypeVar
+
+# attempts per upstream call and bounds of the (jittered) exponential backoff in seconds
+RETRY_ATTEMPTS = int(env.get("RETRY_ATTEMPTS", 3))
+RETRY_BASE_DELAY = float(env.get("RETRY_BASE_DELAY", 0.5))
+RETRY_MAX_DELAY = float(env.get("RETRY_MAX_DELAY", 10))
+# consecutive failures after which an upstream is considered down, and for how many seconds
+BREAKER_THRESHOLD = int(env.get("BREAKER_THRESHOLD", 5))
+BREAKER_RESET = float(env.get("BREAKER_RESET", 30))
+
+
+class UpstreamUnavailable(Exception):
+    def __init__(self, upstream: str, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures of an upstream. Once `threshold` is reached the breaker opens
+    and calls fail fast for `reset_timeout` seconds, after that calls are let through again:
+    the next success closes the breaker, the next failure opens it for another period.
+    Thread-safe, as it is also used from the SFTP worker threads.
+    """
+
+    def __init__(self, name: str, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def check(self):
+        opened_at = self.opened_at
+        if opened_at is not None and self.state == "open":
+            retry_after = self.reset_timeout - (time.monotonic() - opened_at)
+            raise UpstreamUnavailable(
+                self.name,
+                f"{self.name} is unavailable, retry in {retry_after:.0f}s",
+                retry_after=retry_after,
+            )
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logging.info(f"{self.name} is available again")
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.state != "open":
+                logging.warning(f"{self.name} failed {self.failures} times in a row, pausing calls")
+                self.opened_at = time.monotonic()
+
+
+class Retryable(Exception):
+    """Raised by wrapped calls to signal a transient failure, e.g. a 5xx response"""
+
+
+def backoff(attempt: int):
+    # "full jitter", spreads retries of concurrent callers
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+T = TypeVar("T")
+
+
+async def call(
+    breaker: CircuitBreaker, fn: Callable[..., Awaitable[T]], *args, retry_on=(Retryable,), **kwargs
+) -> T:
+    """
+    Awaits `fn(*args, **kwargs)`, retrying exceptions in `retry_on` with exponential backoff.
+    Raises UpstreamUnavailable once all attempts failed or while the breaker is open.
+    """
+    attempt = 0
+    while True:
+        breaker.check()
+        try:
+            result = await fn(*args, **kwargs)
+        except UpstreamUnavailable:
+            raise
+        except retry_on as e:
+            breaker.failure()
+            attempt += 1
+            if attempt >= RETRY_ATTEMPTS:
+                raise UpstreamUnavailable(
+                    breaker.name, f"{breaker.name} is unavailable: {e}"
+                ) from e
+            await asyncio.sleep(backoff(attempt - 1))
+        else:
+            breaker.success()
+            return result
@@ -0,0 +1,209 @@
+"""
+Compares the files of a conference on the upload host with the recordings registered in voctoweb.
+
+    python -m publishing_gw.scan 37c3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import stat
+from dataclasses import dataclass
+from typing import Optional
+
+import paramiko
+
+from publishing_gw import cdn, events, voctoweb
+from publishing_gw.file import FileEntry
+from publishing_gw.model import ScanIssue, ScanReport
+
+# number of events whose recordings are fetched from voctoweb in parallel
+SCAN_CONCURRENCY = int(os.environ.get("SCAN_CONCURRENCY", voctoweb.VOCTOWEB_POOL_SIZE))
+# voctoweb stores sizes in whole MiB, so only larger differences are reported
+SIZE_TOLERANCE = 1
+
+# public URL prefix -> directory on the upload host
+HOSTS = {
+    "https://cdn.media.ccc.de/": "/cdn.media.ccc.de/",
+    "https://static.media.ccc.de/media/": "/static.media.ccc.de/",
+}
+# derived files next to the recordings, which are never registered in voctoweb
+IGNORED_SUFFIXES = (".thumbnails.vtt", ".timeline.jpg", "_preview.jpg")
+SUBTITLE_TYPES = ("text/vtt", "application/x-subrip")
+
+
+@dataclass(slots=True)
+class Expected:
+    guid: str
+    size: Optional[int]  # MiB
+
+
+def remote_path(url: str) -> Optional[str]:
+    for prefix, directory in HOSTS.items():
+        if url.startswith(prefix):
+            return directory + url.removeprefix(prefix)
+    return None
+
+
+def missing_subtitles(event: dict) -> list[str]:
+    """Spoken languages of an event without subtitles in that language"""
+    spoken = set()
+    subtitled = set()
+    for recording in event.get("recordings") or []:
+        mime_type = recording.get("mime_type") or ""
+        language = recording.get("language") or ""
+        if mime_type in SUBTITLE_TYPES:
+            subtitled.add(language)
+        elif mime_type.startswith("video/"):
+            spoken.update(lang for lang in language.split("-") if lang)
+    return sorted(spoken - subtitled)
+
+
+def scan_directory(
+    sftp: paramiko.SFTPClient, directory: str, expected: dict[str, Expected]
+) -> tuple[int, list[ScanIssue]]:
+    """
+    Streams the listing of `directory` and compares it with the expected recordings.
+    Only the matched names and the issues found are kept, not the listing itself.
+    """
+    suffixes = {pathlib.PurePosixPath(name).suffix for name in expected}
+    seen = set()
+    issues = []
+    files = 0
+    try:
+        for attr in sftp.listdir_iter(directory):
+            if attr.st_mode is not None and not stat.S_ISREG(attr.st_mode):
+                continue
+            entry = FileEntry.from_attr(directory, attr)
+            files += 1
+            recording = expected.get(entry.name)
+            if recording is None:
+                if (
+                    pathlib.PurePosixPath(entry.name).suffix in suffixes
+                    and not entry.name.endswith(IGNORED_SUFFIXES)
+                ):
+                    issues.append(ScanIssue(kind="not_registered", path=entry.path, size=entry.size))
+                continue
+            seen.add(entry.name)
+            if (
+                recording.size is not None
+                and abs(entry.size / 1024 / 1024 - recording.size) > SIZE_TOLERANCE
+            ):
+                issues.append(
+                    ScanIssue(
+                        kind="size_mismatch",
+                        path=entry.path,
+                        guid=recording.guid,
+                        size=entry.size,
+                        expected_size=recording.size,
+                    )
+                )
+    except FileNotFoundError:
+        pass
+
+    for name in expected.keys() - seen:
+        issues.append(
+            ScanIssue(
+                kind="missing_on_cdn",
+                path=f"{directory}/{name}",
+                guid=expected[name].guid,
+                expected_size=expected[name].size,
+            )
+        )
+    return files, issues
+
+
+async def scan(conference: str) -> ScanReport:
+    """
+    Raises events.ConferenceNotFound or ValueError if the conference can not be looked up
+    """
+    result = await events.fetch_conference(conference)
+    if result is None:
+        raise events.ConferenceNotFound(conference)
+
+    semaphore = asyncio.Semaphore(SCAN_CONCURRENCY)
+
+    async def get_event(guid):
+        async with semaphore:
+            return await voctoweb.get(f"/public/events/{guid}")
+
+    details = await asyncio.gather(*(get_event(event["guid"]) for event in result["events"]))
+
+    issues = []
+    directories: dict[str, dict[str, Expected]] = {}
+    recordings = 0
+    for summary, event in zip(result["events"], details):
+        if not event:
+            issues.append(ScanIssue(kind="event_unavailable", guid=summary["guid"]))
+            continue
+        for recording in event.get("recordings") or []:
+            path = remote_path(recording.get("recording_url") or "")
+            if path is None:
+                continue
+            recordings += 1
+            directory, name = path.rsplit("/", 1)
+            directories.setdefault(directory, {})[name] = Expected(
+                event["guid"], recording.get("size")
+            )
+        languages = missing_subtitles(event)
+        if languages:
+            issues.append(
+                ScanIssue(kind="missing_subtitles", guid=event["guid"], languages=languages)
+            )
+
+    # at most one listing per pooled connection, others would wait for one and fail with
+    # PoolExhausted after SFTP_POOL_TIMEOUT
+    connections = asyncio.Semaphore(cdn.SFTP_POOL_SIZE)
+
+    async def list_directory(directory, expected):
+        async with connections:
+            return await cdn.run(scan_directory, directory, expected)
+
+    listings = await asyncio.gather(
+        *(list_directory(directory, expected) for directory, expected in directories.items())
+    )
+    for _, found in listings:
+        issues.extend(found)
+
+    return ScanReport(
+        conference=conference,
+        directories=sorted(directories),
+        files=sum(files for files, _ in listings),
+        recordings=recordings,
+        issues=issues,
+    )
+
+
+async def _main(conference: str, as_json: bool):
+    try:
+        report = await scan(conference)
+    finally:
+        await voctoweb.close()
+        await cdn.close()
+
+    if as_json:
+        print(report.model_dump_json(indent=2))
+        return
+    for issue in report.issues:
+        detail = issue.model_dump(exclude_none=True, exclude={"kind", "path", "guid"})
+        print(issue.kind, issue.path or issue.guid, json.dumps(detail) if detail else "", sep="\t")
+    print(
+        f"{len(report.issues)} issues, {report.files} files in {len(report.directories)} "
+        f"directories, {report.recordings} recordings in voctoweb"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the files of a conference on the upload host with voctoweb"
+    )
+    parser.add_argument("conference", help="conference acronym, e.g. 37c3")
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    args = parser.parse_args()
+    asyncio.run(_main(args.conference, args.json))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,111 @@
+import asyncio
+import json
+import logging
 import os
 from fastapi.encoders import jsonable_encoder
-import jwt
 import pydantic
+import tempfile
 import uvicorn
-import pathlib
+from contextlib import asynccontextmanager
 
 from fastapi import (
-    Body,
     Depends,
     FastAPI,
     HTTPException,
     Path,
-    UploadFile,
-    File,
     Form,
     Header,
+    Query,
+    Request,
 )
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
+from prometheus_fastapi_instrumentator import Instrumentator
 from typing import Optional
-from pydantic import BaseModel, TypeAdapter
+from pydantic import BaseModel
+
+from publishing_gw import (
+    auth,
+    cdn,
+    events,
+    fetch,
+    jobs,
+    publish,
+    resilience,
+    scan,
+    stream,
+    timing,
+    uploads,
+    voctoweb,
+    webvtt,
+)
+
+from publishing_gw.model import (
+    BatchBody,
+    Conference,
+    ConferencePage,
+    DetailedEvent,
+    EventSummary,
+    FetchBody,
+    FileUpsertBody,
+    Job,
+    JobQueue,
+    ResolveBody,
+    Resolved,
+    ScanReport,
+    Upload,
+    UploadCreate,
+    partial,
+)
+
+# address and port the server listens on, and number of worker processes
+HOST = os.environ.get("HOST", "::1")
+PORT = int(os.environ.get("PORT", 5005))
+WORKERS = int(os.environ.get("WORKERS", 1))
+# seconds running requests (e.g. uploads) and jobs get to finish on shutdown
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 60))
 
-from publishing_gw import cdn, voctoweb
+# number of files of a batch committed and registered in parallel
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", cdn.SFTP_POOL_SIZE))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await cdn.start()
+    await jobs.start()
+    await uploads.start()
+    yield
+    await uploads.stop()
+    await jobs.stop(SHUTDOWN_TIMEOUT)
+    await voctoweb.close()
+    await fetch.close()
+    await cdn.close()
 
-from publishing_gw.config import config
-from publishing_gw.model import Conference, DetailedEvent
 
 app = FastAPI(
+    lifespan=lifespan,
     title="c3voc Publishing Gateway",
     description="simplify publishing of auxiliary content like slides, subtitles, and other addional metadata to the c3voc infrastructure",
     version="0.2.0",
 )
 
+Instrumentator().instrument(app).expose(app, include_in_schema=False)
+app.add_middleware(timing.TimingMiddleware)
+
 
-def Error(message=None, status_code=400, detail=None):
+def Error(message=None, status_code=400, detail=None, headers=None):
     return JSONResponse(
         status_code=status_code,
         content={"errors": [{"message": message or detail or "unknown error"}]},
+        headers=headers,
+    )
+
+
+@app.exception_handler(resilience.UpstreamUnavailable)
+async def upstream_unavailable(request: Request, e: resilience.UpstreamUnavailable):
+    return Error(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(round(e.retry_after))} if e.retry_after else None,
     )
 
 
@@ -43,9 +113,11 @@ async def token_required(authorization: Optional[str] = Header(None)):
     api_key = None
 
     if authorization and authorization.startswith("Bearer "):
-        # TODO add support for Bearer token via sso.c3voc.de
-        token = jwt.decode(authorization.split(" ")[1], verify=True)
-        return token
+        # JWT issued by sso.c3voc.de
+        claims = await auth.tokens.verify(authorization.split(" ")[1])
+        if claims is None:
+            raise HTTPException(status_code=403, detail="The provided token is not valid")
+        return claims
 
     if authorization and authorization.startswith("Token "):
         api_key = authorization.split(" ")[1]
@@ -54,53 +126,196 @@ async def token_required(authorization: Optional[str] = Header(None)):
 
     if not api_key:
         raise HTTPException(status_code=400, detail="Please provide an API key")
-    if api_key not in config.allowed_keys:
+    if not auth.keys.check(api_key):
         raise HTTPException(status_code=403, detail="The provided API key is not valid")
     return api_key
 
 
+NDJSON = "application/x-ndjson"
+FIELDS = Query(
+    None,
+    description="Comma separated fields to return, subfields separated by dots, "
+    "e.g. guid,slug,recordings.filename",
+)
+
+
+def model_response(model: type[BaseModel], data, fields: Optional[str] = None) -> Response:
+    """
+    Validates upstream data against `model` (restricted to `fields`) and serializes it in one go,
+    bypassing the second validation and jsonable_encoder pass of the response_model
+    """
+    if fields:
+        try:
+            model = partial(model, fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    with timing.span("serialize"):
+        body = model.model_validate(data).model_dump_json()
+    return Response(body, media_type="application/json")
+
+
 @app.get("/", include_in_schema=False)
 async def root():
     return RedirectResponse("/docs", status_code=302)
 
 
+# declared before /api/{conference}, which would match it otherwise
+@app.get(
+    "/api/jobs",
+    summary="Get the number of background publishing jobs and the size of their files",
+)
+async def get_jobs(token: str = Depends(token_required)) -> JobQueue:
+    return await jobs.queue()
+
+
 @app.get(
     "/api/{conference}",
     summary="Get conference/series/project metadata needed for publishing from voctoweb/c3tracker etc.",
+    response_model=ConferencePage,
+    responses={200: {"content": {NDJSON: {}}}},
 )
 async def get_conference(
+    request: Request,
     conference: str = Path(example="37c3"),
-) -> Conference:
-    result = voctoweb.graphql(
-        """query Conference($slug: ID!){
-    	 conference(id: $slug) {
-    		id
-    		title
-    		events:lectures{nodes{guid,slug,title,date,video:videoPreferred{filename}}}
-    	}
-    }""",
-        slug=conference,
-    )["conference"]
+    after: Optional[str] = Query(
+        None, description="Cursor of the page to return, `next` of the previous page"
+    ),
+    limit: Optional[int] = Query(
+        None,
+        ge=1,
+        description="Number of events per page, at most EVENT_PAGE_SIZE (500 by default), "
+        "or the total number of events when streaming",
+    ),
+    fields: Optional[str] = FIELDS,
+) -> Response:
+    if NDJSON in request.headers.get("accept", ""):
+        return await stream_events(conference, after, limit, fields)
+
+    try:
+        if after is None and limit is None:
+            result = await events.fetch_conference(conference)
+        else:
+            limit = min(limit or events.EVENT_PAGE_SIZE, events.EVENT_PAGE_SIZE)
+            result = await events.fetch_page(conference, after, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
     if result is None:
         raise HTTPException(status_code=404, detail="Conference not found")
 
-    result["events"] = result.get("events", {}).get("nodes", [])
-    result["events"] = [event for event in result["events"] if event is not None] # api returns null in some cases at the moment
+    if "next" not in result:
+        return model_response(Conference, result, fields)
+    if fields:
+        fields += ",next"
+    return model_response(ConferencePage, result, fields)
+
+
+async def stream_events(
+    conference: str, after: Optional[str], limit: Optional[int], fields: Optional[str]
+) -> StreamingResponse:
+    """
+    The events of a conference as newline delimited JSON, written while the pages are fetched
+    from voctoweb. Errors after the first page end the stream with an {"error": …} line.
+    """
+    model = EventSummary
+    if fields:
+        try:
+            model = partial(EventSummary, fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    pages = events.pages(conference, after, limit)
+    try:
+        # fail with a proper status code if the conference can not be fetched at all
+        first = await anext(pages)
+    except events.ConferenceNotFound:
+        raise HTTPException(status_code=404, detail="Conference not found")
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    async def lines():
+        page = first
+        try:
+            while True:
+                for event in page["events"]:
+                    yield model.model_validate(event).model_dump_json() + "\n"
+                page = await anext(pages)
+        except StopAsyncIteration:
+            pass
+        except Exception as e:
+            logging.exception(f"streaming the events of {conference} failed")
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            await pages.aclose()
+
+    return StreamingResponse(lines(), media_type=NDJSON)
+
+
+async def event_index(conference: str) -> events.EventIndex:
+    try:
+        return await events.index(conference)
+    except events.ConferenceNotFound:
+        raise HTTPException(status_code=404, detail="Conference not found")
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+@app.get(
+    "/api/{conference}/resolve/{name}",
+    summary="Find an event by guid, slug, local id (e.g. 37c3-58019) or filename",
+)
+async def resolve_event(
+    conference: str = Path(example="37c3"),
+    name: str = Path(example="37c3-58019-deu-eng-Hacking_the_Whatever_hd.mp4"),
+) -> EventSummary:
+    event = (await event_index(conference)).resolve(name)
+    if event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    return event
+
 
-    return Conference.model_validate(result)
+@app.post(
+    "/api/{conference}/resolve",
+    summary="Find the events of many guids, slugs, local ids or filenames at once",
+)
+async def resolve_events(
+    body: ResolveBody,
+    conference: str = Path(example="37c3"),
+) -> Resolved:
+    index = await event_index(conference)
+    return Resolved(events={name: index.resolve(name) for name in body.names})
+
+
+@app.get(
+    "/api/{conference}/scan",
+    summary="Compare the files of a conference on the upload host with the recordings in voctoweb",
+)
+async def scan_conference(
+    conference: str = Path(example="37c3"),
+    token: str = Depends(token_required),
+) -> ScanReport:
+    try:
+        return await scan.scan(conference)
+    except events.ConferenceNotFound:
+        raise HTTPException(status_code=404, detail="Conference not found")
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
 
 @app.get(
     "/api/{conference}/events/{guid}",
     summary="Get event/lecture/item metadata needed for publishing from voctoweb/schedule etc.",
+    response_model=DetailedEvent,
 )
 async def get_event(
     conference: str = Path(example="37c3"),
     guid: str = Path(example="b64fa58b-6f1c-45ef-8dd1-c09947f8a455"),
-) -> DetailedEvent:
-    res = voctoweb.get(f"/public/events/{guid}")
-    return TypeAdapter(DetailedEvent).validate_python(res)
+    fields: Optional[str] = FIELDS,
+) -> Response:
+    res = await voctoweb.get(f"/public/events/{guid}")
+    if not res:
+        raise HTTPException(status_code=404, detail="Event not found")
+    return model_response(DetailedEvent, res, fields)
 
 
 @app.post(
@@ -136,75 +351,392 @@ async def recordings(payload: dict = Form(...), token: str = Depends(token_requi
     return Error(status_code=501, detail="Not implemented yet")
 
 
-class FileMeta(BaseModel):
-    language: str
-    mime_type: str
-
-
-class FileUpsertBody(BaseModel):
-    recording: FileMeta
-    # other: any
-
-    class Config:
-        arbitrary_types_allowed = True
-
-
 @app.put(
     "/api/{conference}/events/{guid}/file",
     summary="Add (or update) a file to an event e.g. lecture slides, subtitles etc.",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": ["meta", "file"],
+                        "properties": {
+                            "meta": {
+                                "type": "string",
+                                "description": "FileUpsertBody as JSON",
+                            },
+                            "file": {"type": "string", "format": "binary"},
+                        },
+                    },
+                },
+            },
+        },
+    },
 )
 async def create_or_update_file(
+    request: Request,
     conference: str = Path(examples=["37c3"]),
     guid: str = Path(examples=["b64fa58b-6f1c-45ef-8dd1-c09947f8a455"]),
-    file: UploadFile = File(),  # example="b64fa58b-6f1c-45ef-8dd1-c09947f8a455.deu.vtt"),
-    meta: str = Body(..., media_type="application/json"),
+    run_async: Optional[bool] = Query(
+        None,
+        alias="async",
+        description="Only store the file and publish it in the background, "
+        "responds with 202 and a job to poll at /api/jobs/{id}. Defaults to JOBS_WRITE_BEHIND",
+    ),
+    force: bool = Query(
+        False, description="Publish even if an identical file was published before"
+    ),
     token: str = Depends(token_required),
 ):
-    if not file.filename.endswith(".vtt"):
-        raise HTTPException(
-            status_code=400, detail="At the moment, only VTT files are supported"
+    if run_async is None:
+        run_async = jobs.JOBS_WRITE_BEHIND
+    if run_async:
+        # acknowledged as soon as the file is stored, the job checks its cues against the length
+        # of the recording, so voctoweb is not involved here
+        model, spool, _ = await receive_file(request, jobs.SpoolFile().open)
+        job = await jobs.submit(conference, guid, model, spool, force=force)
+        return JSONResponse(
+            status_code=202,
+            content=jsonable_encoder(job),
+            headers={"Location": f"/api/jobs/{job.id}"},
         )
 
-    try:
-        model = FileUpsertBody.model_validate_json(json_data=meta)
-    except pydantic.ValidationError as e:
-        raise HTTPException(detail=jsonable_encoder(e.errors()), status_code=422) from e
-
-    # get legacy_id from voctoweb
-    event = voctoweb.get(f"/public/events/{guid}")
-
-    # we need to get the confernce_path and the legacy_id from the event
-    # "thumbnails_url": "https://static.media.ccc.de/media/congress/2024/66-59022846-b130-581e-a89f-ecf6e7e43940.thumbnails.vtt",
-    path_base = pathlib.Path(
-        event.get("thumbnails_url")
-        .replace("https://static.media.ccc.de/media/", "")
-        .replace(".thumbnails.vtt", "")
+    directory, prefix = await publish.lookup_target(guid)
+    # the multipart body is streamed straight to cdn.media.ccc.de without spooling it locally
+    model, remote, stats = await receive_file(request, cdn.ReplicatedFile(directory).open)
+
+    # meta may arrive before or after the file, so the final filename is only set on commit
+    return await publish.finish(
+        remote, guid, directory, prefix, model.recording, force=force, stats=stats
     )
-    filename = f"{path_base.name}-{model.recording.language}.vtt"
-    # filename = f"{legacy_id}-{guid}-{model.recording.language}.vtt"
 
-    conference_path = path_base.parent
 
-    # upload file to cdn.media.ccc.de
-    cdn.upload_file(
-        file,
-        f"/static.media.ccc.de/{conference_path}/{filename}",
+@app.post(
+    "/api/{conference}/events/{guid}/fetch",
+    summary="Add (or update) a file to an event, downloaded by the gateway from a URL",
+)
+async def fetch_file(
+    body: FetchBody,
+    conference: str = Path(examples=["37c3"]),
+    guid: str = Path(examples=["b64fa58b-6f1c-45ef-8dd1-c09947f8a455"]),
+    force: bool = Query(
+        False, description="Publish even if an identical file was published before"
+    ),
+    token: str = Depends(token_required),
+):
+    try:
+        fetch.check_url(body.url)
+    except fetch.FetchError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e)) from e
+    directory, prefix = await publish.lookup_target(guid)
+    # the download is streamed straight to cdn.media.ccc.de, like uploaded files
+    remote = await cdn.ReplicatedFile(directory).open()
+    validator = webvtt.Validator()
+    try:
+        async for chunk in fetch.download(body.url, sha256=body.sha256, size=body.size):
+            if data := validator.feed(chunk):
+                await remote.write(data)
+        if data := validator.close():
+            await remote.write(data)
+    except fetch.FetchError as e:
+        await remote.abort(e)
+        raise HTTPException(status_code=e.status_code, detail=str(e)) from e
+    except webvtt.WebVTTError as e:
+        await remote.abort(e)
+        raise HTTPException(status_code=422, detail=f"Invalid WebVTT file: {e}") from e
+    except BaseException as e:
+        await remote.abort(e)
+        raise
+
+    return await publish.finish(
+        remote, guid, directory, prefix, body.recording, force=force, stats=validator.stats
     )
 
-    # add (or update) file to voctoweb
-    r = voctoweb.upsert_recording(
-        guid,
-        {
-            "folder": "",
-            **model.recording.model_dump(),
-            "filename": filename,
-            "mime_type": "text/vtt",
-            "language": model.recording.language,
-            "state": "auto",
+
+async def receive_file(request: Request, open_target):
+    """
+    Parses the multipart body of a file upload and streams the file into the target
+    returned by `open_target` (e.g. cdn.ReplicatedFile), checking (and normalizing) it as WebVTT
+    on the way. Returns the validated meta data, the target, which still needs to be committed
+    by the caller, and the stats of the file.
+    """
+    model = None
+    target = None
+    complete = False
+    validator = webvtt.Validator()
+    try:
+        async for part, chunk in stream.iter_multipart(request):
+            if part.name == "meta" and part.filename is None:
+                try:
+                    model = FileUpsertBody.model_validate_json(json_data=part.value)
+                except pydantic.ValidationError as e:
+                    raise HTTPException(
+                        detail=jsonable_encoder(e.errors()), status_code=422
+                    ) from e
+            elif part.name == "file" and part.filename is not None:
+                if target is None:
+                    # example="b64fa58b-6f1c-45ef-8dd1-c09947f8a455.deu.vtt"
+                    if not part.filename.endswith(".vtt"):
+                        raise HTTPException(
+                            status_code=400, detail="At the moment, only VTT files are supported"
+                        )
+                    target = await open_target()
+                if chunk is None:
+                    complete = True
+                    data = validator.close()
+                else:
+                    data = validator.feed(chunk)
+                if data:
+                    await target.write(data)
+
+        if model is None:
+            raise HTTPException(status_code=422, detail="Missing form field 'meta'")
+        if target is None or not complete:
+            raise HTTPException(status_code=422, detail="Missing or incomplete form field 'file'")
+    except stream.MultipartError as e:
+        if target is not None:
+            await target.abort(e)
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except webvtt.WebVTTError as e:
+        if target is not None:
+            await target.abort(e)
+        raise HTTPException(status_code=422, detail=f"Invalid WebVTT file: {e}") from e
+    except BaseException as e:
+        if target is not None:
+            await target.abort(e)
+        raise
+    return model, target, validator.stats
+
+
+@app.put(
+    "/api/{conference}/files",
+    summary="Add (or update) many files of a conference's events at once",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "type": "object",
+                        "required": ["meta"],
+                        "properties": {
+                            "meta": {
+                                "type": "string",
+                                "description": "BatchBody as JSON, must be the first part",
+                            },
+                        },
+                        "additionalProperties": {"type": "string", "format": "binary"},
+                    },
+                },
+            },
         },
+    },
+)
+async def create_or_update_files(
+    request: Request,
+    conference: str = Path(examples=["37c3"]),
+    force: bool = Query(
+        False, description="Publish even if an identical file was published before"
+    ),
+    token: str = Depends(token_required),
+):
+    batch = None
+    targets: dict[str, tuple[str, str] | Exception] = {}
+    results = {}
+    remotes = {}
+    validators = {}
+    tasks = []
+    # files are received one after another, but committed and registered in parallel
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def finish(name: str, entry, remote):
+        lookup = targets[entry.guid]
+        assert not isinstance(lookup, Exception)  # such files are not received
+        directory, prefix = lookup
+        try:
+            async with slots:
+                results[name] = await publish.finish(
+                    remote,
+                    entry.guid,
+                    directory,
+                    prefix,
+                    entry.recording,
+                    force=force,
+                    stats=validators[name].stats,
+                )
+        except Exception as e:
+            results[name] = failed(e)
+
+    def failed(e: Exception):
+        if isinstance(e, HTTPException):
+            return {"status": "failed", "error": e.detail}
+        return {"status": "failed", "error": str(e)}
+
+    try:
+        async for part, chunk in stream.iter_multipart(request):
+            if part.name == "meta" and part.filename is None:
+                try:
+                    batch = BatchBody.model_validate_json(part.value)
+                except pydantic.ValidationError as e:
+                    raise HTTPException(
+                        detail=jsonable_encoder(e.errors()), status_code=422
+                    ) from e
+                targets = await publish.lookup_targets(
+                    conference, {entry.guid for entry in batch.files.values()}
+                )
+                continue
+            if part.filename is None or part.name in results:
+                continue
+            if batch is None:
+                raise HTTPException(
+                    status_code=422, detail="Form field 'meta' must precede the files"
+                )
+
+            name = part.name
+            if name not in remotes:
+                entry = batch.files.get(name)
+                if entry is None:
+                    results[name] = {"status": "failed", "error": "No meta data for this file"}
+                    continue
+                if not part.filename.endswith(".vtt"):
+                    results[name] = {
+                        "status": "failed",
+                        "error": "At the moment, only VTT files are supported",
+                    }
+                    continue
+                lookup = targets[entry.guid]
+                if isinstance(lookup, Exception):
+                    results[name] = failed(lookup)
+                    continue
+                remotes[name] = await cdn.ReplicatedFile(lookup[0]).open()
+                validators[name] = webvtt.Validator()
+            validator = validators[name]
+            try:
+                data = validator.feed(chunk) if chunk is not None else validator.close()
+            except webvtt.WebVTTError as e:
+                # the rest of the file is skipped, like the parts of failed files above
+                results[name] = {"status": "failed", "error": f"Invalid WebVTT file: {e}"}
+                await remotes[name].abort(e)
+                continue
+            if data:
+                await remotes[name].write(data)
+            if chunk is None:
+                tasks.append(asyncio.create_task(finish(name, batch.files[name], remotes[name])))
+    except BaseException as e:
+        for task in tasks:
+            task.cancel()
+        for name, remote in remotes.items():
+            if name not in results:
+                await remote.abort(e)
+        if isinstance(e, stream.MultipartError):
+            raise HTTPException(status_code=400, detail=str(e)) from e
+        raise
+
+    await asyncio.gather(*tasks)
+    if batch is None:
+        raise HTTPException(status_code=422, detail="Missing form field 'meta'")
+    missing = {"status": "failed", "error": "File missing"}
+    # in the order of the meta data, followed by unexpected files
+    return {"results": {**{name: results.get(name, missing) for name in batch.files}, **results}}
+
+
+@app.post(
+    "/api/{conference}/events/{guid}/uploads",
+    summary="Start a resumable upload of a file to an event, for large files or unreliable links",
+    status_code=201,
+)
+async def create_upload(
+    body: UploadCreate,
+    response: Response,
+    conference: str = Path(examples=["37c3"]),
+    guid: str = Path(examples=["b64fa58b-6f1c-45ef-8dd1-c09947f8a455"]),
+    token: str = Depends(token_required),
+) -> Upload:
+    upload = await uploads.create(conference, guid, body)
+    response.headers["Location"] = f"/api/uploads/{upload.id}"
+    response.headers["Upload-Offset"] = "0"
+    return upload
+
+
+@app.head(
+    "/api/uploads/{id}",
+    summary="Get the offset to resume an upload from in the Upload-Offset header",
+)
+async def upload_offset(id: str, token: str = Depends(token_required)):
+    upload = await uploads.status(id)
+    return Response(
+        headers={
+            "Upload-Offset": str(upload.offset),
+            "Upload-Length": str(upload.length),
+            "Cache-Control": "no-store",
+        }
     )
 
-    return {"message": "File and data processed"}
+
+@app.get("/api/uploads/{id}", summary="Get the state of a resumable upload")
+async def get_upload(id: str, token: str = Depends(token_required)) -> Upload:
+    return await uploads.status(id)
+
+
+@app.patch(
+    "/api/uploads/{id}",
+    summary="Append the request body to an upload, starting at Upload-Offset",
+    status_code=204,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/offset+octet-stream": {
+                    "schema": {"type": "string", "format": "binary"},
+                },
+            },
+        },
+    },
+)
+async def append_upload(
+    id: str,
+    request: Request,
+    upload_offset: int = Header(),
+    token: str = Depends(token_required),
+):
+    if request.headers.get("Content-Type") != "application/offset+octet-stream":
+        raise HTTPException(
+            status_code=415, detail="Expected Content-Type application/offset+octet-stream"
+        )
+    offset = await uploads.append(id, upload_offset, request.stream())
+    return Response(status_code=204, headers={"Upload-Offset": str(offset)})
+
+
+@app.post(
+    "/api/uploads/{id}/finalize",
+    summary="Publish a completely uploaded file",
+)
+async def finalize_upload(
+    id: str,
+    force: bool = Query(
+        False, description="Publish even if an identical file was published before"
+    ),
+    token: str = Depends(token_required),
+):
+    return await uploads.finalize(id, force=force)
+
+
+@app.delete("/api/uploads/{id}", summary="Cancel an upload", status_code=204)
+async def delete_upload(id: str, token: str = Depends(token_required)):
+    await uploads.delete(id)
+
+
+@app.get(
+    "/api/jobs/{id}",
+    summary="Get the state of a background publishing job",
+)
+async def get_job(id: str, token: str = Depends(token_required)) -> Job:
+    job = await jobs.get(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 
 def dev():
@@ -212,18 +744,29 @@ def dev():
 
 
 def run(reload=False, log_level="info"):
-    port = int(os.environ.get("PORT", 5005))
-    config = uvicorn.Config(
-        app,
-        host="::1",
-        port=port,
+    if WORKERS > 1 and not reload:
+        # worker processes share the metadata cache and export their metrics together,
+        # both have to be configured before the workers import the app
+        os.makedirs(jobs.JOBS_DIR, exist_ok=True)
+        os.environ.setdefault(
+            "VOCTOWEB_CACHE_DB", os.path.join(jobs.JOBS_DIR, "voctoweb-cache.sqlite")
+        )
+        if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+            os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="publishing-gw-metrics-")
+
+    # TODO
+    # setup_logging()
+    uvicorn.run(
+        # workers (and reload) need the app as import string
+        "publishing_gw.server:app",
+        host=HOST,
+        port=PORT,
+        workers=WORKERS,
         log_level=log_level,
         reload=reload,
+        # on SIGTERM stop accepting connections and wait for running uploads
+        timeout_graceful_shutdown=int(SHUTDOWN_TIMEOUT),
     )
-    server = uvicorn.Server(config)
-    # TODO
-    # setup_logging()
-    server.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+import multipart
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import parse_options_header
+from starlette.requests import Request
+
+# form fields (e.g. meta) are kept in memory, so limit their size
+MAX_FIELD_SIZE = 64 * 1024
+
+
+class MultipartError(Exception):
+    pass
+
+
+@dataclass
+class Part:
+    name: str = ""
+    filename: Optional[str] = None
+    content_type: Optional[str] = None
+    # complete value of form fields, file contents are only passed through as chunks
+    value: bytes = b""
+    headers: list[tuple[bytes, bytes]] = field(default_factory=list)
+
+
+class _Parser:
+    def __init__(self, boundary: bytes):
+        self.part = Part()
+        self.events: list[tuple[Part, Optional[bytes]]] = []
+        self._header_name = b""
+        self._header_value = b""
+        self.parser = multipart.MultipartParser(
+            boundary,
+            {
+                "on_part_begin": self.on_part_begin,
+                "on_part_data": self.on_part_data,
+                "on_part_end": self.on_part_end,
+                "on_header_field": self.on_header_field,
+                "on_header_value": self.on_header_value,
+                "on_header_end": self.on_header_end,
+                "on_headers_finished": self.on_headers_finished,
+            },
+        )
+
+    def on_part_begin(self):
+        self.part = Part()
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self.part.filename is not None:
+            self.events.append((self.part, data[start:end]))
+            return
+        self.part.value += data[start:end]
+        if len(self.part.value) > MAX_FIELD_SIZE:
+            raise MultipartError(f"Form field '{self.part.name}' is too large")
+
+    def on_part_end(self):
+        self.events.append((self.part, None))
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self.part.headers.append((self._header_name.lower(), self._header_value))
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        headers = dict(self.part.headers)
+        _, options = parse_options_header(headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise MultipartError('The Content-Disposition header field "name" must be provided.')
+        self.part.name = options[b"name"].decode("utf-8", "replace")
+        if b"filename" in options:
+            self.part.filename = options[b"filename"].decode("utf-8", "replace")
+        if b"content-type" in headers:
+            self.part.content_type = headers[b"content-type"].decode("latin-1")
+
+
+async def iter_multipart(request: Request) -> AsyncIterator[tuple[Part, Optional[bytes]]]:
+    """
+    Parse a multipart/form-data request body while it arrives, without spooling it to disk.
+
+    Yields `(part, chunk)` tuples: file parts are passed through chunk by chunk, followed by
+    `(part, None)` once the part is complete. Form fields are only yielded when complete,
+    i.e. as `(part, None)` with `part.value` set.
+    """
+    content_type, params = parse_options_header(request.headers.get("Content-Type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise MultipartError("Expected a multipart/form-data request body")
+
+    parser = _Parser(params[b"boundary"])
+    try:
+        async for chunk in request.stream():
+            parser.parser.write(chunk)
+            for event in parser.events:
+                yield event
+            parser.events.clear()
+        parser.parser.finalize()
+    except MultipartParseError as e:
+        raise MultipartError(f"Malformed multipart body: {e}") from e
+    for event in parser.events:
+        yield event
@@ -0,0 +1,143 @@
+"""
+Timing of the stages of a request (voctoweb lookups, SFTP uploads, …), reported in the
+Server-Timing header of the response and in the log
+
+    with timing.span("voctoweb.get"):
+        ...
+
+Spans outside of a request (e.g. in background jobs) are not recorded.
+"""
+
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+# add the stages of a request as Server-Timing header to its response
+SERVER_TIMING = bool(int(os.environ.get("SERVER_TIMING", 1)))
+# log the stages of every request as a JSON line (logger publishing_gw.timing, level INFO)
+TIMING_LOG = bool(int(os.environ.get("TIMING_LOG", 0)))
+# requests taking longer than this many seconds are logged with the spans of each stage
+# (0 disables), SLOW_REQUEST_SAMPLE is the fraction of them which is logged
+SLOW_REQUEST_THRESHOLD = float(os.environ.get("SLOW_REQUEST_THRESHOLD", 0))
+SLOW_REQUEST_SAMPLE = float(os.environ.get("SLOW_REQUEST_SAMPLE", 1))
+
+ENABLED = SERVER_TIMING or TIMING_LOG or SLOW_REQUEST_THRESHOLD > 0
+
+logger = logging.getLogger("publishing_gw.timing")
+if TIMING_LOG and not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class Trace:
+    __slots__ = ("start", "stages")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # by name, in the order the first of their spans ended: start of the first span (relative
+        # to the request), total duration in seconds and number of spans, so memory does not grow
+        # with spans repeated per chunk of an upload
+        self.stages: dict[str, list] = {}
+
+    def add(self, name: str, start: float, duration: float):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [start - self.start, duration, 1]
+        else:
+            stage[1] += duration
+            stage[2] += 1
+
+    def header(self) -> str:
+        entries = []
+        for name, (_, total, count) in self.stages.items():
+            entry = f"{name};dur={total * 1000:.1f}"
+            if count > 1:
+                entry += f';desc="{count}x"'
+            entries.append(entry)
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """Records the duration of the block as stage `name` of the current request"""
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter() - start)
+
+
+def _report(scope: dict, status: Optional[int], trace: Trace):
+    duration = time.perf_counter() - trace.start
+    slow = 0 < SLOW_REQUEST_THRESHOLD <= duration and random.random() < SLOW_REQUEST_SAMPLE
+    if not slow and not TIMING_LOG:
+        return
+    entry = {
+        "method": scope["method"],
+        "path": scope["path"],
+        "status": status,
+        "duration_ms": round(duration * 1000, 1),
+        "stages": {
+            name: round(total * 1000, 1) for name, (_, total, _) in trace.stages.items()
+        },
+    }
+    if slow:
+        entry["spans"] = [
+            {
+                "name": name,
+                "start_ms": round(start * 1000, 1),
+                "duration_ms": round(total * 1000, 1),
+                "count": count,
+            }
+            for name, (start, total, count) in sorted(
+                trace.stages.items(), key=lambda stage: stage[1][0]
+            )
+        ]
+        logger.warning(f"slow request {json.dumps(entry)}")
+    else:
+        logger.info(json.dumps(entry))
+
+
+class TimingMiddleware:
+    """ASGI middleware tracing every HTTP request, a no-op if all reporting is disabled"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace()
+        status = None
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING:
+                    timing = (b"server-timing", trace.header().encode())
+                    message = {**message, "headers": [*message.get("headers", []), timing]}
+            await send(message)
+
+        token = _trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _trace.reset(token)
+            _report(scope, status, trace)
@@ -0,0 +1,383 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from os import path, environ as env
+from typing import AsyncIterator, Optional
+from uuid import uuid4
+
+from fastapi import HTTPException
+from starlette.requests import ClientDisconnect
+
+from publishing_gw import cdn, jobs, publish, webvtt
+from publishing_gw.model import FileMeta, Upload, UploadCreate
+
+# seconds without any data appended after which unfinished resumable uploads are discarded
+UPLOAD_EXPIRY = float(env.get("UPLOAD_EXPIRY", 24 * 3600))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id TEXT PRIMARY KEY,
+    conference TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    directory TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    tmp TEXT NOT NULL,
+    created REAL NOT NULL,
+    -- set once the file is moved into place, the upload hosts which stored it (as JSON list)
+    sha256 TEXT,
+    targets TEXT,
+    -- process appending to (or finalizing) the upload, and when data was last appended
+    busy INTEGER,
+    touched REAL
+)
+"""
+
+db: Optional[sqlite3.Connection] = None
+# the database is only used from this thread, like the job database
+db_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="uploads-db")
+expiry: Optional[asyncio.Task] = None
+# digest state of the data appended so far, by upload id, together with the offset it covers;
+# per process, so it is only used if it covers exactly the staged data (other worker processes
+# may have appended to the upload meanwhile)
+hashers: dict[str, tuple[int, "hashlib._Hash"]] = {}
+# WebVTT parser state of the data appended so far, like `hashers`
+validators: dict[str, tuple[int, webvtt.Validator]] = {}
+# requests of this process appending to (or finalizing) an upload, see _claim
+locks: dict[str, asyncio.Lock] = {}
+
+
+def _conn() -> sqlite3.Connection:
+    assert db is not None, "uploads.start() was not called"
+    return db
+
+
+def _fetch(sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+    return _conn().execute(sql, params).fetchall()
+
+
+def _write(sql: str, params: tuple = ()) -> int:
+    return _conn().execute(sql, params).rowcount
+
+
+async def _db(fn, *args):
+    """Calls `fn(*args)` in the database thread"""
+    return await asyncio.get_running_loop().run_in_executor(db_thread, fn, *args)
+
+
+def _upload(row: sqlite3.Row, offset: int) -> Upload:
+    return Upload(
+        id=row["id"],
+        conference=row["conference"],
+        guid=row["guid"],
+        filename=row["filename"],
+        length=row["length"],
+        offset=offset,
+        created=row["created"],
+        expires=(row["touched"] or row["created"]) + UPLOAD_EXPIRY,
+    )
+
+
+async def get(id: str) -> sqlite3.Row:
+    rows = await _db(_fetch, "SELECT * FROM uploads WHERE id = ?", (id,))
+    if not rows:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return rows[0]
+
+
+def _take(id: str) -> bool:
+    pid = os.getpid()
+    if _write("UPDATE uploads SET busy = ? WHERE id = ? AND busy IS NULL", (pid, id)):
+        return True
+    rows = _fetch("SELECT busy FROM uploads WHERE id = ?", (id,))
+    if not rows or rows[0]["busy"] is None:
+        return False
+    owner = rows[0]["busy"]
+    # left behind by a process which died (or by this one before a restart, as no request of
+    # this process holds the upload)
+    if owner != pid and jobs.alive(owner):
+        return False
+    return bool(_write("UPDATE uploads SET busy = ? WHERE id = ? AND busy = ?", (pid, id, owner)))
+
+
+def _release(id: str):
+    _write(
+        "UPDATE uploads SET busy = NULL, touched = ? WHERE id = ? AND busy = ?",
+        (time.time(), id, os.getpid()),
+    )
+
+
+@asynccontextmanager
+async def _claim(id: str):
+    """
+    Only one request may append to or finalize an upload at a time: in this process, and across
+    all worker processes, which share the staged file
+    """
+    lock = locks.setdefault(id, asyncio.Lock())
+    if lock.locked():
+        raise HTTPException(status_code=409, detail="Upload is already in progress")
+    async with lock:
+        if not await _db(_take, id):
+            await get(id)  # 404 if it is gone meanwhile
+            raise HTTPException(status_code=409, detail="Upload is already in progress")
+        try:
+            yield
+        finally:
+            await _db(_release, id)
+
+
+def _stat(sftp, tmp: str):
+    try:
+        return sftp.stat(tmp).st_size
+    except FileNotFoundError:
+        return 0
+
+
+async def offset(row: sqlite3.Row) -> int:
+    """Number of bytes staged on the upload host, which is the authoritative upload offset"""
+    if row["targets"] is not None:
+        # moved into place already
+        return row["length"]
+    return await cdn.run(_stat, row["tmp"])
+
+
+async def create(conference: str, guid: str, body: UploadCreate) -> Upload:
+    if not body.filename.endswith(".vtt"):
+        raise HTTPException(status_code=400, detail="At the moment, only VTT files are supported")
+    directory, prefix = await publish.lookup_target(guid)
+    id = str(uuid4())
+    tmp = f"{directory}/.upload-{id}"
+
+    def touch(sftp):
+        cdn.open_file(sftp, tmp, "w").close()
+
+    await cdn.run(touch)
+    now = time.time()
+    await _db(
+        _write,
+        "INSERT INTO uploads (id, conference, guid, meta, filename, length, directory, prefix, tmp,"
+        " created, touched) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (id, conference, guid, body.recording.model_dump_json(), body.filename, body.length,
+         directory, prefix, tmp, now, now),
+    )
+    hashers[id] = (0, hashlib.sha256())
+    validators[id] = (0, webvtt.Validator(normalize=False))
+    return _upload(await get(id), 0)
+
+
+async def status(id: str) -> Upload:
+    row = await get(id)
+    return _upload(row, await offset(row))
+
+
+async def append(id: str, start: int, chunks: AsyncIterator[bytes]) -> int:
+    """
+    Appends the request body to the staged file, if `start` matches the current offset.
+    Data received before the client disconnects is kept. Returns the new offset.
+    """
+    async with _claim(id):
+        row = await get(id)
+        current = await offset(row)
+        if row["targets"] is not None:
+            raise HTTPException(status_code=409, detail="Upload is finalized already")
+        if start != current:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload-Offset does not match, expected {current}",
+                headers={"Upload-Offset": str(current)},
+            )
+
+        # digest state is only valid if it covers exactly the staged data,
+        # otherwise it is rebuilt from the staged file on finalize
+        known = hashers.pop(id, None)
+        if known and known[0] == current:
+            sha256 = known[1]
+        else:
+            sha256 = hashlib.sha256() if current == 0 else None
+        checked = validators.pop(id, None)
+        if checked and checked[0] == current:
+            validator = checked[1]
+        else:
+            validator = webvtt.Validator(normalize=False) if current == 0 else None
+        remote = await cdn.RemoteFile(
+            row["directory"], tmp=row["tmp"], size=current, sha256=sha256, defer=0
+        ).open()
+        try:
+            async for chunk in chunks:
+                if remote.size + len(chunk) > row["length"]:
+                    raise HTTPException(status_code=413, detail="Upload exceeds its length")
+                if validator is not None:
+                    # the chunk is not appended, the client may resume with corrected data
+                    validator.feed(chunk)
+                await remote.write(chunk)
+        except ClientDisconnect:
+            # keep what was received, the client resumes from the new offset
+            pass
+        except webvtt.WebVTTError as e:
+            validator = None
+            raise HTTPException(status_code=422, detail=f"Invalid WebVTT file: {e}") from e
+        finally:
+            await remote.flush()
+            if sha256 is not None:
+                hashers[id] = (remote.size, remote.sha256)
+            if validator is not None:
+                validators[id] = (remote.size, validator)
+        return remote.size
+
+
+async def finalize(id: str, force=False):
+    async with _claim(id):
+        row = await get(id)
+        if row["targets"] is not None:
+            # an earlier attempt moved the file into place, but could not register it
+            return await _register(row)
+        current = await offset(row)
+        if current != row["length"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload is incomplete, {current} of {row['length']} bytes received",
+                headers={"Upload-Offset": str(current)},
+            )
+        known = hashers.get(id)
+        checked = validators.get(id)
+        try:
+            if known and known[0] == current and checked and checked[0] == current:
+                sha256, validator = known[1], checked[1]
+            else:
+                validator = webvtt.Validator(normalize=False)
+                sha256 = await cdn.run(_rescan, row["tmp"], validator)
+            validator.close()
+        except webvtt.WebVTTError as e:
+            await _discard(row)
+            raise HTTPException(status_code=422, detail=f"Invalid WebVTT file: {e}") from e
+
+        remote = cdn.ReplicatedFile(row["directory"], tmp=row["tmp"], size=current, sha256=sha256)
+
+        async def committed():
+            # the staged file is gone now, a retry only needs to register it
+            await _db(
+                _write,
+                "UPDATE uploads SET sha256 = ?, targets = ? WHERE id = ?",
+                (remote.sha256.hexdigest(), json.dumps(remote.acknowledged), id),
+            )
+
+        try:
+            result = await publish.finish(
+                await remote.open(),
+                row["guid"],
+                row["directory"],
+                row["prefix"],
+                FileMeta.model_validate_json(row["meta"]),
+                force=force,
+                stats=validator.stats,
+                committed=committed,
+            )
+        except HTTPException as e:
+            if e.status_code == 422:
+                # rejected for good, e.g. cues beyond the end of the recording
+                await _discard(row)
+            raise
+        await _forget(id)
+        return result
+
+
+async def _register(row: sqlite3.Row):
+    recording = FileMeta.model_validate_json(row["meta"])
+    filename = publish.target_filename(row["prefix"], recording)
+    targets = json.loads(row["targets"])
+    try:
+        await publish.register_file(row["guid"], recording, filename)
+    except HTTPException as e:
+        if e.status_code == 422:
+            await _forget(row["id"])
+        raise
+    cdn.remember(f"{row['directory']}/{filename}", targets, row["sha256"], row["length"])
+    await _forget(row["id"])
+    return {
+        "message": "File and data processed",
+        "status": "published",
+        "size": row["length"],
+        "sha256": row["sha256"],
+        "targets": targets,
+    }
+
+
+def _rescan(sftp, tmp: str, validator: webvtt.Validator):
+    """Digest and WebVTT stats of a staged file, e.g. after a restart"""
+    sha256 = hashlib.sha256()
+    with sftp.open(tmp, "r", 32768) as fh:
+        fh.prefetch()
+        while chunk := fh.read(32768):
+            sha256.update(chunk)
+            validator.feed(chunk)
+    return sha256
+
+
+async def _forget(id: str):
+    await _db(_write, "DELETE FROM uploads WHERE id = ?", (id,))
+    hashers.pop(id, None)
+    validators.pop(id, None)
+    locks.pop(id, None)
+
+
+async def _discard(row: sqlite3.Row):
+    try:
+        await cdn.run(lambda sftp: sftp.remove(row["tmp"]))
+    except FileNotFoundError:
+        pass
+    await _forget(row["id"])
+
+
+async def delete(id: str):
+    async with _claim(id):
+        await _discard(await get(id))
+
+
+async def _expire():
+    while True:
+        rows = await _db(
+            _fetch,
+            "SELECT id FROM uploads WHERE COALESCE(touched, created) < ?",
+            (time.time() - UPLOAD_EXPIRY,),
+        )
+        for row in rows:
+            try:
+                await delete(row["id"])
+            except HTTPException:
+                pass  # being appended to (so not expired after all), or gone meanwhile
+            except Exception:
+                logging.exception(f"could not discard expired upload {row['id']}")
+        await asyncio.sleep(min(UPLOAD_EXPIRY, 3600))
+
+
+def _open():
+    global db
+    db = sqlite3.connect(
+        path.join(jobs.JOBS_DIR, "uploads.sqlite"),
+        isolation_level=None,
+        timeout=jobs.JOBS_DB_TIMEOUT,
+    )
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(SCHEMA)
+
+
+async def start():
+    global expiry
+    await _db(_open)
+    expiry = asyncio.create_task(_expire())
+
+
+async def stop():
+    if expiry is not None:
+        expiry.cancel()
+        await asyncio.gather(expiry, return_exceptions=True)
+    await _db(_conn().close)
@@ -1,56 +1,234 @@
+import asyncio
+import logging
 import re
-import time
 import json
-from typing import Any
-import requests
+import time
+from typing import Any, Optional
+import httpx
 from os import environ
-from urllib.parse import urljoin
 
+from publishing_gw import metrics, resilience, timing
+from publishing_gw.cache import CacheEntry, SharedCache, TTLCache
 
-VOCTOWEB_URL = "https://api.media.ccc.de"
+
+VOCTOWEB_URL = environ.get("VOCTOWEB_URL", "https://api.media.ccc.de")
 # VOCTOWEB_URL = 'https://media.test.c3voc.de'
 VOCTOWEB_API_KEY = environ.get("VOCTOWEB_API_KEY", "")
 
-debug = False
+# connection pool and timeouts (in seconds) shared by all requests to voctoweb
+VOCTOWEB_POOL_SIZE = int(environ.get("VOCTOWEB_POOL_SIZE", 10))
+VOCTOWEB_KEEPALIVE = float(environ.get("VOCTOWEB_KEEPALIVE", 30))
+VOCTOWEB_TIMEOUT = float(environ.get("VOCTOWEB_TIMEOUT", 10))
+VOCTOWEB_CONNECT_TIMEOUT = float(environ.get("VOCTOWEB_CONNECT_TIMEOUT", 5))
+VOCTOWEB_POOL_TIMEOUT = float(environ.get("VOCTOWEB_POOL_TIMEOUT", 5))
+
+# metadata cache: max. number of entries and time-to-live in seconds
+VOCTOWEB_CACHE_SIZE = int(environ.get("VOCTOWEB_CACHE_SIZE", 1024))
+VOCTOWEB_CACHE_TTL = float(environ.get("VOCTOWEB_CACHE_TTL", 60))
+# SQLite file to share the metadata cache between worker processes, in-process cache if unset
+VOCTOWEB_CACHE_DB = environ.get("VOCTOWEB_CACHE_DB")
+
+# recording upserts are collected for up to UPSERT_WINDOW seconds or UPSERT_BATCH_SIZE
+# recordings and then sent with at most UPSERT_CONCURRENCY requests in flight
+UPSERT_WINDOW = float(environ.get("VOCTOWEB_UPSERT_WINDOW", 0.05))
+UPSERT_BATCH_SIZE = int(environ.get("VOCTOWEB_UPSERT_BATCH_SIZE", 50))
+UPSERT_CONCURRENCY = int(environ.get("VOCTOWEB_UPSERT_CONCURRENCY", VOCTOWEB_POOL_SIZE))
+
 dry_run = False
-slow_down = False
 
-private_api = requests.Session()
-private_api.headers.update(
-    {
+limits = httpx.Limits(
+    max_connections=VOCTOWEB_POOL_SIZE,
+    max_keepalive_connections=VOCTOWEB_POOL_SIZE,
+    keepalive_expiry=VOCTOWEB_KEEPALIVE,
+)
+timeout = httpx.Timeout(
+    VOCTOWEB_TIMEOUT,
+    connect=VOCTOWEB_CONNECT_TIMEOUT,
+    pool=VOCTOWEB_POOL_TIMEOUT,
+)
+
+public_api = httpx.AsyncClient(base_url=VOCTOWEB_URL, limits=limits, timeout=timeout)
+private_api = httpx.AsyncClient(
+    base_url=VOCTOWEB_URL,
+    limits=limits,
+    timeout=timeout,
+    headers={
         "Content-Type": "application/json",
         "Authorization": f"Token token={VOCTOWEB_API_KEY}",
-    }
+    },
 )
 
-def graphql(query: str, **variables: dict):
-    q = re.sub(r'\s+', '+', query)
-    url = f"{VOCTOWEB_URL}/graphql?query={q}"
-    if variables:
-        url += "&variables=" + json.dumps(variables)
-    response = requests.get(url)
+cache = TTLCache("voctoweb", maxsize=VOCTOWEB_CACHE_SIZE, ttl=VOCTOWEB_CACHE_TTL)
+# shared by all worker processes, behind the cache of each process
+shared_cache = (
+    SharedCache(
+        "voctoweb_shared", VOCTOWEB_CACHE_DB, maxsize=VOCTOWEB_CACHE_SIZE, ttl=VOCTOWEB_CACHE_TTL
+    )
+    if VOCTOWEB_CACHE_DB
+    else None
+)
+breaker = resilience.CircuitBreaker("voctoweb")
+
+
+async def close():
+    await upserts.drain()
+    await public_api.aclose()
+    await private_api.aclose()
+    if shared_cache is not None:
+        shared_cache.close()
+
+
+in_flight = metrics.pool_connections.labels("voctoweb", "in_use")
+
+
+def operation_name(uri: str, params: dict | None = None):
+    """Label for metrics, e.g. 'graphql:Conference' or 'GET /public/events/:id'"""
+    if uri == "/graphql" and params:
+        match = re.match(r"\s*(?:query|mutation)\s+(\w+)", params.get("query", ""))
+        return f"graphql:{match.group(1) if match else 'anonymous'}"
+    return re.sub(r"/(?:[0-9a-f]{8}-[0-9a-f-]{27}|\d+)(?=/|$)", "/:id", uri.split("?")[0])
+
+
+async def _request(client: httpx.AsyncClient, method: str, uri: str, **kwargs):
+    operation = operation_name(uri, kwargs.get("params"))
+    if not operation.startswith("graphql:"):
+        operation = f"{method} {operation}"
+    start = time.perf_counter()
+    in_flight.inc()
+    try:
+        response = await client.request(method, uri, **kwargs)
+    except httpx.TransportError as e:
+        raise resilience.Retryable(f"{method} {uri} failed: {e!r}") from e
+    finally:
+        in_flight.dec()
+        metrics.voctoweb_latency.labels(operation).observe(time.perf_counter() - start)
+    if response.status_code >= 500 or response.status_code == 429:
+        raise resilience.Retryable(f"{method} {uri} returned {response.status_code}")
+    return response
+
+
+async def request(client: httpx.AsyncClient, method: str, uri: str, **kwargs) -> httpx.Response:
+    """
+    Sends a request to voctoweb, retrying network errors and 5xx/429 responses with backoff.
+    Raises resilience.UpstreamUnavailable if voctoweb does not recover or is known to be down.
+    """
+    return await resilience.call(breaker, _request, client, method, uri, **kwargs)
+
+
+def cache_key(uri: str, params: dict | None = None):
+    return (uri, tuple(sorted(params.items())) if params else None)
+
+
+async def _cached(key: tuple) -> Optional[CacheEntry]:
+    entry = cache.get(key)
+    if shared_cache is not None and (entry is None or not entry.fresh()):
+        # another worker process may have fetched (or revalidated) it meanwhile
+        entry = await shared_cache.get(key) or entry
+        if entry is not None and entry.fresh():
+            cache.set(
+                key,
+                entry.value,
+                etag=entry.etag,
+                last_modified=entry.last_modified,
+                ttl=entry.expires - time.monotonic(),
+            )
+    return entry
+
+
+async def _store(key: tuple, value, etag=None, last_modified=None):
+    cache.set(key, value, etag=etag, last_modified=last_modified)
+    if shared_cache is not None:
+        await shared_cache.set(key, value, etag=etag, last_modified=last_modified)
+
+
+# upstream lookups in progress, by cache key
+pending: dict[tuple, asyncio.Task] = {}
+
+
+def _done(key: tuple, task: asyncio.Task):
+    if pending.get(key) is task:
+        del pending[key]
+    # the result may have had no waiters left, e.g. when all of them were cancelled
+    if not task.cancelled():
+        task.exception()
 
+
+async def _get_json(uri: str, params: dict | None = None):
+    """
+    GET a JSON document from voctoweb. Responses are served from the cache while fresh,
+    stale entries are revalidated via If-None-Match/If-Modified-Since where voctoweb
+    provides ETag/Last-Modified headers. Concurrent identical lookups share one request.
+    """
+    key = cache_key(uri, params)
+    entry = await _cached(key)
+    if entry is not None and entry.fresh():
+        return entry.value
+
+    task = pending.get(key)
+    if task is not None:
+        operation = operation_name(uri, params)
+        if not operation.startswith("graphql:"):
+            operation = f"GET {operation}"
+        metrics.voctoweb_coalesced.labels(operation).inc()
+    else:
+        # not tied to the first caller, which might be cancelled while others still wait
+        task = asyncio.create_task(_fetch(key, entry, uri, params))
+        pending[key] = task
+        task.add_done_callback(lambda task: _done(key, task))
+    with timing.span("voctoweb.graphql" if uri == "/graphql" else "voctoweb.get"):
+        return await asyncio.shield(task)
+
+
+async def _fetch(key: tuple, entry, uri: str, params: dict | None):
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    response = await request(public_api, "GET", uri, params=params, headers=headers)
+
+    if response.status_code == 304 and entry is not None:
+        metrics.cache_requests.labels(cache.name, "revalidated").inc()
+        # fresh again, also in the cache of this process if it was found in the shared one only
+        await _store(key, entry.value, etag=entry.etag, last_modified=entry.last_modified)
+        return entry.value
     if response.status_code != 200:
-        print(f"  {response.status_code}\n" + response.text.split("\n")[0])
-        if slow_down:
-            time.sleep(5)
+        error = response.text.split("\n")[0]
+        logging.warning(f"voctoweb returned {response.status_code} for {uri}: {error}")
         return False
 
     body = response.json()
-    if debug and 'errors' in body:
-        # TODO use logging.error etc.
-        print(f"  {url}")
-        print(f"  {response.status_code}")
-        print(f"  {body['errors']}")
+    await _store(
+        key,
+        body,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+    return body
 
-    return body.get('data', None)
 
-def get(uri) -> Any:
-    response = requests.get(urljoin(VOCTOWEB_URL, uri))
-    if response.status_code != 200:
-        print(f"  {response.status_code}\n" + response.text.split("\n")[0])
+async def graphql(query: str, **variables: Any):
+    params = {"query": re.sub(r"\s+", " ", query)}
+    if variables:
+        params["variables"] = json.dumps(variables)
+    body = await _get_json("/graphql", params)
+
+    if body is False:
         return False
-    return response.json()
+
+    if 'errors' in body:
+        # do not keep (partially) failed queries around
+        cache.pop(cache_key("/graphql", params))
+        if shared_cache is not None:
+            await shared_cache.pop(cache_key("/graphql", params))
+        logging.warning(f"voctoweb GraphQL query failed: {body['errors']}")
+        logging.debug(f"failed GraphQL query: {params}")
+
+    return body.get('data', None)
+
+async def get(uri) -> Any:
+    return await _get_json(uri)
 
 
 def key_from_slug(slug: str, cleanup=False):
@@ -67,24 +245,125 @@ def key_from_slug(slug: str, cleanup=False):
     return slug
 
 
-def upsert_recording(guid: str, data: dict):
-    if not (dry_run):
-        # create or update recording in voctoweb
-        r = private_api.post(VOCTOWEB_URL + "/api/recordings", json={
+class RecordingRejected(Exception):
+    """voctoweb did not accept a recording, `errors` are its validation errors (status 422)"""
+
+    def __init__(self, status_code: int, errors: Any = None):
+        super().__init__(f"voctoweb rejected the recording with status {status_code}")
+        self.status_code = status_code
+        self.errors = errors
+
+
+async def _upsert(guid: str, data: dict):
+    try:
+        r = await request(private_api, "POST", "/api/recordings", json={
             "guid": guid,
             "recording": {"folder": "", **data},
         })
-        if r.status_code not in [200, 201]:
-            print(f"  voctoweb error {r.status_code}:\n" + r.text.split("\n")[0])
-            if debug:
-                print(r.text)
-            if slow_down:
-                time.sleep(5)
-            if r.status_code == 422:
-                return r.json()
-            return False
-        print(
-            f"  {'created' if r.status_code == 201 else 'updated'} recording successfully"
+    except resilience.UpstreamUnavailable:
+        metrics.voctoweb_upserts.labels("unavailable").inc()
+        raise
+    metrics.voctoweb_upserts.labels(str(r.status_code)).inc()
+    if r.status_code not in [200, 201]:
+        error = r.text.split("\n")[0]
+        logging.warning(
+            f"voctoweb rejected recording {data.get('filename')} of {guid}: {r.status_code} {error}"
+        )
+        logging.debug(f"voctoweb response: {r.text}")
+        if r.status_code == 422:
+            try:
+                errors = r.json()
+            except ValueError:
+                errors = error
+            raise RecordingRejected(r.status_code, errors)
+        raise RecordingRejected(r.status_code)
+    # the cached event metadata now lacks the new recording
+    cache.pop(cache_key(f"/public/events/{guid}"))
+    logging.info(
+        f"{'created' if r.status_code == 201 else 'updated'} recording {data.get('filename')}"
+        f" of {guid}: {r.text}"
+    )
+    return r.json()
+
+
+class UpsertBatcher:
+    """
+    Collects recording upserts for up to `window` seconds or `size` recordings and sends them
+    together, with at most `concurrency` requests in flight, so publishing many files neither
+    pays one round trip after another nor floods voctoweb. Upserts of the same recording within
+    a batch are sent once, with the latest data. Every caller gets the result of its recording.
+    """
+
+    def __init__(self, window: float, size: int, concurrency: int):
+        self.window = window
+        self.size = size
+        self.slots = asyncio.Semaphore(concurrency)
+        # by guid and filename
+        self.pending: dict[tuple[str, str | None], tuple[dict, list[asyncio.Future]]] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, guid: str, data: dict):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (guid, data.get("filename"))
+        _, futures = self.pending.get(key, (None, []))
+        self.pending[key] = (data, futures + [future])
+        if len(self.pending) >= self.size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch: dict[tuple[str, str | None], tuple[dict, list[asyncio.Future]]]):
+        metrics.voctoweb_upsert_batch_size.observe(len(batch))
+        start = time.perf_counter()
+
+        async def send(guid: str, data: dict, futures: list[asyncio.Future]):
+            try:
+                async with self.slots:
+                    result = await _upsert(guid, data)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in futures:
+                    if not future.done():
+                        future.set_result(result)
+
+        await asyncio.gather(
+            *(send(guid, data, futures) for (guid, _), (data, futures) in batch.items())
         )
-        print(f"    {r.text}")
-        return r.json()
+        logging.info(
+            f"sent {len(batch)} recording upserts to voctoweb in {time.perf_counter() - start:.2f}s"
+        )
+
+    async def drain(self):
+        """Sends pending upserts right away and waits for all batches in flight"""
+        self._flush()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+upserts = UpsertBatcher(UPSERT_WINDOW, UPSERT_BATCH_SIZE, UPSERT_CONCURRENCY)
+
+
+async def upsert_recording(guid: str, data: dict):
+    """
+    Creates or updates a recording of an event and returns it (None in dry run mode).
+    Raises RecordingRejected and resilience.UpstreamUnavailable.
+    """
+    if dry_run:
+        return None
+    with timing.span("voctoweb.upsert"):
+        return await upserts.submit(guid, data)
@@ -0,0 +1,181 @@
+"""
+Incremental WebVTT validation, see https://www.w3.org/TR/webvtt1/
+
+    validator = Validator()
+    for chunk in chunks:
+        target.write(validator.feed(chunk))
+    target.write(validator.close())
+    validator.stats.cues, validator.stats.duration
+"""
+
+import codecs
+import os
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+# normalize uploaded files to UTF-8 without BOM and LF line endings
+WEBVTT_NORMALIZE = bool(int(os.environ.get("WEBVTT_NORMALIZE", 1)))
+# accept cues overlapping in time, e.g. for positioned captions of several speakers
+WEBVTT_ALLOW_OVERLAP = bool(int(os.environ.get("WEBVTT_ALLOW_OVERLAP", 0)))
+# seconds the last cue may end after the end of the recording
+WEBVTT_LENGTH_TOLERANCE = float(os.environ.get("WEBVTT_LENGTH_TOLERANCE", 30))
+# longer lines are rejected, which bounds the memory used per upload
+MAX_LINE = 64 * 1024
+
+TIMESTAMP = r"(?:(\d{2,}):)?([0-5]\d):([0-5]\d)\.(\d{3})"
+# start and end of a cue, optionally followed by cue settings
+TIMING = re.compile(rf"({TIMESTAMP})[ \t]+-->[ \t]+({TIMESTAMP})(?:[ \t].*)?")
+# blocks which are not cues, the block name is followed by whitespace or the end of the line
+OTHER_BLOCK = re.compile(r"(NOTE|STYLE|REGION)(?:[ \t]|$)")
+
+HEADER, HEADER_BLOCK, BETWEEN, IDENTIFIER, CUE, NOTE, SKIP = range(7)
+
+
+class WebVTTError(ValueError):
+    pass
+
+
+@dataclass(slots=True)
+class Stats:
+    cues: int = 0
+    # end of the last cue in seconds
+    duration: float = 0.0
+
+
+def _seconds(hours: Optional[str], minutes: str, seconds: str, millis: str) -> float:
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(millis) / 1000
+
+
+def check_duration(stats: Stats, length: Optional[float]):
+    """Raises WebVTTError if the cues end after the recording of `length` seconds"""
+    if length and stats.duration > length + WEBVTT_LENGTH_TOLERANCE:
+        raise WebVTTError(
+            f"cues end at {stats.duration:.3f}s, but the recording is only {length}s long"
+        )
+
+
+class Validator:
+    """
+    Checks a WebVTT file while it is received: the file is decoded and parsed chunk by chunk,
+    only the current (incomplete) line is kept, so time is linear in the file size and memory
+    constant. `feed` and `close` raise WebVTTError as soon as the file is known to be invalid.
+
+    With `normalize`, they return the file as UTF-8 without BOM and with LF line endings,
+    otherwise the data is returned unchanged.
+    """
+
+    def __init__(
+        self, normalize: bool = WEBVTT_NORMALIZE, allow_overlap: bool = WEBVTT_ALLOW_OVERLAP
+    ):
+        self.normalize = normalize
+        self.allow_overlap = allow_overlap
+        self.stats = Stats()
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._received = 0
+        self._started = False
+        self._line = ""
+        self._lineno = 0
+        self._cr = False
+        self._state = HEADER
+        self._start = 0.0
+
+    def _error(self, message: str):
+        raise WebVTTError(f"line {self._lineno}: {message}")
+
+    def _decode(self, chunk: bytes, final: bool) -> str:
+        try:
+            text = self._decoder.decode(chunk, final)
+        except UnicodeDecodeError as e:
+            raise WebVTTError(f"not UTF-8 encoded (byte {self._received + e.start})") from e
+        self._received += len(chunk)
+        if text and not self._started:
+            self._started = True
+            text = text.removeprefix("\ufeff")
+
+        # CR LF may be split across chunks
+        if self._cr and text.startswith("\n"):
+            text = text[1:]
+        if text:
+            self._cr = text.endswith("\r")
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
+    def _timing(self, line: str):
+        match = TIMING.fullmatch(line)
+        if match is None:
+            self._error(f"invalid cue timing '{line}'")
+        start = _seconds(*match.group(2, 3, 4, 5))
+        end = _seconds(*match.group(7, 8, 9, 10))
+        if end <= start:
+            self._error(f"cue ends at {match[6]}, before it starts")
+        if start < self._start:
+            self._error(f"cue starts at {match[1]}, before the previous cue")
+        if start < self.stats.duration and not self.allow_overlap:
+            self._error(f"cue starts at {match[1]}, before the previous cue ended")
+        self._start = start
+        self.stats.cues += 1
+        self.stats.duration = max(self.stats.duration, end)
+
+    def _parse(self, line: str):
+        state = self._state
+        if state == HEADER:
+            if line != "WEBVTT" and not line.startswith(("WEBVTT ", "WEBVTT\t")):
+                self._error("missing WEBVTT header")
+            self._state = HEADER_BLOCK
+        elif not line:
+            if state == IDENTIFIER:
+                self._error("cue identifier without cue timing")
+            self._state = BETWEEN
+        elif state == HEADER_BLOCK:
+            if "-->" in line:
+                self._error("missing empty line after the header")
+        elif state == BETWEEN:
+            if "-->" in line:
+                self._timing(line)
+                self._state = CUE
+            elif block := OTHER_BLOCK.match(line):
+                self._state = NOTE if block[1] == "NOTE" else SKIP
+            else:
+                self._state = IDENTIFIER
+        elif state == IDENTIFIER:
+            if "-->" not in line:
+                self._error("cue identifier without cue timing")
+            self._timing(line)
+            self._state = CUE
+        elif "-->" in line:
+            # most likely a missing empty line between two cues
+            self._error("'-->' in cue text or comment, cues must be separated by an empty line")
+
+    def _lines(self, text: str, final: bool) -> str:
+        if final:
+            # an unterminated last line
+            lines = [self._line + text] if self._line or text else []
+            self._line = ""
+        else:
+            lines = (self._line + text).split("\n")
+            self._line = lines.pop()
+        if len(self._line) > MAX_LINE:
+            self._error(f"line longer than {MAX_LINE} characters")
+        if self._state == HEADER and not lines and not "WEBVTT".startswith(self._line[:6]):
+            # reject e.g. SubRip files without waiting for the end of the line
+            self._lineno += 1
+            self._error("missing WEBVTT header")
+        for line in lines:
+            self._lineno += 1
+            # fast path for cue text, the bulk of a file
+            if self._state != CUE or not line or "-->" in line:
+                self._parse(line)
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def feed(self, chunk: bytes) -> bytes:
+        text = self._lines(self._decode(chunk, False), False)
+        return text.encode() if self.normalize else chunk
+
+    def close(self) -> bytes:
+        """Checks the end of the file, returns the remaining (normalized) data"""
+        text = self._lines(self._decode(b"", True), True)
+        if self._state == HEADER:
+            raise WebVTTError("missing WEBVTT header")
+        if self._state == IDENTIFIER:
+            self._error("cue identifier without cue timing")
+        return text.encode() if self.normalize else b""
@@ -0,0 +1,47 @@
+"""
+The gateway reads its configuration from the environment on import, so it is set up here,
+before any test module imports it: files are published to the SFTP stand-in of the
+benchmarks (started by the `sftp` fixture), state is kept in a temporary directory.
+"""
+
+import multiprocessing
+import os
+import tempfile
+
+import paramiko
+import pytest
+
+from benchmarks import stubs
+
+workdir = tempfile.mkdtemp(prefix="publishing-gw-tests-")
+port = stubs.free_port()
+os.environ.update(
+    SFTP_UPLOAD_HOST="127.0.0.1",
+    SFTP_UPLOAD_PORT=str(port),
+    SFTP_UPLOAD_USER="test",
+    SFTP_UPLOAD_KEY=os.path.join(workdir, "client_key"),
+    CDN_INDEX=os.path.join(workdir, "cdn-index.sqlite"),
+    JOBS_DIR=os.path.join(workdir, "jobs"),
+)
+
+
+@pytest.fixture(scope="session")
+def sftp():
+    """Root directory of the SFTP stand-in"""
+    host_key = os.path.join(workdir, "host_key")
+    paramiko.RSAKey.generate(2048).write_private_key_file(host_key)
+    paramiko.RSAKey.generate(2048).write_private_key_file(os.environ["SFTP_UPLOAD_KEY"])
+    root = os.path.join(workdir, "cdn")
+    os.makedirs(root)
+
+    ctx = multiprocessing.get_context("spawn")
+    latency, down = ctx.Value("d", 0.0, lock=False), ctx.Value("b", 0, lock=False)
+    process = ctx.Process(
+        target=stubs.serve_sftp, args=(port, root, host_key, latency, down), daemon=True
+    )
+    process.start()
+    try:
+        stubs.wait_for_port(port)
+        yield root
+    finally:
+        process.terminate()
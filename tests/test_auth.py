@@ -0,0 +1,209 @@
+"""
+API keys and JWTs, verified against the key set of a local stand-in of the SSO
+"""
+
+import asyncio
+import json
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt import JWT, jwk_from_pem
+
+from publishing_gw import auth
+
+
+def test_key_set():
+    keys = auth.KeySet()
+    keys._load(["secret"])
+    assert keys.check("secret")
+    assert keys.check("token=secret")
+    assert not keys.check("other")
+    assert b"secret" not in b"".join(keys.digests)
+
+
+def test_key_set_reload(monkeypatch):
+    keys = auth.KeySet()
+    keys._load(["old"])
+    config = types.SimpleNamespace(config=types.SimpleNamespace(allowed_keys=["new"]))
+    monkeypatch.setattr(auth.importlib, "reload", lambda module: config)
+
+    # config.py is only checked every API_KEYS_RELOAD seconds, and only reloaded when it changed
+    assert keys.check("old")
+    keys.checked -= auth.API_KEYS_RELOAD + 1
+    assert keys.check("old")
+    keys.mtime = 0
+    keys.checked -= auth.API_KEYS_RELOAD + 1
+    assert keys.check("new")
+    assert not keys.check("old")
+
+
+def test_key_set_keeps_keys_while_config_is_broken(monkeypatch):
+    keys = auth.KeySet()
+    keys._load(["old"])
+
+    def reload(module):
+        raise SyntaxError("invalid syntax")
+
+    monkeypatch.setattr(auth.importlib, "reload", reload)
+    keys.mtime = 0
+    keys.checked -= auth.API_KEYS_RELOAD + 1
+    assert keys.check("old")
+
+
+def signing_key(kid: str):
+    private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    key = jwk_from_pem(pem)
+    return key, {**key.to_dict(public_only=True), "kid": kid, "alg": "RS256"}
+
+
+class SSO:
+    """Serves a key set, which tests may replace, and counts the requests for it"""
+
+    def __init__(self):
+        self.jwks: dict = {"keys": []}
+        self.requests = 0
+        sso = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                sso.requests += 1
+                body = json.dumps(sso.jwks).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/jwks"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return dict(k1=signing_key("k1"), k2=signing_key("k2"))
+
+
+@pytest.fixture
+def sso(keys):
+    sso = SSO()
+    sso.jwks = {"keys": [keys["k1"][1]]}
+    yield sso
+    sso.server.shutdown()
+    sso.server.server_close()
+
+
+def token(keys, kid="k1", signed_by=None, **claims):
+    claims = {"sub": "voc", "exp": int(time.time()) + 600, **claims}
+    claims = {name: value for name, value in claims.items() if value is not None}
+    key = keys[signed_by or kid][0]
+    return JWT().encode(claims, key, alg="RS256", optional_headers={"kid": kid})
+
+
+def verify(verifier: auth.TokenVerifier, *tokens: str) -> list:
+    async def run():
+        return [await verifier.verify(t) for t in tokens]
+
+    return asyncio.run(run())
+
+
+def test_valid_token_is_cached(keys, sso):
+    verifier = auth.TokenVerifier(sso.url)
+    t = token(keys)
+    first, second = verify(verifier, t, t)
+    assert first is not None and first["sub"] == "voc"
+    assert second == first
+    assert sso.requests == 1
+    assert t in verifier.verified
+
+
+def test_token_without_expiry_is_not_cached(keys, sso):
+    verifier = auth.TokenVerifier(sso.url)
+    t = token(keys, exp=None)
+    assert verify(verifier, t)[0] is not None
+    assert t not in verifier.verified
+
+
+@pytest.mark.parametrize(
+    "claims",
+    [
+        dict(exp=int(time.time()) - 600),
+        dict(nbf=int(time.time()) + 600),
+    ],
+)
+def test_expired_token(keys, sso, claims):
+    assert verify(auth.TokenVerifier(sso.url), token(keys, **claims)) == [None]
+
+
+def test_invalid_tokens(keys, sso):
+    header, payload, signature = token(keys).split(".")
+    forged = token(keys, sub="admin").split(".")[1]
+    assert verify(
+        auth.TokenVerifier(sso.url),
+        f"{header}.{forged}.{signature}",
+        f"{header}.{payload}",
+        "not a token",
+        token(keys, "k1", signed_by="k2"),
+    ) == [None] * 4
+
+
+def test_issuer_and_audience(monkeypatch, keys, sso):
+    monkeypatch.setattr(auth, "JWT_ISSUER", "https://sso.c3voc.de")
+    monkeypatch.setattr(auth, "JWT_AUDIENCE", "publishing")
+    verifier = auth.TokenVerifier(sso.url)
+    valid = token(keys, iss="https://sso.c3voc.de", aud=["wiki", "publishing"])
+    assert verify(
+        verifier,
+        valid,
+        token(keys, iss="https://sso.example.org", aud="publishing"),
+        token(keys, iss="https://sso.c3voc.de", aud="wiki"),
+    ) == [verifier.verified[valid][0], None, None]
+
+
+def test_rotated_key(monkeypatch, keys, sso):
+    monkeypatch.setattr(auth, "JWKS_MIN_REFRESH", 0)
+    verifier = auth.TokenVerifier(sso.url)
+    assert verify(verifier, token(keys))[0] is not None
+
+    sso.jwks = {"keys": [keys["k2"][1]]}
+    assert verify(verifier, token(keys, "k2"))[0] is not None
+    assert sso.requests == 2
+
+
+def test_unknown_keys_are_rate_limited(keys, sso):
+    verifier = auth.TokenVerifier(sso.url)
+    tokens = [token(keys, "k2", sub=str(i)) for i in range(3)]
+    assert verify(verifier, *tokens) == [None] * 3
+    # one regular fetch, the refreshes for the unknown key wait for JWKS_MIN_REFRESH
+    assert sso.requests == 1
+
+
+def test_unreachable_key_set(keys, sso):
+    verifier = auth.TokenVerifier(sso.url)
+    t = token(keys)
+    assert verify(verifier, t)[0] is not None
+
+    # a stale key set is used when the SSO is down
+    sso.server.shutdown()
+    sso.server.server_close()
+    verifier.fetched -= auth.JWKS_REFRESH + 1
+    verifier.verified.clear()
+    assert verify(verifier, t)[0] is not None
+    assert verify(auth.TokenVerifier(sso.url), t) == [None]
+
+
+def test_without_key_set(keys):
+    assert verify(auth.TokenVerifier(""), token(keys)) == [None]
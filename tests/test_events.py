@@ -0,0 +1,66 @@
+"""
+The event index, which resolves the names of an event (guid, slug, filenames) to the event
+"""
+
+from publishing_gw import events, model
+
+
+def event(local_id: int, video: dict | None = None) -> dict:
+    return {
+        "guid": f"guid-{local_id}",
+        "slug": f"37c3-{local_id}-some_talk",
+        "title": f"Talk {local_id}",
+        "date": "2023-12-28T19:00:00+01:00",
+        "video": video,
+    }
+
+
+def test_event_without_video():
+    index = events.EventIndex("37c3")
+    index.update([event(1), event(2, {"filename": "37c3-2-deu-Some_Talk_hd.mp4"})])
+
+    summary = index.resolve("guid-1")
+    assert summary is not None and summary.video is None
+    assert index.resolve("37c3-1-some_talk") == summary
+    assert index.resolve("37c3-2-deu-Some_Talk_hd.mp4").guid == "guid-2"
+
+
+def test_partial_event_without_video():
+    partial = model.partial(model.Conference, "events.guid,events.video.filename")
+    page = partial.model_validate(
+        {"events": [event(1), event(2, {"filename": "37c3-2-deu-Some_Talk_hd.mp4"})]}
+    )
+    assert page.model_dump() == {
+        "events": [
+            {"guid": "guid-1", "video": None},
+            {"guid": "guid-2", "video": {"filename": "37c3-2-deu-Some_Talk_hd.mp4"}},
+        ]
+    }
+
+
+def test_names():
+    names = events.event_names(event(3, {"filename": "37c3-3-deu-Some_Talk_hd.mp4"}))
+    assert names == {
+        "guid-3",
+        "37c3-3-some_talk",
+        "37c3-3",
+        "37c3-3-deu-Some_Talk_hd.mp4",
+    }
+
+
+def test_resolve_other_files_of_an_event():
+    index = events.EventIndex("37c3")
+    index.update([event(1)])
+    assert index.resolve("37c3-1-eng-Some_Talk.vtt").guid == "guid-1"
+    assert index.resolve("37c3-9-eng-Other_Talk.vtt") is None
+
+
+def test_update_changes_and_removes_events():
+    index = events.EventIndex("37c3")
+    index.update([event(1, {"filename": "old_hd.mp4"}), event(2)])
+    index.update([event(1, {"filename": "new_hd.mp4"})])
+
+    assert index.resolve("new_hd.mp4").guid == "guid-1"
+    assert index.resolve("old_hd.mp4") is None
+    assert index.resolve("guid-2") is None
+    assert set(index.names.values()) == {"guid-1"}
@@ -0,0 +1,259 @@
+"""
+Downloads of files offered by other services, from a local server supporting range requests
+"""
+
+import asyncio
+import hashlib
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from publishing_gw import fetch
+
+CONTENT = bytes(range(256)) * 41  # 10496 bytes
+
+
+class Source:
+    """Serves `content` at any path, with ranges (if `ranges` is set) and an ETag"""
+
+    def __init__(self):
+        self.content = CONTENT
+        self.etag: str | None = '"v1"'
+        self.ranges = True
+        self.redirect: str | None = None
+        # number of requests after which the file changes
+        self.change_after: int | None = None
+        self.requests: list[dict] = []
+        source = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                source.requests.append(dict(self.headers))
+                if source.change_after is not None and len(source.requests) > source.change_after:
+                    source.etag = '"v2"'
+                if self.path == "/missing":
+                    return self.respond(404, b"not found")
+                if source.redirect:
+                    self.send_response(302)
+                    self.send_header("Location", source.redirect)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                content = source.content
+                match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if_range = self.headers.get("If-Range")
+                if not source.ranges or match is None or if_range not in (None, source.etag):
+                    return self.respond(200, content)
+                start = int(match[1])
+                end = min(int(match[2] or len(content) - 1), len(content) - 1)
+                if start >= len(content):
+                    return self.respond(416, b"")
+                self.respond(
+                    206, content[start : end + 1], f"bytes {start}-{end}/{len(content)}"
+                )
+
+            def respond(self, status: int, body: bytes, content_range: str | None = None):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                if content_range:
+                    self.send_header("Content-Range", content_range)
+                if source.etag:
+                    self.send_header("ETag", source.etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_port
+        self.url = f"http://127.0.0.1:{self.port}/transcript.vtt"
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+
+@pytest.fixture
+def source(monkeypatch):
+    # restored after the test, download() replaces it
+    monkeypatch.setattr(fetch, "client", fetch.client)
+    monkeypatch.setattr(fetch, "FETCH_ALLOW_PRIVATE", True)
+    monkeypatch.setattr(fetch, "FETCH_RANGE_SIZE", 1024)
+    monkeypatch.setattr(fetch, "FETCH_RANGES", 4)
+    source = Source()
+    yield source
+    source.server.shutdown()
+    source.server.server_close()
+
+
+def download(url: str, **kwargs) -> bytes:
+    async def run():
+        # a client per download, as its connections are bound to the event loop
+        fetch.client = httpx.AsyncClient(
+            transport=fetch._transport(),
+            follow_redirects=True,
+            event_hooks={"request": [fetch._check_request]},
+        )
+        try:
+            return b"".join([chunk async for chunk in fetch.download(url, **kwargs)])
+        finally:
+            await fetch.client.aclose()
+
+    return asyncio.run(run())
+
+
+def ranges(source: Source) -> list:
+    return [request.get("Range") for request in source.requests]
+
+
+def test_ranges(source):
+    assert download(source.url) == CONTENT
+    assert len(source.requests) == 11
+    assert sorted(ranges(source)) == sorted(
+        f"bytes={start}-{min(start + 1024, len(CONTENT)) - 1}"
+        for start in range(0, len(CONTENT), 1024)
+    )
+    assert all(r.get("If-Range") == '"v1"' for r in source.requests[1:])
+
+
+def test_single_request(monkeypatch, source):
+    monkeypatch.setattr(fetch, "FETCH_RANGES", 1)
+    assert download(source.url) == CONTENT
+    assert ranges(source) == [None]
+
+
+def test_without_range_support(source):
+    source.ranges = False
+    assert download(source.url) == CONTENT
+    assert len(source.requests) == 1
+
+
+def test_ranges_without_validator(source):
+    # the rest of the file is fetched in one go, as ranges could mix two versions of the file
+    source.etag = None
+    assert download(source.url) == CONTENT
+    assert ranges(source) == ["bytes=0-1023", "bytes=1024-"]
+
+
+def test_empty_file(source):
+    source.content = b""
+    assert download(source.url, size=0) == b""
+
+
+def test_file_changed_while_fetched(source):
+    source.change_after = 1
+    with pytest.raises(fetch.FetchError, match="changed while it was fetched") as e:
+        download(source.url)
+    assert e.value.status_code == 502
+
+
+def test_error_status(source):
+    with pytest.raises(fetch.FetchError, match="responded with status 404") as e:
+        download(f"http://127.0.0.1:{source.port}/missing")
+    assert e.value.status_code == 502
+
+
+@pytest.mark.parametrize("range_support", [True, False])
+def test_max_size(source, range_support):
+    source.ranges = range_support
+    with pytest.raises(fetch.FetchError, match="is larger than 10000 bytes") as e:
+        download(source.url, max_size=10000)
+    assert e.value.status_code == 413
+    # rejected by the announced size, before anything else is fetched
+    assert len(source.requests) == 1
+
+
+def test_max_size_without_announced_size(monkeypatch, source):
+    # e.g. a chunked response
+    chunks = [CONTENT] * 2
+
+    async def aiter_bytes(self):
+        for chunk in chunks:
+            yield chunk
+
+    monkeypatch.setattr(httpx.Response, "aiter_bytes", aiter_bytes)
+    source.ranges = False
+    with pytest.raises(fetch.FetchError, match="is larger than 15000 bytes") as e:
+        download(source.url, max_size=15000)
+    assert e.value.status_code == 413
+
+
+def test_expected_size(source):
+    assert download(source.url, size=len(CONTENT)) == CONTENT
+    with pytest.raises(fetch.FetchError, match=f"has {len(CONTENT)} bytes, expected 10") as e:
+        download(source.url, size=10)
+    assert e.value.status_code == 422
+
+
+def test_sha256(source):
+    digest = hashlib.sha256(CONTENT).hexdigest()
+    assert download(source.url, sha256=digest.upper()) == CONTENT
+    with pytest.raises(fetch.FetchError, match=f"SHA-256 of .* is {digest}, expected 00") as e:
+        download(source.url, sha256="00" * 32)
+    assert e.value.status_code == 422
+
+
+@pytest.mark.parametrize("url", ["file:///etc/passwd", "ftp://example.org/x.vtt", "http:///x"])
+def test_not_http(url):
+    with pytest.raises(fetch.FetchError, match="not a HTTP") as e:
+        fetch.check_url(url)
+    assert e.value.status_code == 422
+
+
+def test_allowed_hosts(monkeypatch):
+    monkeypatch.setattr(fetch, "FETCH_ALLOWED_HOSTS", {"cdn.example.org"})
+    fetch.check_url("https://CDN.example.org/x.vtt")
+    with pytest.raises(fetch.FetchError, match="fetching from example.com is not allowed") as e:
+        fetch.check_url("https://example.com/x.vtt")
+    assert e.value.status_code == 403
+    # listed hosts are not resolved, so they may be internal
+    assert asyncio.run(fetch.resolve("cdn.example.org")) == ["cdn.example.org"]
+
+
+@pytest.mark.parametrize("host", ["localhost", "127.0.0.1", "10.0.0.1", "169.254.169.254", "::1"])
+def test_internal_addresses(host):
+    with pytest.raises(fetch.FetchError, match=f"fetching from {host} .* is not allowed") as e:
+        asyncio.run(fetch.resolve(host))
+    assert e.value.status_code == 403
+
+
+def test_public_address():
+    assert asyncio.run(fetch.resolve("8.8.8.8")) == ["8.8.8.8"]
+
+
+def test_unresolvable_host():
+    with pytest.raises(fetch.FetchError, match="could not resolve") as e:
+        asyncio.run(fetch.resolve("does-not-exist.invalid"))
+    assert e.value.status_code == 502
+
+
+def test_internal_source(monkeypatch, source):
+    monkeypatch.setattr(fetch, "FETCH_ALLOW_PRIVATE", False)
+    with pytest.raises(fetch.FetchError, match="not allowed") as e:
+        download(source.url)
+    assert e.value.status_code == 403
+    assert source.requests == []
+
+
+def test_connects_to_checked_address(monkeypatch, source):
+    monkeypatch.setattr(fetch, "FETCH_ALLOW_PRIVATE", False)
+    resolved = []
+
+    async def resolve(host):
+        resolved.append(host)
+        return ["127.0.0.1"]
+
+    monkeypatch.setattr(fetch, "resolve", resolve)
+    assert download(f"http://cdn.example.org:{source.port}/x.vtt") == CONTENT
+    assert "cdn.example.org" in resolved
+    assert source.requests[0]["Host"] == f"cdn.example.org:{source.port}"
+
+
+def test_redirect_to_other_host(monkeypatch, source):
+    monkeypatch.setattr(fetch, "FETCH_ALLOWED_HOSTS", {"127.0.0.1"})
+    source.redirect = "http://localhost/latest/meta-data/"
+    with pytest.raises(fetch.FetchError, match="fetching from localhost is not allowed") as e:
+        download(source.url)
+    assert e.value.status_code == 403
+    assert len(source.requests) == 1
@@ -0,0 +1,77 @@
+"""
+Partial models, which back the `?fields=` parameter of the API
+"""
+
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from publishing_gw import model, server
+
+CONFERENCE = {
+    "id": "37c3",
+    "title": "37C3: Unlocked",
+    "events": [
+        {
+            "guid": "guid-1",
+            "slug": "37c3-1-some_talk",
+            "title": "Talk 1",
+            "date": "2023-12-28T19:00:00+01:00",
+            "video": {"filename": "37c3-1-deu-Some_Talk_hd.mp4"},
+        }
+    ],
+}
+
+
+def test_only_selected_fields():
+    partial = model.partial(model.Conference, "id, events.slug")
+    assert partial.model_validate(CONFERENCE).model_dump() == {
+        "id": "37c3",
+        "events": [{"slug": "37c3-1-some_talk"}],
+    }
+
+
+def test_fields_in_model_order():
+    partial = model.partial(model.EventSummary, "video.filename,title,guid")
+    assert list(partial.model_fields) == ["guid", "title", "video"]
+
+
+def test_unselected_fields_are_not_validated():
+    partial = model.partial(model.Conference, "id")
+    assert partial.model_validate({"id": "37c3", "events": None}).model_dump() == {"id": "37c3"}
+
+
+def test_selected_fields_are_validated():
+    partial = model.partial(model.Conference, "events.guid")
+    with pytest.raises(ValueError):
+        partial.model_validate({"events": [{"slug": "no guid"}]})
+
+
+def test_partial_models_are_cached():
+    assert model.partial(model.Conference, "id") is model.partial(model.Conference, "id")
+
+
+@pytest.mark.parametrize(
+    "fields, message",
+    [
+        ("id,speakers", "Unknown fields of Conference: speakers"),
+        ("events.video.size", "Unknown fields of Video: size"),
+        ("title.length", "Field Conference.title has no subfields"),
+        ("id,,title", "Invalid field ''"),
+        ("events.", "Invalid field 'events.'"),
+    ],
+)
+def test_invalid_fields(fields, message):
+    with pytest.raises(ValueError, match=message):
+        model.partial(model.Conference, fields)
+
+
+def test_model_response():
+    response = server.model_response(model.Conference, CONFERENCE, "events.video")
+    assert json.loads(response.body) == {
+        "events": [{"video": {"filename": "37c3-1-deu-Some_Talk_hd.mp4"}}]
+    }
+    with pytest.raises(HTTPException) as e:
+        server.model_response(model.Conference, CONFERENCE, "speakers")
+    assert e.value.status_code == 400
@@ -0,0 +1,75 @@
+"""
+Publishing against the SFTP stand-in of the benchmarks, with voctoweb replaced per test
+
+    $ poetry run python -m pytest tests
+"""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from benchmarks import stubs
+from publishing_gw import cdn, model, publish, resilience, voctoweb
+
+GUID = stubs.event_guid(0)
+DIRECTORY = f"/static.media.ccc.de/{stubs.CONFERENCE}"
+PREFIX = f"0-{GUID}"
+CONTENT = b"WEBVTT\n\n00:00.000 --> 00:01.000\nHello\n"
+
+
+@pytest.fixture(scope="module")
+def gateway(sftp):
+    return dict(cdn=cdn, model=model, publish=publish, resilience=resilience, voctoweb=voctoweb)
+
+
+def publish_file(gateway, content: bytes = CONTENT):
+    cdn, model, publish = gateway["cdn"], gateway["model"], gateway["publish"]
+    recording = model.FileMeta(language="deu", mime_type="text/vtt")
+
+    async def run():
+        remote = await cdn.ReplicatedFile(DIRECTORY).open()
+        await remote.write(content)
+        return await publish.finish(remote, GUID, DIRECTORY, PREFIX, recording)
+
+    return asyncio.run(run())
+
+
+def fake_upserts(monkeypatch, gateway, *results):
+    """Replaces voctoweb.upsert_recording, which returns (or raises) `results` one by one"""
+    calls = []
+
+    async def upsert_recording(guid, data):
+        result = results[len(calls)]
+        calls.append(data["filename"])
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    monkeypatch.setattr(gateway["voctoweb"], "upsert_recording", upsert_recording)
+    return calls
+
+
+def test_failed_registration_is_retried(monkeypatch, gateway):
+    unavailable = gateway["resilience"].UpstreamUnavailable("voctoweb", "down")
+    calls = fake_upserts(monkeypatch, gateway, unavailable, {"id": 1})
+
+    with pytest.raises(gateway["resilience"].UpstreamUnavailable):
+        publish_file(gateway)
+    # the file is in place now, but voctoweb does not know it yet
+    assert publish_file(gateway)["status"] == "published"
+    assert publish_file(gateway)["status"] == "unchanged"
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize(
+    "rejection, status_code",
+    [((422, {"filename": ["is invalid"]}), 422), ((500,), 502)],
+)
+def test_rejected_registration(monkeypatch, gateway, rejection, status_code):
+    content = CONTENT + f"\n00:02.000 --> 00:03.000\n{status_code}\n".encode()
+    fake_upserts(monkeypatch, gateway, gateway["voctoweb"].RecordingRejected(*rejection))
+
+    with pytest.raises(HTTPException) as e:
+        publish_file(gateway, content)
+    assert e.value.status_code == status_code
@@ -0,0 +1,110 @@
+"""
+Retries and the circuit breaker guarding calls to upstreams
+"""
+
+import asyncio
+
+import pytest
+
+from publishing_gw import resilience
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(resilience, "backoff", lambda attempt: 0)
+
+
+def test_breaker_opens_at_threshold():
+    breaker = resilience.CircuitBreaker("upstream", threshold=3, reset_timeout=60)
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.check()
+
+    breaker.failure()
+    assert breaker.state == "open"
+    with pytest.raises(resilience.UpstreamUnavailable) as e:
+        breaker.check()
+    assert e.value.upstream == "upstream"
+    assert 0 < e.value.retry_after <= 60
+
+
+def test_success_resets_failures():
+    breaker = resilience.CircuitBreaker("upstream", threshold=2, reset_timeout=60)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert (breaker.state, breaker.failures) == ("closed", 1)
+
+
+def test_half_open():
+    breaker = resilience.CircuitBreaker("upstream", threshold=1, reset_timeout=60)
+    breaker.failure()
+    assert breaker.state == "open"
+
+    # the reset timeout passed
+    assert breaker.opened_at is not None
+    breaker.opened_at -= 61
+    assert breaker.state == "half-open"
+    breaker.check()
+
+    # the next failure opens it for another period
+    breaker.failure()
+    assert breaker.state == "open"
+
+    breaker.opened_at -= 61
+    breaker.success()
+    assert (breaker.state, breaker.failures) == ("closed", 0)
+
+
+def flaky(*results):
+    """An upstream call which returns (or raises) `results` one by one"""
+    calls = []
+
+    async def fn(*args):
+        result = results[len(calls)]
+        calls.append(args)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    return fn, calls
+
+
+def test_call_retries():
+    breaker = resilience.CircuitBreaker("upstream", threshold=5)
+    fn, calls = flaky(resilience.Retryable("502"), "ok")
+
+    assert asyncio.run(resilience.call(breaker, fn, "arg")) == "ok"
+    assert calls == [("arg",), ("arg",)]
+    assert breaker.failures == 0
+
+
+def test_call_gives_up(monkeypatch):
+    monkeypatch.setattr(resilience, "RETRY_ATTEMPTS", 2)
+    breaker = resilience.CircuitBreaker("upstream", threshold=5)
+    fn, calls = flaky(resilience.Retryable("502"), resilience.Retryable("503"), "ok")
+
+    with pytest.raises(resilience.UpstreamUnavailable, match="upstream is unavailable: 503"):
+        asyncio.run(resilience.call(breaker, fn))
+    assert len(calls) == 2
+    assert breaker.failures == 2
+
+
+def test_call_fails_fast_while_open():
+    breaker = resilience.CircuitBreaker("upstream", threshold=2)
+    fn, calls = flaky(*[resilience.Retryable("502")] * 3)
+
+    with pytest.raises(resilience.UpstreamUnavailable, match="retry in"):
+        asyncio.run(resilience.call(breaker, fn))
+    assert len(calls) == 2
+
+
+def test_other_errors_are_not_retried():
+    breaker = resilience.CircuitBreaker("upstream", threshold=5)
+    fn, calls = flaky(KeyError("guid"), "ok")
+
+    with pytest.raises(KeyError):
+        asyncio.run(resilience.call(breaker, fn))
+    assert len(calls) == 1
+    assert breaker.failures == 0
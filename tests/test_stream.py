@@ -0,0 +1,97 @@
+"""
+Streaming multipart/form-data parser, with request bodies arriving in chunks of any size
+"""
+
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+from publishing_gw import stream
+
+BOUNDARY = "boundary"
+BODY = (
+    b"--boundary\r\n"
+    b'Content-Disposition: form-data; name="meta"\r\n\r\n'
+    b'{"language": "deu"}\r\n'
+    b"--boundary\r\n"
+    b'Content-Disposition: form-data; name="file"; filename="talk.vtt"\r\n'
+    b"Content-Type: text/vtt\r\n\r\n"
+    b"WEBVTT\n\n00:00.000 --> 00:01.000\nHello\n\r\n"
+    b"--boundary--\r\n"
+)
+
+
+def request(body: bytes, chunk_size: int, content_type: str) -> Request:
+    chunks = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/",
+        "headers": [(b"content-type", content_type.encode())],
+    }
+    return Request(scope, receive)
+
+
+def parse(body: bytes, chunk_size: int = 1024, content_type: str = "") -> list:
+    content_type = content_type or f"multipart/form-data; boundary={BOUNDARY}"
+
+    async def run():
+        return [
+            (part, chunk)
+            async for part, chunk in stream.iter_multipart(request(body, chunk_size, content_type))
+        ]
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 1024])
+def test_fields_and_files(chunk_size):
+    events = parse(BODY, chunk_size)
+
+    meta, end = events[0]
+    assert end is None
+    assert (meta.name, meta.filename, meta.value) == ("meta", None, b'{"language": "deu"}')
+
+    files = events[1:]
+    part = files[0][0]
+    assert (part.name, part.filename, part.content_type) == ("file", "talk.vtt", "text/vtt")
+    assert all(p is part for p, _ in files)
+    assert files[-1][1] is None
+    assert b"".join(c for _, c in files[:-1]) == b"WEBVTT\n\n00:00.000 --> 00:01.000\nHello\n"
+    # file contents are not kept in memory
+    assert part.value == b""
+
+
+def test_file_is_streamed():
+    events = parse(BODY, 8)
+    assert len([chunk for part, chunk in events if part.name == "file" and chunk]) > 1
+
+
+def test_not_multipart():
+    with pytest.raises(stream.MultipartError, match="Expected a multipart/form-data"):
+        parse(b"{}", content_type="application/json")
+    with pytest.raises(stream.MultipartError, match="Expected a multipart/form-data"):
+        parse(BODY, content_type="multipart/form-data")
+
+
+def test_field_without_name():
+    body = BODY.replace(b'name="meta"', b'title="meta"')
+    with pytest.raises(stream.MultipartError, match='"name" must be provided'):
+        parse(body)
+
+
+def test_field_too_large(monkeypatch):
+    monkeypatch.setattr(stream, "MAX_FIELD_SIZE", 8)
+    with pytest.raises(stream.MultipartError, match="Form field 'meta' is too large"):
+        parse(BODY)
+
+
+def test_malformed_body():
+    with pytest.raises(stream.MultipartError, match="Malformed multipart body"):
+        parse(BODY.replace(b"--boundary\r\n", b"--boundary\r\r", 1))
@@ -0,0 +1,178 @@
+"""
+Resumable (tus) uploads against the SFTP stand-in of the benchmarks: offsets, finalizing,
+and resuming after a restart
+"""
+
+import asyncio
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from benchmarks import stubs
+from publishing_gw import jobs, model, publish, uploads, voctoweb
+
+GUID = stubs.event_guid(1)
+DIRECTORY = f"/static.media.ccc.de/{stubs.CONFERENCE}"
+PREFIX = f"1-{GUID}"
+CONTENT = b"WEBVTT\n\n00:00.000 --> 00:01.000\nHello\n\n00:01.000 --> 00:02.000\nWorld\n"
+
+
+@pytest.fixture
+def registered(sftp, monkeypatch):
+    """Filenames registered in voctoweb, the event (a 60s recording) is looked up without it"""
+    os.makedirs(jobs.JOBS_DIR, exist_ok=True)
+    filenames = []
+
+    async def lookup_target(guid):
+        return DIRECTORY, PREFIX
+
+    async def event_length(guid):
+        return 60.0
+
+    async def upsert_recording(guid, data):
+        filenames.append(data["filename"])
+        return {"id": len(filenames)}
+
+    monkeypatch.setattr(publish, "lookup_target", lookup_target)
+    monkeypatch.setattr(publish, "event_length", event_length)
+    monkeypatch.setattr(voctoweb, "upsert_recording", upsert_recording)
+    return filenames
+
+
+def run(fn):
+    async def main():
+        await uploads.start()
+        try:
+            return await fn()
+        finally:
+            await uploads.stop()
+
+    return asyncio.run(main())
+
+
+async def body(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+async def create(language: str, content: bytes = CONTENT, filename="talk.vtt") -> model.Upload:
+    return await uploads.create(
+        stubs.CONFERENCE,
+        GUID,
+        model.UploadCreate(
+            recording=model.FileMeta(language=language, mime_type="text/vtt"),
+            filename=filename,
+            length=len(content),
+        ),
+    )
+
+
+def test_upload(sftp, registered):
+    half = len(CONTENT) // 2
+
+    async def flow():
+        upload = await create("eng")
+        assert (upload.offset, upload.length) == (0, len(CONTENT))
+
+        assert await uploads.append(upload.id, 0, body(CONTENT[:10], CONTENT[10:half])) == half
+        assert (await uploads.status(upload.id)).offset == half
+
+        with pytest.raises(HTTPException) as e:
+            await uploads.append(upload.id, 0, body(CONTENT))
+        assert e.value.status_code == 409
+        assert e.value.headers == {"Upload-Offset": str(half)}
+
+        with pytest.raises(HTTPException) as e:
+            await uploads.finalize(upload.id)
+        assert e.value.status_code == 409
+
+        assert await uploads.append(upload.id, half, body(CONTENT[half:])) == len(CONTENT)
+        result = await uploads.finalize(upload.id)
+        with pytest.raises(HTTPException) as e:
+            await uploads.status(upload.id)
+        assert e.value.status_code == 404
+        return result
+
+    result = run(flow)
+    assert result["status"] == "published"
+    assert registered == [f"{PREFIX}-eng.vtt"]
+    with open(f"{sftp}{DIRECTORY}/{PREFIX}-eng.vtt", "rb") as f:
+        assert f.read() == CONTENT
+    assert not [name for name in os.listdir(f"{sftp}{DIRECTORY}") if name.startswith(".upload-")]
+
+
+def test_finalize_after_restart(sftp, registered):
+    upload = run(lambda: create("fra"))
+    run(lambda: uploads.append(upload.id, 0, body(CONTENT)))
+    # the digest and WebVTT state of a previous process are gone, the staged file is read again
+    uploads.hashers.clear()
+    uploads.validators.clear()
+    assert run(lambda: uploads.finalize(upload.id))["status"] == "published"
+    assert registered == [f"{PREFIX}-fra.vtt"]
+
+
+def test_upload_exceeding_its_length(sftp, registered):
+    async def flow():
+        upload = await create("spa")
+        with pytest.raises(HTTPException) as e:
+            await uploads.append(upload.id, 0, body(CONTENT, b"more"))
+        assert e.value.status_code == 413
+        # the data received so far is kept
+        return await uploads.status(upload.id)
+
+    assert run(flow).offset == len(CONTENT)
+
+
+def test_invalid_webvtt(sftp, registered):
+    content = b"1\n00:00:01,000 --> 00:00:02,000\nSubRip\n"
+
+    async def flow():
+        upload = await create("ita", content)
+        with pytest.raises(HTTPException) as e:
+            await uploads.append(upload.id, 0, body(content))
+        assert e.value.status_code == 422
+        assert "missing WEBVTT header" in e.value.detail
+
+    run(flow)
+    assert registered == []
+
+
+def test_cues_beyond_the_recording(sftp, registered):
+    content = CONTENT + b"\n10:00.000 --> 10:01.000\nLater\n"
+
+    async def flow():
+        upload = await create("nld", content)
+        await uploads.append(upload.id, 0, body(content))
+        with pytest.raises(HTTPException) as e:
+            await uploads.finalize(upload.id)
+        assert e.value.status_code == 422
+        with pytest.raises(HTTPException) as e:
+            await uploads.status(upload.id)
+        assert e.value.status_code == 404
+        return upload
+
+    upload = run(flow)
+    assert registered == []
+    assert not os.path.exists(f"{sftp}{DIRECTORY}/{PREFIX}-nld.vtt")
+    assert not os.path.exists(f"{sftp}{DIRECTORY}/.upload-{upload.id}")
+
+
+def test_only_vtt_files(sftp, registered):
+    with pytest.raises(HTTPException) as e:
+        run(lambda: create("eng", filename="talk.srt"))
+    assert e.value.status_code == 400
+
+
+def test_delete(sftp, registered):
+    async def flow():
+        upload = await create("por")
+        await uploads.append(upload.id, 0, body(CONTENT[:10]))
+        await uploads.delete(upload.id)
+        with pytest.raises(HTTPException) as e:
+            await uploads.status(upload.id)
+        assert e.value.status_code == 404
+        return upload
+
+    upload = run(flow)
+    assert not os.path.exists(f"{sftp}{DIRECTORY}/.upload-{upload.id}")
@@ -0,0 +1,118 @@
+"""
+Incremental WebVTT validation, with files split into chunks at every possible position
+"""
+
+import pytest
+
+from publishing_gw import webvtt
+
+CUES = "WEBVTT\n\n00:00.000 --> 00:01.000\nHällo\n\n1\n00:01.500 --> 00:02.000 align:start\nWelt\n"
+
+
+def validate(data: bytes, chunk_size: int = 1, **kwargs) -> tuple[bytes, webvtt.Stats]:
+    validator = webvtt.Validator(**kwargs)
+    output = b"".join(
+        validator.feed(data[i : i + chunk_size]) for i in range(0, len(data), chunk_size)
+    )
+    return output + validator.close(), validator.stats
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1024])
+def test_valid_file(chunk_size):
+    output, stats = validate(CUES.encode(), chunk_size, normalize=True)
+    assert output == CUES.encode()
+    assert (stats.cues, stats.duration) == (2, 2.0)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 1024])
+def test_bom_and_crlf_are_normalized(chunk_size):
+    data = b"\xef\xbb\xbf" + CUES.replace("\n", "\r\n").encode()
+    output, stats = validate(data, chunk_size, normalize=True)
+    assert output == CUES.encode()
+    assert stats.cues == 2
+
+
+def test_unchanged_without_normalize():
+    data = b"\xef\xbb\xbf" + CUES.replace("\n", "\r\n").encode()
+    output, _ = validate(data, 3, normalize=False)
+    assert output == data
+
+
+def test_cr_line_endings():
+    output, stats = validate(CUES.replace("\n", "\r").encode(), normalize=True)
+    assert output == CUES.encode()
+    assert stats.cues == 2
+
+
+def test_utf8_sequence_split_across_chunks():
+    # "ä" is encoded in two bytes, which end up in separate chunks with a chunk size of 1
+    output, _ = validate(CUES.encode(), 1, normalize=True)
+    assert "Hällo" in output.decode()
+
+
+def test_unterminated_last_line():
+    output, stats = validate(CUES.rstrip("\n").encode(), normalize=True)
+    assert output == CUES.encode()
+    assert stats.cues == 2
+
+
+@pytest.mark.parametrize(
+    "data, message",
+    [
+        (b"1\n00:00:01,000 --> 00:00:02,000\nSubRip\n", "missing WEBVTT header"),
+        (b"", "missing WEBVTT header"),
+        (b"WEBVTT\n\n\xff\n", r"not UTF-8 encoded \(byte 8\)"),
+        (b"WEBVTT\n\n00:01.000 --> 00:00.500\nBackwards\n", "before it starts"),
+        (b"WEBVTT\n\n00:00.000 --> 00:01.000\nOne\n00:01.000 --> 00:02.000\n", "empty line"),
+        (b"WEBVTT\n\nidentifier\n\n", "cue identifier without cue timing"),
+        (b"WEBVTT\n\n00:00.000 -> 00:01.000\nArrow\n", "cue identifier without cue timing"),
+        (b"WEBVTT\n\n0:00.000 --> 00:01.000\nShort\n", "invalid cue timing"),
+    ],
+)
+def test_invalid_file(data, message):
+    with pytest.raises(webvtt.WebVTTError, match=message):
+        validate(data)
+
+
+def test_truncated_utf8_sequence_at_the_end():
+    with pytest.raises(webvtt.WebVTTError, match="not UTF-8 encoded"):
+        validate(CUES.encode() + b"\xc3")
+
+
+OVERLAP = b"WEBVTT\n\n00:00.000 --> 00:02.000\nOne\n\n00:01.000 --> 00:03.000\nTwo\n"
+
+
+def test_overlapping_cues():
+    with pytest.raises(webvtt.WebVTTError, match="before the previous cue ended"):
+        validate(OVERLAP, allow_overlap=False)
+    _, stats = validate(OVERLAP, allow_overlap=True)
+    assert (stats.cues, stats.duration) == (2, 3.0)
+
+
+def test_cues_out_of_order():
+    data = b"WEBVTT\n\n00:02.000 --> 00:03.000\nOne\n\n00:01.000 --> 00:04.000\nTwo\n"
+    with pytest.raises(webvtt.WebVTTError, match="before the previous cue$"):
+        validate(data, allow_overlap=True)
+
+
+def test_notes_and_styles_are_skipped():
+    data = (
+        b"WEBVTT\n\nNOTE a comment\nspanning lines\n\nSTYLE\n::cue { color: red }\n\n"
+        b"00:00.000 --> 00:01.000\nText\n"
+    )
+    _, stats = validate(data)
+    assert stats.cues == 1
+
+
+def test_overlong_line():
+    data = b"WEBVTT\n\n00:00.000 --> 00:01.000\n" + b"x" * (webvtt.MAX_LINE + 1)
+    with pytest.raises(webvtt.WebVTTError, match="line longer than"):
+        validate(data, 4096)
+
+
+def test_check_duration():
+    stats = webvtt.Stats(cues=1, duration=100.0)
+    webvtt.check_duration(stats, 100.0 - webvtt.WEBVTT_LENGTH_TOLERANCE)
+    webvtt.check_duration(stats, None)
+    with pytest.raises(webvtt.WebVTTError, match="recording is only"):
+        webvtt.check_duration(stats, 50.0)